@@ -24,16 +24,43 @@ try:
 except ImportError:
     from md5 import md5
 
+from threading import Lock
 import time
 from . import CacheStore
 
 
+# Locks for refreshing cache items, shared by the items with the same key
+# in all the template instances of the process: key -> [lock, users]
+_refreshLocks = {}
+_refreshLocksLock = Lock()
+
+
+def _getRefreshLock(key):
+    with _refreshLocksLock:
+        entry = _refreshLocks.get(key)
+        if entry is None:
+            entry = _refreshLocks[key] = [Lock(), 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def _putRefreshLock(key):
+    with _refreshLocksLock:
+        entry = _refreshLocks[key]
+        entry[1] -= 1
+        if not entry[1]:
+            del _refreshLocks[key]
+
+
 class CacheItem(object):
     '''
     A CacheItem is a container storing:
 
         - cacheID (string)
         - refreshTime (timestamp or None) : last time the cache was refreshed
+        - expiryTime (timestamp or 0) : when the cache has to be refreshed
+        - hardExpiryTime (timestamp or 0) : when the cache can no longer be
+          used while it is being refreshed (0: at expiryTime)
         - data (string) : the content of the cache
     '''
 
@@ -42,6 +69,7 @@ class CacheItem(object):
         self._cacheStore = cacheStore
         self._refreshTime = None
         self._expiryTime = 0
+        self._hardExpiryTime = 0
 
     def hasExpired(self):
         return (self._expiryTime and time.time() > self._expiryTime)
@@ -52,9 +80,20 @@ class CacheItem(object):
     def getExpiryTime(self):
         return self._expiryTime
 
+    def hasHardExpired(self):
+        expiryTime = self._hardExpiryTime or self._expiryTime
+        return (expiryTime and time.time() > expiryTime)
+
+    def setHardExpiryTime(self, time):
+        self._hardExpiryTime = time
+
+    def getHardExpiryTime(self):
+        return self._hardExpiryTime
+
     def setData(self, data):
         self._refreshTime = time.time()
-        self._cacheStore.set(self._cacheItemID, data, self._expiryTime)
+        self._cacheStore.set(self._cacheItemID, data,
+                             self._hardExpiryTime or self._expiryTime)
 
     def getRefreshTime(self):
         return self._refreshTime
@@ -71,12 +110,134 @@ class CacheItem(object):
         self._cacheStore.delete(self._cacheItemID)
         self._refreshTime = None
 
+    def _refreshLockKey(self):
+        storeKey = getattr(self._cacheStore, 'storeKey', None)
+        if storeKey is None:  # not a _CacheDataStoreWrapper
+            return (id(self._cacheStore), self._cacheItemID)
+        return storeKey(self._cacheItemID)
+
+    def startRefresh(self, serveStale=False):
+        """Start refreshing the item; return whether the caller should
+        render it.
+
+        Only one thread at a time refreshes an item (with the same key in
+        any template instance of the process).  While it does, the other
+        callers get False; they use the old data if serveStale is true and
+        the data hasn't reached its hard expiry time, otherwise they wait
+        for the refresh to finish and use its result.  A caller that gets
+        True must call endRefresh() when it is done.
+        """
+        key = self._refreshLockKey()
+        lock = _getRefreshLock(key)
+        if lock.acquire(False):
+            return True
+        if serveStale and self.getRefreshTime() and not self.hasHardExpired():
+            _putRefreshLock(key)
+            return False
+        lock.acquire()
+        if self._isFresh():  # refreshed by the thread we waited for
+            lock.release()
+            _putRefreshLock(key)
+            return False
+        return True
+
+    def endRefresh(self):
+        key = self._refreshLockKey()
+        _refreshLocks[key][0].release()
+        _putRefreshLock(key)
+
+    def _isFresh(self):
+        return bool(self.getRefreshTime()) and not self.hasExpired()
+
+
+class SharedCacheItem(CacheItem):
+    '''
+    A CacheItem whose data may have been stored by another template
+    instance (or process) that shares the cache store.  The data is valid
+    as long as the cache store has it; the expiry times are stored with it.
+    '''
+    _storedData = None
+    _prefetched = False
+
+    def hasExpired(self):
+        # The generated code calls this first: look for data in the store
+        # unless prefetchCacheItems() just did
+        if self._refreshTime is None:
+            if self._prefetched:
+                self._prefetched = False
+            else:
+                self._load()
+        return CacheItem.hasExpired(self)
+
+    def _load(self):
+        try:
+            self._setStoredValue(self._cacheStore.get(self._cacheItemID))
+        except KeyError:
+            pass
+
+    def _setStoredValue(self, value):
+        data, self._expiryTime, self._hardExpiryTime = value
+        self._storedData = (data,)
+        # refreshed by somebody else; the time isn't known
+        self._refreshTime = time.time()
+
+    def setData(self, data):
+        self._storedData = None
+        self._refreshTime = time.time()
+        self._cacheStore.set(
+            self._cacheItemID,
+            (data, self._expiryTime, self._hardExpiryTime),
+            self._hardExpiryTime or self._expiryTime)
+
+    def getData(self):
+        assert self._refreshTime
+        if self._storedData is not None:
+            data, = self._storedData
+            self._storedData = None
+            return data
+        return self._cacheStore.get(self._cacheItemID)[0]
+
+    def clear(self):
+        self._storedData = None
+        CacheItem.clear(self)
+
+    def _isFresh(self):
+        # look for data stored by the thread we waited for
+        self._refreshTime = self._storedData = None
+        self._load()
+        return CacheItem._isFresh(self)
+
+
+def prefetchCacheItems(cacheItems):
+    """Load the data of SharedCacheItems that have not been loaded yet with
+    one getMulti() call per cache store instead of a get() per item.
+    """
+    stores = {}
+    for cacheItem in cacheItems:
+        if not isinstance(cacheItem, SharedCacheItem) \
+                or cacheItem._refreshTime is not None:
+            continue
+        wrapper = cacheItem._cacheStore
+        store, items = stores.setdefault(
+            id(wrapper.dataStore()), (wrapper.dataStore(), {}))
+        items[wrapper.storeKey(cacheItem._cacheItemID)] = cacheItem
+        cacheItem._prefetched = True
+    for store, items in stores.values():
+        for key, value in store.getMulti(list(items)).items():
+            items[key]._setStoredValue(value)
+
 
 class _CacheDataStoreWrapper(object):
     def __init__(self, dataStore, keyPrefix):
         self._dataStore = dataStore
         self._keyPrefix = keyPrefix
 
+    def dataStore(self):
+        return self._dataStore
+
+    def storeKey(self, key):
+        return self._keyPrefix + key
+
     def get(self, key):
         return self._dataStore.get(self._keyPrefix + key)
 
@@ -138,3 +299,15 @@ class CacheRegion(object):
             self._cacheItems[cacheItemID] = cacheItem
             self._isNew = False
         return self._cacheItems[cacheItemID]
+
+
+class SharedCacheRegion(CacheRegion):
+    '''
+    A `CacheRegion` whose items are shared with the template instances
+    that use the same cache store and key prefix; the region is never new
+    because its items may already be in the cache store.
+    '''
+    _cacheItemClass = SharedCacheItem
+
+    def isNew(self):
+        return False
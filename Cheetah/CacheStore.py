@@ -13,8 +13,22 @@ get(key, val)
   returns val or raises a KeyError
 delete(key)
   deletes or raises a KeyError
+
+getSharedCacheStore() returns a MemoryCacheStore shared by all the templates
+of the process (see Template._CHEETAH_shareCacheRegions).  SQLiteCacheStore
+keeps the data in a local file that can be shared by several processes.
 '''
+from collections import OrderedDict
+from numbers import Number
+from threading import Lock, local
+import os
+import pickle
+import sys
 import time
+try:
+    import sqlite3
+except ImportError:  # Python built without sqlite3
+    sqlite3 = None
 
 
 class Error(Exception):
@@ -38,47 +52,314 @@ class AbstractCacheStore(object):
     def get(self, key):
         raise NotImplementedError
 
+    def getMulti(self, keys):
+        """Return a dict with the values of the keys that are in the store.
+
+        Stores that can fetch several values at once override this.
+        """
+        values = {}
+        for key in keys:
+            try:
+                values[key] = self.get(key)
+            except KeyError:
+                pass
+        return values
+
 
 class MemoryCacheStore(AbstractCacheStore):
-    def __init__(self):
-        self._data = {}
+    """Store the data in a dictionary in memory.
+
+    The store can be bounded by the number of entries (maxEntries) and the
+    total size of the values (maxSize, in characters for strings; tuples
+    and lists count their strings); the least recently used entries are
+    evicted to stay within the bounds.
+    Expired entries are dropped when they are looked up and by a sweep of
+    the whole store after every sweepInterval seconds.  The store counts
+    hits, misses, evictions and expirations (see .stats()) and can be used
+    by several threads.
+    """
+
+    def __init__(self, maxEntries=None, maxSize=None, sweepInterval=60):
+        self.maxEntries = maxEntries
+        self.maxSize = maxSize
+        self.sweepInterval = sweepInterval
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self._data = OrderedDict()  # least recently used first
+        self._size = 0
+        self._nextSweep = time.time() + sweepInterval
+        self._lock = Lock()
+
+    def _sizeOf(self, val):
+        if isinstance(val, (tuple, list)):
+            # e.g. (data, expiry, hardExpiry) of a SharedCacheItem:
+            # the size of the data, the numbers don't count
+            return sum([self._sizeOf(item) for item in val
+                        if item is not None and not isinstance(item, Number)])
+        try:
+            return len(val)
+        except TypeError:
+            return sys.getsizeof(val)
+
+    def _isExpired(self, exptime, now):
+        return exptime and now > exptime
+
+    def _remove(self, key):
+        val, exptime = self._data.pop(key)
+        self._size -= self._sizeOf(val)
+
+    def _contains(self, key):
+        if key not in self._data:
+            return False
+        if self._isExpired(self._data[key][1], time.time()):
+            self._remove(key)
+            self.expirations += 1
+            return False
+        return True
+
+    def _set(self, key, val, time):
+        self._maybeSweep()
+        data = self._data
+        if key in data:
+            self._remove(key)
+        data[key] = (val, time)
+        self._size += self._sizeOf(val)
+        while data and (
+                (self.maxEntries is not None and len(data) > self.maxEntries)
+                or (self.maxSize is not None and self._size > self.maxSize)):
+            self._remove(next(iter(data)))
+            self.evictions += 1
+
+    def _maybeSweep(self):
+        now = time.time()
+        if now >= self._nextSweep:
+            self._nextSweep = now + self.sweepInterval
+            self._sweep(now)
+
+    def _sweep(self, now):
+        expired = [key for key, (val, exptime) in self._data.items()
+                   if self._isExpired(exptime, now)]
+        for key in expired:
+            self._remove(key)
+        self.expirations += len(expired)
+        return len(expired)
+
+    def sweep(self):
+        """Drop the expired entries; return their number."""
+        with self._lock:
+            return self._sweep(time.time())
 
     def set(self, key, val, time=0):
-        self._data[key] = (val, time)
+        with self._lock:
+            self._set(key, val, time)
 
     def add(self, key, val, time=0):
-        if key in self._data:
-            raise Error('a value for key %r is already in the cache' % key)
-        self._data[key] = (val, time)
+        with self._lock:
+            if self._contains(key):
+                raise Error(
+                    'a value for key %r is already in the cache' % key)
+            self._set(key, val, time)
 
     def replace(self, key, val, time=0):
-        if key in self._data:
-            raise Error('a value for key %r is already in the cache' % key)
-        self._data[key] = (val, time)
+        with self._lock:
+            if not self._contains(key):
+                raise Error('no value for key %r in the cache' % key)
+            self._set(key, val, time)
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def get(self, key):
+        with self._lock:
+            if not self._contains(key):
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            # move to the most recently used end
+            entry = self._data.pop(key)
+            self._data[key] = entry
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def stats(self):
+        """Return a dict with the counters and the current size."""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'entries': len(self._data),
+                    'size': self._size,
+                    }
+
+
+# The bounds of the store returned by getSharedCacheStore()
+sharedCacheStoreMaxEntries = 10000
+sharedCacheStoreMaxSize = 64 * 1024 * 1024
+_sharedCacheStore = None
+_sharedCacheStoreLock = Lock()
+
+
+def getSharedCacheStore():
+    """Return the process-wide MemoryCacheStore, creating it if needed."""
+    global _sharedCacheStore
+    with _sharedCacheStoreLock:
+        if _sharedCacheStore is None:
+            _sharedCacheStore = MemoryCacheStore(
+                maxEntries=sharedCacheStoreMaxEntries,
+                maxSize=sharedCacheStoreMaxSize)
+        return _sharedCacheStore
+
+
+class SQLiteCacheStore(AbstractCacheStore):
+    """Store the data in an SQLite database file.
+
+    All the processes (e.g. the pre-forked workers of a web server) that
+    open the same file share the data; no server is needed.  The values are
+    pickled.  Like with MemoryCacheStore the time is the absolute expiry
+    time (0 means never); expired entries are dropped by a sweep of the
+    database on the first set() after sweepInterval seconds.
+    """
+
+    def __init__(self, path, timeout=10, sweepInterval=60):
+        if sqlite3 is None:
+            raise Error('SQLiteCacheStore needs the sqlite3 module')
+        self._path = path
+        self._timeout = timeout
+        self.sweepInterval = sweepInterval
+        self._nextSweep = time.time() + sweepInterval
+        self._local = local()
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+
+    def path(self):
+        return self._path
+
+    def _connection(self):
+        # a connection can be used by neither another thread nor the child
+        # of a fork()
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self._path, timeout=self._timeout)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def close(self):
+        """Close the database connection of the current thread."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            self._local.connection = None
+            connection.close()
+
+    def _dumps(self, val):
+        return sqlite3.Binary(pickle.dumps(val, 2))
+
+    def set(self, key, val, time=0):
+        self._maybeSweep()
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                (key, self._dumps(val), time))
+
+    def add(self, key, val, time=0):
+        self._maybeSweep()
+        with self._connection() as connection:
+            self._deleteExpired(connection, key)
+            cursor = connection.execute(
+                'INSERT OR IGNORE INTO cache VALUES (?, ?, ?)',
+                (key, self._dumps(val), time))
+            if not cursor.rowcount:
+                raise Error(
+                    'a value for key %r is already in the cache' % key)
+
+    def replace(self, key, val, time=0):
+        with self._connection() as connection:
+            self._deleteExpired(connection, key)
+            cursor = connection.execute(
+                'UPDATE cache SET value = ?, expires = ? WHERE key = ?',
+                (self._dumps(val), time, key))
+            if not cursor.rowcount:
+                raise Error('no value for key %r in the cache' % key)
 
     def delete(self, key):
-        del self._data[key]
+        with self._connection() as connection:
+            cursor = connection.execute(
+                'DELETE FROM cache WHERE key = ?', (key,))
+            if not cursor.rowcount:
+                raise KeyError(key)
 
     def get(self, key):
-        (val, exptime) = self._data[key]
-        if exptime and time.time() > exptime:
-            del self._data[key]
+        row = self._connection().execute(
+            'SELECT value, expires FROM cache WHERE key = ?',
+            (key,)).fetchone()
+        if row is None or (row[1] and time.time() > row[1]):
             raise KeyError(key)
-        else:
-            return val
+        return pickle.loads(bytes(row[0]))
+
+    def getMulti(self, keys):
+        values = {}
+        now = time.time()
+        keys = list(keys)
+        # stay below SQLite's limit on the number of parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self._connection().execute(
+                'SELECT key, value, expires FROM cache WHERE key IN (%s)'
+                % ', '.join('?' * len(chunk)), chunk)
+            for key, value, expires in rows:
+                if not (expires and now > expires):
+                    values[key] = pickle.loads(bytes(value))
+        return values
 
     def clear(self):
-        self._data.clear()
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache')
+
+    def _deleteExpired(self, connection, key):
+        connection.execute(
+            'DELETE FROM cache WHERE key = ? AND expires AND expires < ?',
+            (key, time.time()))
+
+    def _maybeSweep(self):
+        now = time.time()
+        if now >= self._nextSweep:
+            self._nextSweep = now + self.sweepInterval
+            self.sweep()
+
+    def sweep(self):
+        """Drop the expired entries; return their number."""
+        with self._connection() as connection:
+            return connection.execute(
+                'DELETE FROM cache WHERE expires AND expires < ?',
+                (time.time(),)).rowcount
 
 
 class MemcachedCacheStore(AbstractCacheStore):
-    servers = ('127.0.0.1:11211')
+    """Store the data in memcached servers.
+
+    memcache.Client keeps its connections per thread, so one client can be
+    shared by all the threads using the store.
+    """
+    servers = ['127.0.0.1:11211']
 
     def __init__(self, servers=None, debug=False):
         if servers is None:
             servers = self.servers
+        self._servers = servers
+        self._debug = debug
+        self._client = self._newClient()
+
+    def _newClient(self):
         from memcache import Client as MemcachedClient
-        self._client = MemcachedClient(servers, debug)
+        return MemcachedClient(self._servers, self._debug)
 
     def set(self, key, val, time=0):
         self._client.set(key, val, time)
@@ -87,13 +368,11 @@ class MemcachedCacheStore(AbstractCacheStore):
         res = self._client.add(key, val, time)
         if not res:
             raise Error('a value for key %r is already in the cache' % key)
-        self._data[key] = (val, time)
 
     def replace(self, key, val, time=0):
         res = self._client.replace(key, val, time)
         if not res:
-            raise Error('a value for key %r is already in the cache' % key)
-        self._data[key] = (val, time)
+            raise Error('no value for key %r in the cache' % key)
 
     def delete(self, key):
         res = self._client.delete(key, time=0)
@@ -107,5 +386,8 @@ class MemcachedCacheStore(AbstractCacheStore):
         else:
             return val
 
+    def getMulti(self, keys):
+        return self._client.get_multi(list(keys))
+
     def clear(self):
         self._client.flush_all()
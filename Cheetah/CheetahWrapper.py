@@ -16,6 +16,7 @@ from optparse import OptionParser
 
 from .Compiler import DEFAULT_COMPILER_SETTINGS
 from .Template import Template
+from .TemplateBundle import writeBundle
 from .Utils.Misc import mkdirsWithPyInitFiles
 from .Version import Version
 from .compat import PY2
@@ -201,6 +202,10 @@ class CheetahWrapper(object):
             help='Specify the shbang to place at the top '
                  'of compiled templates, '
                  'e.g. --shbang="#!/usr/bin/env python"')
+        pao('--bundle', dest='bundle', default=None,
+            help='compile: write the compiled code of all templates '
+                 'to one bundle FILE (see Cheetah.TemplateBundle) '
+                 'instead of .py files')
         pao('--encoding', dest='encoding', default=None,
             help='Specify the encoding of source files '
                  '(e.g. "utf-8" to force input files to be interpreted '
@@ -374,6 +379,9 @@ you do have write permission to and re-run the tests.""")
         D("All bundles: %s", pprint.pformat(bundles))
         if self.opts.flat:
             self._checkForCollisions(bundles)
+        if self.isCompile and self.opts.bundle:
+            self._compileToBundleFile(bundles)
+            return
 
         # In parallel mode a new process is forked for each template
         # compilation, out of a pool of size self.opts.parallel. This is not
@@ -599,6 +607,37 @@ you do have write permission to and re-run the tests.""")
                                        compilerSettings=compilerSettings))
         sys.stdout.write(output)
 
+    def _compileToBundleFile(self, bundles):
+        """Compile all templates into one bundle file; the module names are
+           the paths relative to --idir.
+        """
+        C = self.chatter
+        TemplateClass = self._getTemplateClass()
+        compilerSettings = self._getCompilerSettings()
+        modules = []
+        for b in bundles:
+            base = b.base
+            if os.altsep:
+                base = base.replace(os.altsep, os.sep)
+            nameParts = base.split(os.sep)
+            for part in nameParts:
+                if not moduleNameRE.match(part):
+                    tup = b.src, part
+                    raise Error("""\
+%s: %s contains invalid characters.  Templates and directories in a bundle
+must be named according to the same rules as Python modules.""" % tup)
+            moduleName = '.'.join(nameParts)
+            C("Compiling %s -> %s:%s", b.src, self.opts.bundle, moduleName)
+            pysrc = TemplateClass.compile(file=b.src, returnAClass=False,
+                                          moduleName=b.basename,
+                                          className=b.basename,
+                                          commandlineopts=self.opts,
+                                          compilerSettings=compilerSettings)
+            filename = os.path.join(self.opts.bundle, base + '.py')
+            code = compile(pysrc, filename, 'exec')
+            modules.append((moduleName, b.basename, code))
+        writeBundle(self.opts.bundle, modules)
+
     def _compileOrFillBundle(self, b):
         C = self.chatter
         TemplateClass = self._getTemplateClass()
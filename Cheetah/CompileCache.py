@@ -0,0 +1,359 @@
+'''
+Caches for the code and classes generated by Template.compile().
+
+CompileCache is an in-memory mapping used as Template._CHEETAH_compileCache.
+It can be bounded by the number of entries, the total size of the generated
+code and the time an entry has not been used, and it counts hits, misses
+and evictions.
+
+PersistentCompileCache is an on-disk cache for the generated code.
+
+The in-memory compilation cache of Template.compile() is keyed on Python's
+builtin hash() which is not stable between process restarts, so every new
+process has to parse and generate the code for every dynamically compiled
+template again.  A PersistentCompileCache stores the generated module code
+together with the marshalled code object in a directory, keyed on a SHA-1
+digest of everything the generated code depends on:
+
+  - the template source (or the file path, contents and mtime),
+  - the compiler class and compiler settings,
+  - module, class, main method and baseclass names,
+  - Cheetah version and the Python implementation/version.
+
+If any of these contain a value that doesn't have a stable representation
+(e.g. a callable in the compiler settings), no key is generated
+and the template is compiled as usual.
+'''
+
+from collections import OrderedDict
+import hashlib
+import marshal
+import os
+import platform
+import sys
+import tempfile
+import time
+
+try:
+    from threading import RLock
+except ImportError:
+    class RLock:
+        def __enter__(self):
+            pass
+
+        def __exit__(self, *args):
+            pass
+
+from .Version import Version
+from .compat import unicode
+
+
+class Error(Exception):
+    pass
+
+
+_stableScalarTypes = (type(None), bool, int, float, str, unicode, bytes)
+
+
+def _stableRepr(value):
+    """Return a repr() of value that is the same in all processes
+    or None if value doesn't have one.
+    """
+    if isinstance(value, _stableScalarTypes):
+        return repr(value)
+    elif isinstance(value, (list, tuple)):
+        reprs = [_stableRepr(v) for v in value]
+        if None in reprs:
+            return None
+        return '[%s]' % ', '.join(reprs)
+    elif isinstance(value, dict):
+        reprs = []
+        for k in sorted(value.keys(), key=repr):
+            kRepr, vRepr = _stableRepr(k), _stableRepr(value[k])
+            if kRepr is None or vRepr is None:
+                return None
+            reprs.append('%s: %s' % (kRepr, vRepr))
+        return '{%s}' % ', '.join(reprs)
+    elif isinstance(value, type):
+        return '<class %s.%s>' % (value.__module__, value.__name__)
+    return None
+
+
+def _pythonTag():
+    # marshal format and bytecode are specific to the Python version
+    return '%s-%s-%s' % (platform.python_implementation(),
+                         '.'.join([str(v) for v in sys.version_info[:3]]),
+                         marshal.version)
+
+
+class CompileCache(object):
+    '''
+    A mapping of cache hashes to CompileCacheItem instances with optional
+    eviction.  Without limits it behaves like the plain dict Cheetah used
+    before.
+
+      - maxEntries: the maximum number of entries; the least recently used
+        entries are evicted first.
+      - maxCodeSize: the maximum total length of the generated code
+        (item.code) of all entries.
+      - maxIdleTime: entries that haven't been used for more than this
+        number of seconds (see item.lastCheckoutTime) are evicted.
+
+    When an item is evicted the module Template.compile() created for it is
+    removed from sys.modules so the class and the code can be garbage
+    collected once nothing else references them.
+
+    Subclasses can implement a different policy by overriding
+    _selectVictims().
+    '''
+
+    def __init__(self, maxEntries=None, maxCodeSize=None, maxIdleTime=None):
+        self.maxEntries = maxEntries
+        self.maxCodeSize = maxCodeSize
+        self.maxIdleTime = maxIdleTime
+        self._items = OrderedDict()  # least recently used first
+        self._codeSize = 0
+        self._lock = RLock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(list(self._items.keys()))
+
+    def keys(self):
+        return list(self._items.keys())
+
+    def values(self):
+        return list(self._items.values())
+
+    def items(self):
+        return list(self._items.items())
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return False
+            if self._isIdle(item, time.time()):
+                self._evict(key)
+                return False
+            return True
+
+    def __getitem__(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            now = time.time()
+            if item is None or self._isIdle(item, now):
+                if item is not None:
+                    self._evict(key)
+                self.misses += 1
+                raise KeyError(key)
+            # move to the most recently used end
+            del self._items[key]
+            self._items[key] = item
+            item.lastCheckoutTime = now
+            self.hits += 1
+            return item
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, item):
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            if getattr(item, 'lastCheckoutTime', None) is None:
+                item.lastCheckoutTime = time.time()
+            self._items[key] = item
+            self._codeSize += self._itemSize(item)
+            for victim in self._selectVictims():
+                self._evict(victim)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self._items:
+                raise KeyError(key)
+            self._evict(key, count=False)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._items.keys()):
+                self._evict(key, count=False)
+
+    def stats(self):
+        """Return a dict with the counters and the current size."""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._items),
+                    'codeSize': self._codeSize,
+                    }
+
+    def _itemSize(self, item):
+        return len(getattr(item, 'code', None) or '')
+
+    def _isIdle(self, item, now):
+        return bool(self.maxIdleTime) and \
+            now - item.lastCheckoutTime > self.maxIdleTime
+
+    def _selectVictims(self):
+        """Return the keys to evict after an insertion."""
+        victims = []
+        now = time.time()
+        if self.maxIdleTime:
+            victims = [key for key, item in self._items.items()
+                       if self._isIdle(item, now)]
+        numEntries = len(self._items) - len(victims)
+        codeSize = self._codeSize - sum(
+            [self._itemSize(self._items[key]) for key in victims])
+        newest = next(reversed(self._items))
+        for key, item in self._items.items():
+            if key == newest:  # never evict the item just added
+                break
+            if key in victims:
+                continue
+            if (self.maxEntries is not None
+                    and numEntries > self.maxEntries) \
+                    or (self.maxCodeSize is not None
+                        and codeSize > self.maxCodeSize):
+                victims.append(key)
+                numEntries -= 1
+                codeSize -= self._itemSize(item)
+            else:
+                break
+        return victims
+
+    def _remove(self, key):
+        item = self._items.pop(key)
+        self._codeSize -= self._itemSize(item)
+        return item
+
+    def _evict(self, key, count=True):
+        item = self._remove(key)
+        if count:
+            self.evictions += 1
+        klass = getattr(item, 'klass', None)
+        if klass is not None:
+            klass._CHEETAH_isInCompilationCache = False
+            moduleName = getattr(item, 'moduleName', None)
+            module = sys.modules.get(moduleName)
+            if module is not None \
+                    and getattr(module, klass.__name__, None) is klass:
+                # Python 2 sets the globals of a freed module to None;
+                # the class keeps its module alive while it's in use
+                klass._CHEETAH_module = module
+                del sys.modules[moduleName]
+
+
+def replaceCodeFilename(codeObject, filename):
+    """Return a copy of codeObject (and all nested code objects)
+    with co_filename set to filename, or None if this Python
+    can't do that (code.replace() is available since Python 3.8).
+    """
+    if codeObject.co_filename == filename:
+        return codeObject
+    if not hasattr(codeObject, 'replace'):
+        return None
+    consts = tuple([
+        replaceCodeFilename(const, filename)
+        if isinstance(const, type(codeObject)) else const
+        for const in codeObject.co_consts])
+    return codeObject.replace(co_filename=filename, co_consts=consts)
+
+
+class PersistentCompileCache(object):
+    '''
+    Stores generated module code and code objects in `cacheDir`.
+
+    Each entry is a single file named `<key>.cheetahc`.  Entries are written
+    to a temporary file first and then renamed, so concurrent processes
+    never see a partially written entry.  Corrupt or unreadable entries are
+    treated as cache misses.
+    '''
+    fileExtension = '.cheetahc'
+
+    def __init__(self, cacheDir):
+        self._cacheDir = cacheDir
+
+    def cacheDir(self):
+        return self._cacheDir
+
+    def genKey(self, source=None, file=None, **parts):
+        """Return a hex digest for the template source or file and the
+        keyword arguments or None if some of them don't have a stable
+        representation.
+        """
+        if file:
+            # The path and mtime are embedded into the generated code
+            with open(file, 'rb') as f:
+                parts['__fileDigest'] = hashlib.sha1(f.read()).hexdigest()
+            parts['__file'] = file
+            parts['__fileMtime'] = os.path.getmtime(file)
+        else:
+            parts['__source'] = source
+        parts['__cheetahVersion'] = Version
+        parts['__python'] = _pythonTag()
+        partsRepr = _stableRepr(parts)
+        if partsRepr is None:
+            return None
+        return hashlib.sha1(partsRepr.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._cacheDir, key + self.fileExtension)
+
+    def load(self, key):
+        """Return the tuple (generatedModuleCode, outputEncoding, codeObject)
+        stored for the key or None.  codeObject can be None if it wasn't
+        stored.
+        """
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            entry = marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(entry, tuple) or len(entry) != 3:
+            return None
+        return entry
+
+    def store(self, key, generatedModuleCode, outputEncoding,
+              codeObject=None):
+        if not os.path.isdir(self._cacheDir):
+            raise Error('%s does not exist' % self._cacheDir)
+        data = marshal.dumps((generatedModuleCode, outputEncoding,
+                              codeObject))
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=self._cacheDir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            path = self._path(key)
+            try:
+                os.rename(tmpPath, path)
+            except OSError:  # Windows can't rename over an existing file
+                if not os.path.exists(path):
+                    raise
+                os.remove(tmpPath)
+        except Exception:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for filename in os.listdir(self._cacheDir):
+            if filename.endswith(self.fileExtension):
+                os.remove(os.path.join(self._cacheDir, filename))
@@ -18,13 +18,15 @@ import random
 import warnings
 import copy
 import codecs
+import hashlib
 
 from .Version import Version, VersionTuple
 from .SettingsManager import SettingsManager
 from .Utils.Indenter import indentize  # an undocumented preprocessor
 from . import NameMapper
+from .ParseTree import PassManager, TreeBuilder
 from .Parser import Parser, ParseError, specialVarRE, \
-    STATIC_CACHE, REFRESH_CACHE, SET_GLOBAL, SET_MODULE, \
+    STATIC_CACHE, REFRESH_CACHE, SET_LOCAL, SET_GLOBAL, SET_MODULE, \
     unicodeDirectiveRE, encodingDirectiveRE, escapedNewlineRE
 from .compat import PY2, string_type, unicode
 
@@ -55,6 +57,26 @@ _DEFAULT_COMPILER_SETTINGS = [
     ('useStackFrames', True,
      'Used for NameMapper.valueFromFrameOrSearchList '
      'rather than NameMapper.valueFromSearchList'),
+    ('hoistSearchList', False,
+     "With useStackFrames=False, build the list "
+     "[locals()] + searchList + [globals(), builtin] once and rebuild it "
+     "only where local variables or the searchList could have changed "
+     "(after #set, loop targets and explicit calls) "
+     "instead of building it for every $placeholder. "
+     "Changes to the searchList made by autocalled methods or filters "
+     "are seen only after the next rebuild"),
+    ('useDirectLocalNames', False,
+     "Access $placeholders whose first name is a #for target, "
+     "a #set local or a #def argument as plain Python local variables "
+     "instead of looking them up with NameMapper. "
+     "The local variable itself is not autocalled, "
+     "like with useSearchList=False"),
+    ('coalesceWrites', False,
+     "Output runs of static text and $placeholders with one "
+     "write(''.join((...))) call instead of a write() call for each. "
+     "Output written before an exception in the same run of writes "
+     "is lost. Don't use it if methods called from $placeholders "
+     "write to the transaction implicitly (Webware servlets)"),
     ('useErrorCatcher', False,
      'Turn on the #errorCatcher directive '
      'for catching NameMapper errors, etc'),
@@ -74,6 +96,13 @@ _DEFAULT_COMPILER_SETTINGS = [
 
     ('commentOffset', 1, ''),
     ('outputRowColComments', True, ''),
+    ('production', False,
+     'Generate code for production: the lines and columns of placeholders '
+     'and directives go to the source map _CHEETAH_lineMap of the template '
+     'class (used by Cheetah.Template.formatException() and '
+     'rewriteProfileStats()) instead of comments in the generated code, '
+     'and filters are called without the rawExpr argument. '
+     "Don't use it with filters that need kw['rawExpr']"),
     ('includeBlockMarkers', False,
      'Wrap #block\'s in a comment in the template\'s output'),
     ('blockMarkerStart', ('\n<!-- START BLOCK: ', ' -->\n'), ''),
@@ -129,12 +158,57 @@ _DEFAULT_COMPILER_SETTINGS = [
     ('allowPlaceholderFilterArgs', True, ''),
     ('encoding', None,
      'The encoding to read input files as (or None for ASCII)'),
+    ('inlineIncludes', False,
+     'Compile the files of #include directives with a string literal '
+     'path into the including template instead of including them '
+     'at runtime'),
+    ('optimizationPasses', None,
+     'List of the passes (names in Cheetah.ParseTree.passes or callables) '
+     'to run on a parse tree of the source before generating code, '
+     'or None to generate code while parsing'),
 ]
 
 DEFAULT_COMPILER_SETTINGS = \
     dict([(v[0], v[1]) for v in _DEFAULT_COMPILER_SETTINGS])
 
 
+# Generated code for the searchList used with useStackFrames=False
+_unhoistedSearchList = 'VFSL([locals()]+SL+[globals(), builtin]'
+_hoistedSearchList = 'VFSL(_SL'
+_hoistSearchListStatement = '_SL = [locals()] + SL + [globals(), builtin]'
+# Calls locals() again after dropping _SL so that the frame's locals dict
+# doesn't keep the list that refers to the dict (a reference cycle
+# with Python < 3.13)
+_dropHoistedSearchListStatement = '_SL = None; locals()'
+# Chunks where _SL can't be rebuilt in a preceding statement
+# or where $placeholders could be evaluated in a nested scope
+_noHoistingStatementRE = re.compile(r'(?:elif|else|except|finally|while)\b')
+_nestedScopeRE = re.compile(r'\b(?:lambda|for|def|class)\b')
+
+# With the compiler setting production the positions in the source
+# (index in _CHEETAH_sourceFiles, line, col) are appended to the generated
+# lines as markers (NUL can't be in the generated code otherwise) and moved
+# to _CHEETAH_lineMap when the module is wrapped
+_lineColMarker = '\0%d,%d,%d\0'
+_lineColMarkerRE = re.compile('\0(\\d+),(\\d+),(\\d+)\0')
+_lineMapPlaceholder = '\0lineMap\0'
+_defRE = re.compile(r'\s*def\s+\w+\s*\(')
+
+_identifierRE = re.compile(r'[a-zA-Z_][a-zA-Z_0-9]*')
+_forTargetRE = re.compile(r'for\s+(.+?)\s+in\b')
+_targetRE = re.compile(r'^[\s,()a-zA-Z_0-9]+$')
+
+
+def _targetNames(target):
+    """Return the names bound by an assignment or for target like 'a'
+    or 'a, (b, c)'.  Targets with attributes, items or slices
+    don't bind any local names.
+    """
+    if not _targetRE.match(target):
+        return []
+    return _identifierRE.findall(target)
+
+
 class GenUtils(object):
     """
     An abstract baseclass for the Compiler classes that provides methods that
@@ -180,6 +254,8 @@ class GenUtils(object):
             if key == 'timer':
                 key = 'interval'
                 val = self.genTimeInterval(val)
+            elif key == 'stale':
+                val = self.genTimeInterval(val)
 
             cacheInfo[key] = val
         return cacheInfo
@@ -283,6 +359,19 @@ class GenUtils(object):
 
         This option allows Cheetah to be used with Psyco, which doesn't support
         stack frame introspection.
+
+        If the compiler setting hoistSearchList=True the list is built in
+        a separate statement and reused::
+
+          _SL = [locals()] + SL + [globals(), builtin]
+          A` = VFSL(_SL, name=A[0], executeCallables=(useAC and A[1]))A[2]
+
+        If the compiler setting useDirectLocalNames=True and 'a' is known to
+        be a local variable at this point of the method (see
+        MethodCompiler.isLocalName()) NameMapper is only used for the rest
+        of the name::
+
+          A` = VFN(a, name='b.c', executeCallables=(useAC and A[1]))A[2]
         """
         defaultUseAC = self.setting('useAutocalling')
         useSearchList = self.setting('useSearchList')
@@ -290,6 +379,10 @@ class GenUtils(object):
         nameChunks.reverse()
         name, useAC, remainder = nameChunks.pop()
 
+        if useSearchList and self.setting('useDirectLocalNames') \
+                and self.isLocalName(name.split('.')[0]):
+            useSearchList = False
+
         if not useSearchList:
             firstDotIdx = name.find('.')
             if firstDotIdx != -1 and firstDotIdx < len(name):
@@ -306,8 +399,14 @@ class GenUtils(object):
                           '"' + name + '",'
                           + repr(defaultUseAC and useAC) + ')'
                           + remainder)
+        elif self.setting('hoistSearchList'):
+            # See MethodCompiler._hoistSearchList()
+            pythonCode = (_hoistedSearchList + ','
+                          '"' + name + '",'
+                          + repr(defaultUseAC and useAC) + ')'
+                          + remainder)
         else:
-            pythonCode = ('VFSL([locals()]+SL+[globals(), builtin],'
+            pythonCode = (_unhoistedSearchList + ','
                           '"' + name + '",'
                           + repr(defaultUseAC and useAC) + ')'
                           + remainder)
@@ -343,6 +442,9 @@ class MethodCompiler(GenUtils):
         self._indent = self.setting('indentationStep')
         self._indentLev = self.setting('initialMethIndentLevel')
         self._pendingStrConstChunks = []
+        # (expression, changesLocals) pairs to output with one write()
+        # call (see the compiler setting coalesceWrites)
+        self._pendingWrites = []
         self._methodSignature = None
         self._methodDef = None
         self._docStringLines = []
@@ -354,6 +456,12 @@ class MethodCompiler(GenUtils):
         self._filterRegionsStack = []
 
         self._isErrorCatcherOn = False
+        # Local variables that are bound at this point of the method body,
+        # mapped to the indentation level they were bound at
+        self._localNames = {}
+        # Whether _SL must be rebuilt before it's used (see hoistSearchList)
+        self._searchListIsStale = True
+        self._searchListIsHoisted = False
 
         self._hasReturnStatement = False
         self._isGenerator = False
@@ -375,13 +483,40 @@ class MethodCompiler(GenUtils):
         return self._indent * self._indentLev
 
     def indent(self):
+        self.commitWrites()
         self._indentLev += 1
+        self._searchListIsStale = True
 
     def dedent(self):
+        self.commitWrites()
+        self._searchListIsStale = True
         if self._indentLev:
             self._indentLev -= 1
         else:
             raise Error('Attempt to dedent when the indentLev is 0')
+        # Names bound in the block just closed may be unbound after it
+        for name, indentLev in list(self._localNames.items()):
+            if indentLev > self._indentLev:
+                del self._localNames[name]
+
+    # methods for tracking local variables
+
+    def isLocalName(self, name):
+        """Return True if name is certainly bound as a local variable at
+        the current position of the method body.
+        """
+        return name in self._localNames
+
+    def bindLocalNames(self, names, indentLev=None):
+        if indentLev is None:
+            indentLev = self._indentLev
+        for name in names:
+            self._localNames[name] = min(
+                self._localNames.get(name, indentLev), indentLev)
+
+    def unbindLocalNames(self, names):
+        for name in names:
+            self._localNames.pop(name, None)
 
     # methods for final code wrapping
 
@@ -429,43 +564,154 @@ class MethodCompiler(GenUtils):
     def addMethDocString(self, line):
         self._docStringLines.append(line.replace('%', '%%'))
 
-    def addChunk(self, chunk):
+    def addChunk(self, chunk, changesLocals=True):
+        """Add a line of code to the method body.
+
+        changesLocals=False marks chunks that can't bind local variables or
+        change the searchList, so a hoisted searchList (see the compiler
+        setting hoistSearchList) stays valid after them.
+        """
         self.commitStrConst()
+        self._addChunk(chunk, changesLocals)
+
+    def _addChunk(self, chunk, changesLocals=True):
+        if _hoistedSearchList in chunk:
+            chunk = self._hoistSearchList(chunk, changesLocals)
+        elif changesLocals:
+            self._searchListIsStale = True
         chunk = "\n" + self.indentation() + chunk
         self._methodBodyChunks.append(chunk)
 
+    def _hoistSearchList(self, chunk, changesLocals):
+        """Rebuild _SL before the chunk if it is stale.
+
+        Where a statement can't be put before the chunk (elif, while, ...) or
+        the placeholders could be evaluated in a nested scope the searchList
+        is built inline as without hoistSearchList.
+        """
+        nestedScopePos = 0
+        if chunk.startswith('for '):
+            nestedScopePos = 4
+        if _noHoistingStatementRE.match(chunk) \
+                or _nestedScopeRE.search(chunk, nestedScopePos):
+            if changesLocals:
+                self._searchListIsStale = True
+            return self._unhoistSearchList(chunk)
+        if self._searchListIsStale:
+            self._methodBodyChunks.append(
+                "\n" + self.indentation() + _hoistSearchListStatement)
+            self._searchListIsHoisted = True
+        self._searchListIsStale = changesLocals
+        return chunk
+
+    def _dropHoistedSearchList(self):
+        """Drop _SL where the method returns."""
+        if self._searchListIsHoisted:
+            self.addChunk(_dropHoistedSearchListStatement)
+
+    def _unhoistSearchList(self, code):
+        return code.replace(_hoistedSearchList + ',',
+                            _unhoistedSearchList + ',')
+
     def appendToPrevChunk(self, appendage):
         self._methodBodyChunks[-1] = self._methodBodyChunks[-1] + appendage
 
-    def addWriteChunk(self, chunk):
-        self.addChunk('write(' + chunk + ')')
+    def addWriteChunk(self, chunk, changesLocals=True):
+        if self._coalesceWrites():
+            self._addPendingWrite(chunk, changesLocals)
+        else:
+            self.addChunk('write(' + chunk + ')', changesLocals=changesLocals)
+
+    def _coalesceWrites(self):
+        return self.setting('coalesceWrites')
+
+    def hasPendingWrites(self):
+        return bool(self._pendingWrites)
+
+    def _addPendingWrite(self, chunk, changesLocals):
+        self._commitStrConstToPendingWrites()
+        if _hoistedSearchList in chunk and \
+                [1 for _chunk, _changesLocals in self._pendingWrites
+                 if _changesLocals]:
+            # the hoisted searchList must be rebuilt before the chunk
+            self.commitWrites()
+        self._pendingWrites.append((chunk, changesLocals))
+
+    def commitWrites(self):
+        """Add one write() call for the pending writes."""
+        if not self._pendingWrites:
+            return
+        pendingWrites = self._pendingWrites
+        self._pendingWrites = []
+        changesLocals = bool([1 for _chunk, _changesLocals in pendingWrites
+                              if _changesLocals])
+        if len(pendingWrites) == 1:
+            chunk = pendingWrites[0][0]
+        else:
+            chunk = "''.join((%s))" % ', '.join(
+                [_chunk for _chunk, _changesLocals in pendingWrites])
+        self.addChunk('write(' + chunk + ')', changesLocals=changesLocals)
 
     def addFilteredChunk(self, chunk, filterArgs=None,
                          rawExpr=None, lineCol=None):
         if filterArgs is None:
             filterArgs = ''
-        if self.setting('includeRawExprInFilterArgs') and rawExpr:
+        if self.setting('includeRawExprInFilterArgs') and rawExpr \
+                and not self.setting('production'):
             filterArgs += ', rawExpr=%s' % repr(rawExpr)
+        # Explicit calls like $webInput(['name']) can change the searchList;
+        # without rawExpr the chunk can be anything.
+        changesLocals = not rawExpr or '(' in rawExpr
+        if self._coalesceWrites() and (not rawExpr or 'trans' in rawExpr):
+            # The expression could write to the transaction itself
+            self.commitStrConst()
 
         if self.setting('alwaysFilterNone'):
-            if rawExpr and rawExpr.find('\n') == -1 and \
+            if self._coalesceWrites():
+                # Assign the value to its own variable now
+                # and filter it in the coalesced write
+                self._commitStrConstToPendingWrites()
+                varName = '_v%d' % len(self._pendingWrites)
+                addChunk = self._addChunk
+            else:
+                varName = '_v'
+                addChunk = self.addChunk
+            if self.setting('production'):
+                addChunk("%s = %s" % (varName, chunk),
+                         changesLocals=changesLocals)
+                if lineCol:
+                    self.appendToPrevChunk(self._lineColMarker(lineCol))
+            elif rawExpr and rawExpr.find('\n') == -1 and \
                     rawExpr.find('\r') == -1:
-                self.addChunk("_v = %s # %r" % (chunk, rawExpr))
+                addChunk("%s = %s # %r" % (varName, chunk, rawExpr),
+                         changesLocals=changesLocals)
                 if lineCol:
                     self.appendToPrevChunk(' on line %s, col %s' % lineCol)
             else:
-                self.addChunk("_v = %s" % chunk)
+                addChunk("%s = %s" % (varName, chunk),
+                         changesLocals=changesLocals)
 
-            if self.setting('useFilters'):
+            if self._coalesceWrites():
+                if self.setting('useFilters'):
+                    value = "_filter(%s%s)" % (varName, filterArgs)
+                else:
+                    value = "str(%s)" % varName
+                self._pendingWrites.append(
+                    ("%s if %s is not None else u''" % (value, varName),
+                     False))
+            elif self.setting('useFilters'):
                 self.addChunk("if _v is not None: write(_filter(_v%s))"
-                              % filterArgs)
+                              % filterArgs, changesLocals=changesLocals)
             else:
-                self.addChunk("if _v is not None: write(str(_v))")
+                self.addChunk("if _v is not None: write(str(_v))",
+                              changesLocals=False)
         else:
             if self.setting('useFilters'):
-                self.addChunk("write(_filter(%s%s))" % (chunk, filterArgs))
+                self.addWriteChunk("_filter(%s%s)" % (chunk, filterArgs),
+                                   changesLocals=changesLocals)
             else:
-                self.addChunk("write(str(%s))" % chunk)
+                self.addWriteChunk("str(%s)" % chunk,
+                                   changesLocals=changesLocals)
 
     def _appendToPrevStrConst(self, strConst):
         if self._pendingStrConstChunks:
@@ -478,13 +724,28 @@ class MethodCompiler(GenUtils):
         Add the code for outputting the pending strConst without chopping off
         any whitespace from it.
         """
-        if not self._pendingStrConstChunks:
+        if self._coalesceWrites():
+            self._commitStrConstToPendingWrites()
+            self.commitWrites()
             return
+        strConst = self._popStrConst()
+        if strConst:
+            self.addWriteChunk(strConst, changesLocals=False)
+
+    def _commitStrConstToPendingWrites(self):
+        strConst = self._popStrConst()
+        if strConst:
+            self._pendingWrites.append((strConst, False))
+
+    def _popStrConst(self):
+        """Return the pending strConst as a string literal."""
+        if not self._pendingStrConstChunks:
+            return None
 
         strConst = ''.join(self._pendingStrConstChunks)
         self._pendingStrConstChunks = []
         if not strConst:
-            return
+            return None
 
         reprstr = repr(strConst)
         i = 0
@@ -502,7 +763,7 @@ class MethodCompiler(GenUtils):
             out.append('"""')
             out.append(body)
             out.append('"""')
-        self.addWriteChunk(''.join(out))
+        return ''.join(out)
 
     def handleWSBeforeDirective(self):
         """Truncate the pending strCont to the beginning of the current line.
@@ -558,18 +819,26 @@ class MethodCompiler(GenUtils):
             self.addFilteredChunk(expr, filterArgs, rawPlaceholder,
                                   lineCol=lineCol)
 
-        if self.setting('outputRowColComments'):
+        # A pending write is not the previous chunk
+        if self.hasPendingWrites():
+            pass
+        elif self.setting('production'):
+            self.appendToPrevChunk(self._lineColMarker(lineCol))
+        elif self.setting('outputRowColComments'):
             self.appendToPrevChunk(' # from line %s, col %s' % lineCol + '.')
         if cacheInfo:
             self.endCacheRegion()
 
-    def addSilent(self, expr):
+    def addSilent(self, expr, lineCol=None):
         self.addChunk(expr)
+        self._appendLineColMarker(lineCol)
 
-    def addEcho(self, expr, rawExpr=None):
-        self.addFilteredChunk(expr, rawExpr=rawExpr)
+    def addEcho(self, expr, rawExpr=None, lineCol=None):
+        self.addFilteredChunk(expr, rawExpr=rawExpr, lineCol=lineCol)
+        if not self.hasPendingWrites():
+            self._appendLineColMarker(lineCol)
 
-    def addSet(self, expr, exprComponents, setStyle):
+    def addSet(self, expr, exprComponents, setStyle, lineCol=None):
         if setStyle is SET_GLOBAL:
             (LVALUE, OP, RVALUE) = (exprComponents.LVALUE,
                                     exprComponents.OP,
@@ -598,6 +867,10 @@ class MethodCompiler(GenUtils):
             self._moduleCompiler.addModuleGlobal(expr)
         else:
             self.addChunk(expr)
+            self._appendLineColMarker(lineCol)
+            if setStyle is SET_LOCAL:
+                self.bindLocalNames(
+                    _targetNames(exprComponents.LVALUE.strip()))
 
     def addInclude(self, sourceExpr, includeFrom, isRaw):
         self.addChunk('self._handleCheetahInclude(' + sourceExpr
@@ -610,6 +883,9 @@ class MethodCompiler(GenUtils):
 
     def addFor(self, expr, lineCol=None):
         self.addIndentingDirective(expr, lineCol=lineCol)
+        match = _forTargetRE.match(expr)
+        if match:
+            self.bindLocalNames(_targetNames(match.group(1)))
 
     def addRepeat(self, expr, lineCol=None):
         # the _repeatCount stuff here allows nesting of #repeat directives
@@ -618,13 +894,30 @@ class MethodCompiler(GenUtils):
                     % (self._repeatCount, expr),
                     lineCol=lineCol)
 
+    def _lineColMarker(self, lineCol):
+        return _lineColMarker % (
+            (self._moduleCompiler.sourceFileIndex(),) + tuple(lineCol))
+
+    def _appendLineColMarker(self, lineCol):
+        """Map the previous chunk to the position lineCol in the source
+        (see the compiler setting production)."""
+        if lineCol and self.setting('production'):
+            self.appendToPrevChunk(self._lineColMarker(lineCol))
+
+    def _appendGeneratedFrom(self, lineCol):
+        if not lineCol:
+            return
+        if self.setting('production'):
+            self.appendToPrevChunk(self._lineColMarker(lineCol))
+        else:
+            self.appendToPrevChunk(' # generated from line %s, col %s'
+                                   % lineCol)
+
     def addIndentingDirective(self, expr, lineCol=None):
         if expr and not expr[-1] == ':':
             expr = expr + ':'
         self.addChunk(expr)
-        if lineCol:
-            self.appendToPrevChunk(' # generated from line %s, col %s'
-                                   % lineCol)
+        self._appendGeneratedFrom(lineCol)
         self.indent()
 
     def addReIndentingDirective(self, expr, dedent=True, lineCol=None):
@@ -635,9 +928,7 @@ class MethodCompiler(GenUtils):
             expr = expr + ':'
 
         self.addChunk(expr)
-        if lineCol:
-            self.appendToPrevChunk(' # generated from line %s, col %s'
-                                   % lineCol)
+        self._appendGeneratedFrom(lineCol)
         self.indent()
 
     def addIf(self, expr, lineCol=None):
@@ -692,16 +983,26 @@ class MethodCompiler(GenUtils):
     def addFinally(self, expr, dedent=True, lineCol=None):
         self.addReIndentingDirective(expr, dedent=dedent, lineCol=lineCol)
 
-    def addReturn(self, expr):
+    def addReturn(self, expr, lineCol=None):
         assert not self._isGenerator
-        self.addChunk(expr)
+        if self._searchListIsHoisted:
+            value = expr[len('return'):].strip()
+            if value:
+                self.addChunk('_v = ' + value)
+                self._appendLineColMarker(lineCol)
+            self._dropHoistedSearchList()
+            self.addChunk(value and 'return _v' or expr)
+        else:
+            self.addChunk(expr)
+            self._appendLineColMarker(lineCol)
         self._hasReturnStatement = True
 
-    def addYield(self, expr):
+    def addYield(self, expr, lineCol=None):
         assert not self._hasReturnStatement
         self._isGenerator = True
         if expr.replace('yield', '').strip():
             self.addChunk(expr)
+            self._appendLineColMarker(lineCol)
         else:
             self.addChunk('if _dummyTrans:')
             self.indent()
@@ -715,22 +1016,26 @@ class MethodCompiler(GenUtils):
                           '"This method cannot be called with a trans arg")')
             self.dedent()
 
-    def addPass(self, expr):
+    def addPass(self, expr, lineCol=None):
         self.addChunk(expr)
 
-    def addDel(self, expr):
+    def addDel(self, expr, lineCol=None):
         self.addChunk(expr)
+        self._appendLineColMarker(lineCol)
+        self.unbindLocalNames(_identifierRE.findall(expr[len('del'):]))
 
-    def addAssert(self, expr):
+    def addAssert(self, expr, lineCol=None):
         self.addChunk(expr)
+        self._appendLineColMarker(lineCol)
 
-    def addRaise(self, expr):
+    def addRaise(self, expr, lineCol=None):
         self.addChunk(expr)
+        self._appendLineColMarker(lineCol)
 
-    def addBreak(self, expr):
+    def addBreak(self, expr, lineCol=None):
         self.addChunk(expr)
 
-    def addContinue(self, expr):
+    def addContinue(self, expr, lineCol=None):
         self.addChunk(expr)
 
     def addPSP(self, PSP):
@@ -761,18 +1066,37 @@ class MethodCompiler(GenUtils):
         return ('_' + str(random.randrange(100, 999))
                 + str(random.randrange(10000, 99999)))
 
+    def nextCacheRegionID(self, lineCol):
+        """Derive the ID from the template source and the position of the
+        region so that it is the same every time the template is compiled
+        (cache regions can be shared by processes, see
+        Template._CHEETAH_shareCacheRegions).
+        """
+        return '_%s_%s_%s' % (
+            (self._moduleCompiler.currentSourceDigest()[:8],)
+            + tuple(lineCol))
+
     def startCacheRegion(self, cacheInfo, lineCol, rawPlaceholder=None):
 
         # @@TR: we should add some runtime logging to this
 
-        ID = self.nextCacheID()
+        ID = self.nextCacheRegionID(lineCol)
         interval = cacheInfo.get('interval', None)
         test = cacheInfo.get('test', None)
         customID = cacheInfo.get('id', None)
         if customID:
             ID = customID
         varyBy = cacheInfo.get('varyBy', repr(ID))
-        self._cacheRegionsStack.append(ID)  # attrib of current methodCompiler
+        stale = cacheInfo.get('stale', None)
+        # only one thread at a time renders the region
+        singleFlight = bool(stale) or str(cacheInfo.get('lock', False)) \
+            not in ('False', '0', 'None', '')
+        # attrib of current methodCompiler
+        self._cacheRegionsStack.append((ID, singleFlight))
+        if 'varyBy' not in cacheInfo:
+            self._classCompiler.addCacheRegionID(ID)
+        self._classCompiler.setSourceDigest(
+            self._moduleCompiler.sourceDigest())
 
         # @@TR: add this to a special class var as well
         self.addChunk('')
@@ -806,6 +1130,18 @@ class MethodCompiler(GenUtils):
             self.addChunk('_RECACHE_%(ID)s = True' % locals())
             self.dedent()
 
+        if singleFlight:
+            self.addChunk('_REFRESHING_%(ID)s = False' % locals())
+            self.addChunk(
+                'if _RECACHE_%(ID)s or not _cacheItem_%(ID)s.getRefreshTime():'
+                % locals())
+            self.indent()
+            self.addChunk(
+                '_RECACHE_%(ID)s = _REFRESHING_%(ID)s = '
+                '_cacheItem_%(ID)s.startRefresh(serveStale=%(stale)r)'
+                % {'ID': ID, 'stale': bool(stale)})
+            self.dedent()
+
         self.addChunk(
             'if (not _RECACHE_%(ID)s) and _cacheItem_%(ID)s.getRefreshTime():'
             % locals())
@@ -839,15 +1175,31 @@ class MethodCompiler(GenUtils):
             self.addChunk(("_cacheItem_%(ID)s.setExpiryTime(currentTime() +"
                           % locals())
                           + str(interval) + ")")
+            if stale:
+                self.addChunk(
+                    "_cacheItem_%(ID)s.setHardExpiryTime(currentTime() + "
+                    % locals() + str(interval) + " + " + str(stale) + ")")
+        if singleFlight:
+            self.addChunk('try:')
+            self.indent()
 
     def endCacheRegion(self):
-        ID = self._cacheRegionsStack.pop()
+        ID, singleFlight = self._cacheRegionsStack.pop()
         self.addChunk('trans = _orig_trans%(ID)s' % locals())
         self.addChunk('write = trans.response().write')
         self.addChunk(
             '_cacheData = _cacheCollector_%(ID)s.response().getvalue()'
             % locals())
         self.addChunk('_cacheItem_%(ID)s.setData(_cacheData)' % locals())
+        if singleFlight:
+            self.dedent()
+            self.addChunk('finally:')
+            self.indent()
+            self.addChunk('if _REFRESHING_%(ID)s:' % locals())
+            self.indent()
+            self.addChunk('_cacheItem_%(ID)s.endRefresh()' % locals())
+            self.dedent()
+            self.dedent()
         self.addWriteChunk('_cacheData')
         self.addChunk('del _cacheData')
         self.addChunk('del _cacheCollector_%(ID)s' % locals())
@@ -929,7 +1281,9 @@ class MethodCompiler(GenUtils):
                 initialKwArgs = ', ' + initialKwArgs
             self.addFilteredChunk(
                 '%(functionName)s(_callArgVal%(ID)s%(initialKwArgs)s)'
-                % locals())
+                % locals(), lineCol=lineCol)
+            if not self.hasPendingWrites():
+                self._appendLineColMarker(lineCol)
             self.addChunk('del _callArgVal%(ID)s' % locals())
         else:
             if initialKwArgs:
@@ -938,7 +1292,9 @@ class MethodCompiler(GenUtils):
             reset()
             self.addFilteredChunk(
                 '%(functionName)s(%(initialKwArgs)s**_callKws%(ID)s)'
-                % locals())
+                % locals(), lineCol=lineCol)
+            if not self.hasPendingWrites():
+                self._appendLineColMarker(lineCol)
             self.addChunk('del _callKws%(ID)s' % locals())
         self.addChunk('## END %(regionTitle)s REGION: ' % locals() + ID
                       + ' of ' + functionName
@@ -1025,8 +1381,8 @@ class MethodCompiler(GenUtils):
         self.addChunk('_orig_filter%(ID)s = _filter' % locals())
         if isKlass:
             self.addChunk(
-                '_filter = self._CHEETAH__currentFilter = '
-                + theFilter.strip() + '(self).filter')
+                '_filter = self._setCurrentFilter('
+                + theFilter.strip() + '(self).filter)')
         else:
             if theFilter.lower() == 'none':
                 self.addChunk('_filter = self._CHEETAH__initialFilter')
@@ -1037,16 +1393,18 @@ class MethodCompiler(GenUtils):
                     'if "' + theFilter + '" in self._CHEETAH__filters:')
                 self.indent()
                 self.addChunk(
-                    '_filter = self._CHEETAH__currentFilter = '
-                    'self._CHEETAH__filters[filterName]')
+                    '_filter = self._setCurrentFilter('
+                    'self._CHEETAH__filters[filterName])')
                 self.dedent()
                 self.addChunk('else:')
                 self.indent()
                 self.addChunk(
-                    '_filter = self._CHEETAH__currentFilter'
-                    + ' = \\\n\t\t\tself._CHEETAH__filters[filterName] = '
-                    + 'getattr(self._CHEETAH__filtersLib, filterName)'
-                    + '(self).filter')
+                    'self._CHEETAH__filters[filterName] = '
+                    'getattr(self._CHEETAH__filtersLib, filterName)'
+                    '(self).filter')
+                self.addChunk(
+                    '_filter = self._setCurrentFilter('
+                    'self._CHEETAH__filters[filterName])')
                 self.dedent()
 
     def closeFilterBlock(self):
@@ -1054,7 +1412,7 @@ class MethodCompiler(GenUtils):
         # self.addChunk('_filter = self._CHEETAH__initialFilter')
         # self.addChunk('_filter = _orig_filter%(ID)s'%locals())
         self.addChunk(
-            '_filter = self._CHEETAH__currentFilter = _orig_filter%(ID)s'
+            '_filter = self._setCurrentFilter(_orig_filter%(ID)s)'
             % locals())
 
 
@@ -1176,14 +1534,19 @@ class AutoMethodCompiler(MethodCompiler):
 
         if not self._isGenerator:
             self.addStop()
+        else:
+            self._dropHoistedSearchList()
         self.addChunk('')
 
-    def addStop(self, expr=None):
+    def addStop(self, expr=None, lineCol=None):
+        self._dropHoistedSearchList()
         self.addChunk(
             'return _dummyTrans and trans.response().getvalue() or ""')
 
     def addMethArg(self, name, defVal=None):
         self._argStringList.append((name, defVal))
+        self.bindLocalNames([name.strip().lstrip('*')],
+                            self.setting('initialMethIndentLevel'))
 
     def methodSignature(self):
         argStringChunks = []
@@ -1297,6 +1660,10 @@ class ClassCompiler(GenUtils):
                 '__metaclass__ = ' + self.setting('templateMetaclass'))
         self._initMethChunks = []
         self._blockMetaData = {}
+        # cache regions with a single cache item (no varyBy)
+        self._cacheRegionIDs = []
+        self._sourceDigest = None
+        self._includedFiles = []
         self._errorCatcherCount = 0
         self._placeholderToErrorCatcherMap = {}
 
@@ -1473,6 +1840,10 @@ class ClassCompiler(GenUtils):
 
         self._errorCatcherCount += 1
         methodName = '__errorCatcher' + str(self._errorCatcherCount)
+        # The code is eval()'ed with the caller's locals which may not
+        # contain an up to date _SL
+        codeChunk = codeChunk.replace(_hoistedSearchList + ',',
+                                      _unhoistedSearchList + ',')
         self._placeholderToErrorCatcherMap[rawCode] = methodName
 
         catcherMeth = self._spawnMethodCompiler(
@@ -1590,13 +1961,35 @@ class ClassCompiler(GenUtils):
             methGen.methodDef() for methGen in self._finishedMethods()]
         return '\n\n'.join(methodDefs)
 
+    def addCacheRegionID(self, regionID):
+        self._cacheRegionIDs.append(regionID)
+
+    def setSourceDigest(self, digest):
+        self._sourceDigest = digest
+
+    def addIncludedFile(self, path, mtime):
+        if (path, mtime) not in self._includedFiles:
+            self._includedFiles.append((path, mtime))
+
     def attributes(self):
+        generatedAttribs = self._generatedAttribs
+        if self._cacheRegionIDs:
+            generatedAttribs = generatedAttribs + [
+                '_CHEETAH_cacheRegionIDs = %r'
+                % (tuple(self._cacheRegionIDs),)]
+        if self._sourceDigest:
+            generatedAttribs = generatedAttribs + [
+                '_CHEETAH_sourceDigest = %r' % str(self._sourceDigest)]
+        if self._includedFiles:
+            generatedAttribs = generatedAttribs + [
+                '_CHEETAH_includedFiles = %r'
+                % (tuple(self._includedFiles),)]
         try:
             attribs = [self.setting('indentationStep') + str(attrib)
-                       for attrib in self._generatedAttribs]
+                       for attrib in generatedAttribs]
         except UnicodeEncodeError:
             attribs = [self.setting('indentationStep') + unicode(attrib)
-                       for attrib in self._generatedAttribs]
+                       for attrib in generatedAttribs]
         return '\n\n'.join(attribs)
 
 
@@ -1715,8 +2108,13 @@ class ModuleCompiler(SettingsManager, GenUtils):
         if source.find('#indent') != -1:  # @@TR: undocumented hack
             source = indentize(source)
 
+        self._treeBuilder = None
+        compiler = self
+        if self.setting('optimizationPasses'):
+            compiler = self._treeBuilder = TreeBuilder(
+                self, PassManager(self.setting('optimizationPasses')))
         self._parser = self.parserClass(source, filename=self._filePath,
-                                        compiler=self)
+                                        compiler=compiler)
         self._setupCompilerState()
 
     def __getattr__(self, name):
@@ -1741,6 +2139,10 @@ class ModuleCompiler(SettingsManager, GenUtils):
         self.updateSettings(copy.deepcopy(DEFAULT_COMPILER_SETTINGS))
 
     def _setupCompilerState(self):
+        self._sourceDigest = None
+        self._sourceFiles = [self._filePath]
+        self._sourceFileIndexes = [0]
+        self._sourceFileDigests = {}
         self._activeClassesList = []
         self._finishedClassesList = []      # listed by ordered
         self._finishedClassIndex = {}  # listed by name
@@ -1808,6 +2210,8 @@ class ModuleCompiler(SettingsManager, GenUtils):
             classCompiler.setBaseClass(self._baseclassName)
         self._addActiveClassCompiler(classCompiler)
         self._parser.parse()
+        if self._treeBuilder is not None:
+            self._treeBuilder.flush()
         self._swallowClassCompiler(self._popActiveClassCompiler())
         self._compiled = True
         self._parser.cleanup()
@@ -1841,6 +2245,36 @@ class ModuleCompiler(SettingsManager, GenUtils):
     def _finishedClasses(self):
         return self._finishedClassesList
 
+    def sourceDigest(self):
+        if self._sourceDigest is None:
+            self._sourceDigest = hashlib.sha1(
+                self._parser.src().encode('utf-8')).hexdigest()
+        return self._sourceDigest
+
+    def pushSourceFile(self, path, source):
+        """Attribute the following positions in the source to the file
+        path (a file included with inlineIncludes) with the contents source
+        until popSourceFile()."""
+        if path not in self._sourceFiles:
+            self._sourceFiles.append(path)
+        index = self._sourceFiles.index(path)
+        self._sourceFileIndexes.append(index)
+        self._sourceFileDigests[index] = hashlib.sha1(
+            source.encode('utf-8')).hexdigest()
+
+    def popSourceFile(self):
+        self._sourceFileIndexes.pop()
+
+    def sourceFileIndex(self):
+        return self._sourceFileIndexes[-1]
+
+    def currentSourceDigest(self):
+        """The digest of the source file the parser is in."""
+        index = self.sourceFileIndex()
+        if index == 0:
+            return self.sourceDigest()
+        return self._sourceFileDigests[index]
+
     def importedVarNames(self):
         return self._importedVarNames
 
@@ -1977,7 +2411,7 @@ class ModuleCompiler(SettingsManager, GenUtils):
         name = includeUnderscores and '__' + basename + '__' or basename
         self._specialVars[name] = contents.strip()
 
-    def addImportStatement(self, impStatement):
+    def addImportStatement(self, impStatement, lineCol=None):
         settings = self.settings()
         if not self._methodBodyChunks or settings.get('useLegacyImportMode'):
             # In the case where we are importing inline
@@ -2099,7 +2533,7 @@ if __CHEETAH_versionTuple__ < RequiredCheetahVersionTuple:
 %(classes)s
 
 ## END CLASS DEFINITION
-
+%(lineMap)s
 if not hasattr(%(mainClassName)s, '_initCheetahAttributes'):
     templateAPIClass = getattr(%(mainClassName)s,
                                '_CHEETAH_templateClass',
@@ -2116,11 +2550,49 @@ if not hasattr(%(mainClassName)s, '_initCheetahAttributes'):
             'classes': self.classDefs(),
             'footer': self.moduleFooter(),
             'mainClassName': self._mainClassName,
+            'lineMap': _lineMapPlaceholder,
         }  # noqa
+        moduleDef = self._moveLineColsToLineMap(moduleDef)
 
         self._moduleDef = moduleDef
         return moduleDef
 
+    def _moveLineColsToLineMap(self, moduleDef):
+        """Replace the markers of positions in the source with the
+        assignment of the source map to the main class:
+        _CHEETAH_sourceFiles is the tuple of the template file (None for a
+        string) and the files included with inlineIncludes and
+        _CHEETAH_lineMap is a dict {line in moduleDef: (index in
+        _CHEETAH_sourceFiles, line, col)}.
+
+        The line of a def statement is mapped to the first position in the
+        method so profiles can be mapped to the source.
+        """
+        if not self.setting('production'):
+            return moduleDef.replace(_lineMapPlaceholder + '\n', '')
+        lineMap = {}
+        defLineNum = None
+        lines = moduleDef.split('\n')
+        for i, line in enumerate(lines):
+            if _defRE.match(line):
+                defLineNum = i + 1
+            if '\0' not in line or line == _lineMapPlaceholder:
+                continue
+            match = _lineColMarkerRE.search(line)
+            if match:
+                position = tuple([int(group) for group in match.groups()])
+                lineMap[i + 1] = position
+                if defLineNum is not None:
+                    lineMap[defLineNum] = position
+                    defLineNum = None
+                lines[i] = _lineColMarkerRE.sub('', line)
+        moduleDef = '\n'.join(lines)
+        return moduleDef.replace(
+            _lineMapPlaceholder,
+            '%s._CHEETAH_sourceFiles = %r\n%s._CHEETAH_lineMap = %r'
+            % (self._mainClassName, tuple(self._sourceFiles),
+               self._mainClassName, lineMap))
+
     def timestamp(self, theTime=None):
         if not theTime:
             theTime = time.time()
@@ -9,6 +9,13 @@ specific DummyTransaction or DummyResponse behavior
 '''
 
 import logging
+# Generated templates do `from Cheetah.DummyTransaction import *`;
+# keep the names below private to not leak them into templates.
+import threading as _threading
+try:
+    import queue as _queue
+except ImportError:  # Python 2
+    import Queue as _queue
 from .compat import unicode
 
 
@@ -87,6 +94,161 @@ class DummyTransaction(object):
         return self._response
 
 
+class FileResponse(DummyResponse):
+    '''
+    A Response that writes the output straight to a file-like object
+    instead of accumulating it; if encoding is given the output is
+    encoded on the fly (for files opened in binary mode).
+    '''
+    def __init__(self, fileobj, encoding=None, errors='strict'):
+        super(FileResponse, self).__init__()
+        self._file = fileobj
+        self._encoding = encoding
+        self._errors = errors
+
+    def write(self, value):
+        if self._encoding and isinstance(value, unicode):
+            value = value.encode(self._encoding, self._errors)
+        self._file.write(value)
+
+    def flush(self):
+        if hasattr(self._file, 'flush'):
+            self._file.flush()
+
+    def getvalue(self, outputChunks=None):
+        # Everything has already been written to the file
+        if outputChunks:
+            return super(FileResponse, self).getvalue(outputChunks)
+        return u''
+
+
+class FileTransaction(object):
+    '''
+        A transaction whose response writes to a file-like object,
+        see FileResponse.
+    '''
+    def __init__(self, fileobj, encoding=None, errors='strict'):
+        self._response = FileResponse(fileobj, encoding, errors)
+
+    def response(self, resp=None):
+        return self._response
+
+
+class StreamingClosed(BaseException):
+    '''Raised in the rendering thread when the consumer of a
+    StreamingTransaction stopped reading the output.  Like GeneratorExit
+    it isn't an Exception so that ``#except Exception`` in the template
+    doesn't keep the rendering going'''
+    pass
+
+
+class StreamingResponse(DummyResponse):
+    '''
+    A Response that doesn't accumulate the whole output: writes are
+    buffered until they reach chunkSize characters and then passed
+    to the emit callable.
+    '''
+    def __init__(self, emit, chunkSize=8192):
+        super(StreamingResponse, self).__init__()
+        self._emit = emit
+        self._chunkSize = chunkSize
+        self._bufferedSize = 0
+
+    def write(self, value):
+        if not value:
+            return
+        self._outputChunks.append(value)
+        self._bufferedSize += len(value)
+        if self._bufferedSize >= self._chunkSize:
+            self.flush()
+
+    def flush(self):
+        if self._outputChunks:
+            chunk = super(StreamingResponse, self).getvalue()
+            self._outputChunks = []
+            self._bufferedSize = 0
+            self._emit(chunk)
+
+    def getvalue(self, outputChunks=None):
+        # Everything written so far has already been emitted
+        if outputChunks:
+            return super(StreamingResponse, self).getvalue(outputChunks)
+        return u''
+
+
+class StreamingTransaction(object):
+    '''
+        A transaction whose response is produced incrementally.
+
+        ``stream(render)`` calls ``render(trans=self)`` in a separate thread
+        and yields the output in chunks of about ``chunkSize`` characters
+        while it is being written; at most ``queueSize`` chunks are kept
+        waiting for the consumer so memory use doesn't grow with the size
+        of the output.
+
+        Every ``stream()`` call starts a new thread which lives until the
+        template has been rendered or the iterator is closed; the template
+        (and the objects in its searchList) are used from that thread.
+    '''
+    def __init__(self, chunkSize=8192, queueSize=4):
+        self._chunkSize = chunkSize
+        self._queue = _queue.Queue(queueSize)
+        self._closed = False
+        self._response = None
+
+    def response(self, resp=None):
+        if self._response is None:
+            self._response = resp or StreamingResponse(
+                self._emit, self._chunkSize)
+        return self._response
+
+    def _emit(self, item):
+        while True:
+            if self._closed:
+                raise StreamingClosed()
+            try:
+                self._queue.put(item, timeout=0.1)
+            except _queue.Full:
+                continue
+            return
+
+    def _run(self, render):
+        try:
+            render(trans=self)
+            self.response().flush()
+        except StreamingClosed:
+            return
+        except BaseException as e:
+            self._error = e
+        self._emit(_streamingDone)
+
+    def stream(self, render):
+        self._error = None
+        thread = _threading.Thread(target=self._run, args=(render,))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is _streamingDone:
+                    break
+                yield chunk
+            if self._error is not None:
+                raise self._error
+        finally:
+            self._closed = True
+            # Unblock the rendering thread if it waits for a free slot;
+            # its next write raises StreamingClosed
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except _queue.Empty:
+                    break
+
+
+_streamingDone = object()
+
+
 class TransformerResponse(DummyResponse):
     def __init__(self, *args, **kwargs):
         super(TransformerResponse, self).__init__(*args, **kwargs)
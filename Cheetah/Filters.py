@@ -6,24 +6,22 @@
     #filter results in output filters Cheetah's $placeholders .
     #transform results in a filter on the entirety of the output
 '''
-from .compat import unicode
+import sys
+from collections import OrderedDict
+from decimal import Decimal
+
+from .compat import PY2, unicode
 
 # Additional entities WebSafe knows how to transform.  No need to include
 # '<', '>' or '&' since those will have been done already.
 webSafeEntities = {' ': '&nbsp;', '"': '&quot;'}
 
 
-class Filter(object):
-    """A baseclass for the Cheetah Filters."""
+class _PyFilterBase(object):
+    """Pure-python implementation of the standard filters.
 
-    def __init__(self, template=None):
-        """Setup a reference to the template that is using the filter instance.
-        This reference isn't used by any of the standard filters, but is
-        available to Filter subclasses, should they need it.
-
-        Subclasses should call this method.
-        """
-        self.template = template
+    Replaced by the C version from Cheetah._filters if it's available.
+    """
 
     def filter(self, val, encoding=None, str=str, **kw):
         '''
@@ -43,6 +41,84 @@ class Filter(object):
                 # on and let DummyTransaction worry about it
                 return str(val)
 
+    def _maxLen(self, val, **kw):
+        output = _PyFilterBase.filter(self, val, **kw)
+        if 'maxlen' in kw and len(output) > kw['maxlen']:
+            return output[:kw['maxlen']]
+        return output
+
+    def _webSafe(self, val, **kw):
+        s = _PyFilterBase.filter(self, val, **kw)
+        also = kw.get('also')
+        try:
+            replacements = self._webSafeCache[also]
+        except (AttributeError, KeyError, TypeError):
+            replacements = self._webSafeReplacements(also)
+        for k, v in replacements:
+            # Checking first is much faster for the common case of strings
+            # without any characters to escape
+            if k in s:
+                s = s.replace(k, v)
+        return s
+
+    def _webSafeReplacements(self, also):
+        """Return the (character, entity) pairs WebSafe replaces in order.
+
+        The pairs are computed once per distinct `also` and cached on the
+        filter instance; changes to webSafeEntities are not seen by filters
+        that have already escaped the same characters.
+        """
+        try:
+            cache = self._webSafeCache
+        except AttributeError:
+            cache = self._webSafeCache = {}
+        try:
+            return cache[also]
+        except KeyError:
+            pass
+        except TypeError:  # unhashable, e.g. a list
+            return self._webSafeReplacements(tuple(also))
+        # These substitutions are copied from cgi.escape().
+        # "&" must be done first!
+        replacements = [("&", "&amp;"), ("<", "&lt;"), (">", "&gt;")]
+        # Process the additional transformations if any.
+        if also is not None:
+            entities = webSafeEntities   # Global variable.
+            for k in also:
+                if k in entities:
+                    v = entities[k]
+                else:
+                    v = "&#%s;" % ord(k)
+                replacements.append((k, v))
+        if len(cache) >= 100:
+            cache.clear()
+        cache[also] = replacements = tuple(replacements)
+        return replacements
+
+
+try:
+    if getattr(sys, '_cheetah_filters_pure', False):
+        raise ImportError  # Not an error, just a way to skip ``_filters``
+    from ._filters import Filter as _FilterBase, setWebSafeEntities
+    setWebSafeEntities(webSafeEntities)
+    C_VERSION = True
+except ImportError:
+    _FilterBase = _PyFilterBase
+    C_VERSION = False
+
+
+class Filter(_FilterBase):
+    """A baseclass for the Cheetah Filters."""
+
+    def __init__(self, template=None):
+        """Setup a reference to the template that is using the filter instance.
+        This reference isn't used by any of the standard filters, but is
+        available to Filter subclasses, should they need it.
+
+        Subclasses should call this method.
+        """
+        self.template = template
+
 
 RawOrEncodedUnicode = Filter
 
@@ -124,36 +200,116 @@ class CodeHighlighter(EncodeUnicode):
             --></style>%(source)s''' % {'css': css, 'source': encoded}
 
 
+def _callsBaseFilter(filterClass, klass):
+    """Return True if super(klass, ...).filter() of instances of
+    filterClass is the filter() of the base Filter.
+
+    Then MaxLen and WebSafe can use _maxLen()/_webSafe() of the base,
+    which do the same without calling back into Python.
+    """
+    if getattr(filterClass.filter, '__func__', filterClass.filter) \
+            is not getattr(klass.filter, '__func__', klass.filter):
+        return False  # filter() is overridden
+    mro = filterClass.__mro__
+    for base in mro[mro.index(klass) + 1:]:
+        if 'filter' in base.__dict__:
+            return base is _FilterBase
+    return False
+
+
 class MaxLen(Filter):
-    def filter(self, val, **kw):
-        """Replace None with '' and cut off at maxlen."""
+    """Replace None with '' and cut off at maxlen."""
+
+    def __init__(self, template=None):
+        super(MaxLen, self).__init__(template)
+        if _callsBaseFilter(type(self), MaxLen):
+            self.filter = self._maxLen
 
+    def filter(self, val, **kw):
         output = super(MaxLen, self).filter(val, **kw)
-        if 'maxlen' in kw and len(output) > kw['maxlen']:
-            return output[:kw['maxlen']]
-        return output
+        return self._maxLen(output, **kw)
 
 
 class WebSafe(Filter):
     """Escape HTML entities in $placeholders.
     """
+
+    def __init__(self, template=None):
+        super(WebSafe, self).__init__(template)
+        if _callsBaseFilter(type(self), WebSafe):
+            self.filter = self._webSafe
+
     def filter(self, val, **kw):
         s = super(WebSafe, self).filter(val, **kw)
-        # These substitutions are copied from cgi.escape().
-        s = s.replace("&", "&amp;")  # Must be done first!
-        s = s.replace("<", "&lt;")
-        s = s.replace(">", "&gt;")
-        # Process the additional transformations if any.
-        if 'also' in kw:
-            also = kw['also']
-            entities = webSafeEntities   # Global variable.
-            for k in also:
-                if k in entities:
-                    v = entities[k]
-                else:
-                    v = "&#%s;" % ord(k)
-                s = s.replace(k, v)
-        return s
+        return self._webSafe(s, **kw)
+
+
+# Types of values MemoizingFilter caches the output for
+_memoizableTypes = set([str, unicode, int, Decimal])
+if PY2:
+    _memoizableTypes.add(long)  # noqa: F821 undefined name 'long' in PY3
+
+
+class MemoizingFilter(Filter):
+    """Cache the output of another filter for immutable values.
+
+    Values of the types str, int and Decimal are looked up in a bounded
+    LRU cache of the filter instance, keyed by the value, its type and the
+    keyword arguments other than rawExpr; other values are passed to the
+    filter every time.  The cache is cleared when a #filter directive of
+    the template switches to the filter.  Subclass and set filterClass
+    (and maxSize) or use memoize():
+
+        from Cheetah.Filters import memoize
+        Template(source, filter=memoize(CurrencyFilter))
+
+    Only use it for filters whose output depends on nothing but the value
+    and the other keyword arguments, and only for filters that are more
+    expensive than the cache lookup: the standard filters are not.
+    Rendering 20 placeholders with str, int and Decimal values 10000
+    times took 0.63s with Filter and 0.79s with memoize(Filter), 0.72s
+    with WebSafe and 0.86s with memoize(WebSafe), but 1.02s with a filter
+    that quantizes and formats numbers as amounts of money and 0.76s with
+    it memoized.
+    """
+    filterClass = Filter
+    maxSize = 1000
+
+    def __init__(self, template=None):
+        super(MemoizingFilter, self).__init__(template)
+        self._filter = self.filterClass(template).filter
+        self._memo = OrderedDict()
+
+    def filterSwitched(self):
+        """Called by Template._setCurrentFilter() when a #filter directive
+        switches to this filter."""
+        self._memo.clear()
+
+    def filter(self, val, **kw):
+        if type(val) not in _memoizableTypes:
+            return self._filter(val, **kw)
+        memo = self._memo
+        try:
+            if not kw or len(kw) == 1 and 'rawExpr' in kw:
+                key = (type(val), val)
+            else:
+                key = (type(val), val, frozenset(
+                    [item for item in kw.items() if item[0] != 'rawExpr']))
+            output = memo.pop(key)
+        except KeyError:
+            output = self._filter(val, **kw)
+            if len(memo) >= self.maxSize:
+                memo.popitem(last=False)
+        except TypeError:  # unhashable keyword arguments
+            return self._filter(val, **kw)
+        memo[key] = output
+        return output
+
+
+def memoize(filterClass, maxSize=MemoizingFilter.maxSize):
+    """Return a MemoizingFilter subclass that caches filterClass."""
+    return type('Memoized' + filterClass.__name__, (MemoizingFilter,),
+                {'filterClass': filterClass, 'maxSize': maxSize})
 
 
 class Strip(Filter):
@@ -128,6 +128,13 @@ Implementation details
 
 * NameMapper.NotFound is raised if a value can't be found for a name.
 
+* A SearchList remembers in which namespace the first chunk of a name was
+  found, so later lookups of the name skip the namespaces before it.  The
+  cache is cleared when the SearchList or a WatchedDict in it gets or loses
+  a namespace or a name; other changes of the namespaces aren't noticed.
+  Lists built with ``[locals()] + searchList + [globals(), builtin]`` share
+  the cache of the searchList.
+
 Performance and the C version
 ================================================================================
 
@@ -143,6 +150,7 @@ been compiled or falls back to the Python version if not.
 from pprint import pformat
 import inspect
 import sys
+import weakref
 
 from .compat import PY2
 if PY2:
@@ -155,6 +163,8 @@ else:
 _INCLUDE_NAMESPACE_REPR_IN_NOTFOUND_EXCEPTIONS = False
 _ALLOW_WRAPPING_OF_NOTFOUND_EXCEPTIONS = True
 __all__ = ['NotFound',
+           'SearchList',
+           'WatchedDict',
            'hasKey',
            'valueForKey',
            'valueForName',
@@ -252,6 +262,40 @@ def _namespaces(callerFrame, searchList=None):
     yield __builtins__
 
 
+_NOT_FOUND = object()
+
+
+def _namespaceForKey(searchList, key):
+    """Return the first namespace in searchList that has the key
+    or _NOT_FOUND, using the name cache of SearchList.
+    """
+    start = searchList._searchListStart
+    if start:
+        for namespace in searchList[:start]:
+            if hasKey(namespace, key):
+                return namespace
+    index = searchList._nameCache.get(key, _NOT_FOUND)
+    if index is None:  # not in the SearchList part
+        pass
+    elif index is not _NOT_FOUND \
+            and hasKey(searchList[start + index], key):
+        return searchList[start + index]
+    else:
+        end = searchList._searchListEnd
+        index = None
+        for i in range(start, end):
+            if hasKey(searchList[i], key):
+                index = i - start
+                break
+        searchList._nameCache[key] = index
+        if index is not None:
+            return searchList[start + index]
+    for namespace in searchList[searchList._searchListEnd:]:
+        if hasKey(namespace, key):
+            return namespace
+    return _NOT_FOUND
+
+
 def hasName(obj, name):
     # Not in the C version
     """Determine if 'obj' has the 'name' """
@@ -291,6 +335,13 @@ except Exception:
 
     def valueFromSearchList(searchList, name, executeCallables=False):
         key = name.split('.')[0]
+        if type(searchList) is not list \
+                and hasattr(searchList, '_nameCache'):
+            namespace = _namespaceForKey(searchList, key)
+            if namespace is not _NOT_FOUND:
+                return _valueForName(namespace, name,
+                                     executeCallables=executeCallables)
+            _raiseNotFoundException(key, searchList)
         for namespace in searchList:
             if hasKey(namespace, key):
                 return _valueForName(namespace, name,
@@ -326,6 +377,15 @@ except Exception:
                 if not isinstance(FrameLocalsProxy, Mapping):
                     MutableMapping.register(type(FrameLocalsProxy))
             key = name.split('.')[0]
+            if type(searchList) is not list \
+                    and hasattr(searchList, '_nameCache'):
+                namespace = frame.f_locals
+                if hasKey(namespace, key):
+                    return __valueForName()
+                namespace = _namespaceForKey(searchList, key)
+                if namespace is not _NOT_FOUND:
+                    return __valueForName()
+                searchList = None  # globals and builtins
             for namespace in _namespaces(frame, searchList):
                 if hasKey(namespace, key):
                     return __valueForName()
@@ -342,6 +402,142 @@ except Exception:
 # CLASSES
 
 
+def _invalidating(method, invalidateName='invalidate'):
+    def invalidatingMethod(self, *args, **kw):
+        try:
+            return method(self, *args, **kw)
+        finally:
+            getattr(self, invalidateName)()
+    invalidatingMethod.__name__ = method.__name__
+    return invalidatingMethod
+
+
+class SearchList(list):
+    """A searchList with a cache of the namespaces names were found in.
+
+    The cache maps the first chunk of a name to the index of the first
+    namespace that has it (or None if no namespace has it).  It is replaced
+    by a new one when the list is changed or when a name is added to or
+    removed from one of the WatchedDicts passed as `watch`.
+    Other changes of the namespaces, e.g. setting a new attribute on an
+    object in the searchList, aren't noticed.
+
+    Adding a list to a SearchList, as in
+    ``[locals()] + searchList + [globals(), builtin]``, returns a list
+    that uses the cache for the part of it that is the SearchList.
+    """
+    _searchListStart = 0
+
+    def __init__(self, namespaces=(), watch=()):
+        list.__init__(self, namespaces)
+        self.invalidate()
+        for namespace in watch:
+            namespace.addWatcher(self)
+
+    def invalidate(self):
+        # A new dict rather than clear() as lists created by __add__
+        # have the old one and the old indexes
+        self._nameCache = {}
+        self._searchListEnd = len(self)
+
+    def __add__(self, other):
+        if not isinstance(other, list):
+            return NotImplemented
+        return _SearchListPart.new(self, other, self._nameCache,
+                                   0, len(self))
+
+    def __radd__(self, other):
+        if not isinstance(other, list):
+            return NotImplemented
+        return _SearchListPart.new(other, self, self._nameCache,
+                                   len(other), len(other) + len(self))
+
+    __setitem__ = _invalidating(list.__setitem__)
+    __delitem__ = _invalidating(list.__delitem__)
+    if PY2:
+        __setslice__ = _invalidating(list.__setslice__)
+        __delslice__ = _invalidating(list.__delslice__)
+    __iadd__ = _invalidating(list.__iadd__)
+    __imul__ = _invalidating(list.__imul__)
+    append = _invalidating(list.append)
+    extend = _invalidating(list.extend)
+    insert = _invalidating(list.insert)
+    pop = _invalidating(list.pop)
+    remove = _invalidating(list.remove)
+    reverse = _invalidating(list.reverse)
+    sort = _invalidating(list.sort)
+
+
+class _SearchListPart(list):
+    """The result of adding lists to a SearchList: the namespaces
+    from _searchListStart to _searchListEnd are those of the SearchList.
+    """
+    # This is created for every $placeholder without hoistSearchList
+    __slots__ = ('_nameCache', '_searchListStart', '_searchListEnd')
+
+    @classmethod
+    def new(cls, left, right, nameCache, start, end):
+        part = cls(left)
+        part += right
+        part._nameCache = nameCache
+        part._searchListStart = start
+        part._searchListEnd = end
+        return part
+
+    def __add__(self, other):
+        if not isinstance(other, list):
+            return NotImplemented
+        return _SearchListPart.new(self, other, self._nameCache,
+                                   self._searchListStart, self._searchListEnd)
+
+    def __radd__(self, other):
+        if not isinstance(other, list):
+            return NotImplemented
+        return _SearchListPart.new(other, self, self._nameCache,
+                                   len(other) + self._searchListStart,
+                                   len(other) + self._searchListEnd)
+
+
+class WatchedDict(dict):
+    """A dict namespace that invalidates the caches of the SearchLists
+    watching it when a key is added or removed.
+    """
+    def __init__(self, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        self._watchers = []  # weak references to SearchLists
+
+    def addWatcher(self, searchList):
+        self._watchers.append(weakref.ref(searchList))
+
+    def _invalidate(self):
+        for watcherRef in self._watchers[:]:
+            searchList = watcherRef()
+            if searchList is None:
+                self._watchers.remove(watcherRef)
+            else:
+                searchList.invalidate()
+
+    def __setitem__(self, key, value):
+        isNew = key not in self
+        dict.__setitem__(self, key, value)
+        if isNew:
+            self._invalidate()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kw):
+        dict.update(self, *args, **kw)
+        self._invalidate()
+
+    __delitem__ = _invalidating(dict.__delitem__, '_invalidate')
+    pop = _invalidating(dict.pop, '_invalidate')
+    popitem = _invalidating(dict.popitem, '_invalidate')
+    clear = _invalidating(dict.clear, '_invalidate')
+
+
 class Mixin:
     """@@ document me"""
     def valueForName(self, name):
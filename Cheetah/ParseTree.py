@@ -0,0 +1,427 @@
+'''
+A parse tree between the Parser and the ModuleCompiler for optimization
+passes.
+
+The parser generates code by calling the methods of the compiler while it
+scans the source.  With the compiler setting optimizationPasses the parser
+calls a TreeBuilder instead.  The TreeBuilder records the calls that output
+text, placeholders and comments and the #if/#unless blocks around them as
+a tree of nodes, with the line and column of the directives and
+placeholders.  Any other call (defining a method, changing a setting,
+starting a #for loop, etc.) is a barrier: the recorded nodes are run through
+the passes, replayed to the compiler, and the call is passed on.  A pass is
+a function that takes a list of nodes and returns a list of nodes:
+
+foldConstants
+  evaluates the conditions of #if/#elif/#unless directives that are made
+  of literals only (e.g. ``#if False``)
+eliminateDeadCode
+  drops the branches whose condition is false and the ones after a branch
+  whose condition is true; a block whose first branch is true is replaced
+  by the body of the branch
+mergeWrites
+  drops the commits of pending text that are followed by more text or a
+  placeholder, so they are output with one write() call
+
+E.g.::
+
+  Template.compile(source, compilerSettings={
+      'optimizationPasses': ['foldConstants', 'eliminateDeadCode',
+                             'mergeWrites']})
+
+The names are looked up in the dict passes; callables are used as they are.
+'''
+
+import ast
+import re
+
+from .compat import PY2
+
+
+class Unknown(object):
+    '''The value of a condition that can't be evaluated at compile time.'''
+
+
+class Node(object):
+    '''A call of a compiler method.'''
+
+    def __init__(self, name, args=(), kws=None):
+        self.name = name
+        self.args = args
+        self.kws = kws or {}
+        self.lineCol = self.kws.get('lineCol')
+
+    def emit(self, compiler):
+        getattr(compiler, self.name)(*self.args, **self.kws)
+
+    def __repr__(self):
+        return '<%s %s%r>' % (self.__class__.__name__, self.name, self.args)
+
+
+class Text(Node):
+    '''Static text: addStrConst() or addRawText().'''
+
+
+class Placeholder(Node):
+    '''A $placeholder: addPlaceholder().'''
+
+    def __init__(self, name, args=(), kws=None):
+        super(Placeholder, self).__init__(name, args, kws)
+        if self.lineCol is None and len(args) > 4:
+            self.lineCol = args[4]
+
+
+class Branch(object):
+    '''A branch of an If block: the #if, #unless, #elif or #else directive
+    (a Node) and the nodes of its body.'''
+
+    def __init__(self, node, condition):
+        self.node = node
+        self.condition = condition
+        self.value = Unknown
+        self.children = []
+        self.lineCol = node.lineCol
+
+
+class If(object):
+    '''An #if or #unless block and its #elif and #else branches.
+
+    end is the Node (a dedent() call) that closed the block or None while
+    the block is open.  keep is set on a block that an #else in short form
+    may continue after it has been closed; the passes don't change such a
+    block.
+    '''
+
+    def __init__(self, node, condition):
+        self.branches = [Branch(node, condition)]
+        self.end = None
+        self.keep = False
+        self.lineCol = node.lineCol
+
+    def isClosed(self):
+        return self.end is not None
+
+    def emit(self, compiler):
+        for branch in self.branches:
+            branch.node.emit(compiler)
+            for node in branch.children:
+                node.emit(compiler)
+        if self.end is not None:
+            self.end.emit(compiler)
+
+
+_ifRE = re.compile(r'(?:if|elif|else[ \t\f]+if)[ \t\f]+(.*?):?\s*$', re.S)
+_elseRE = re.compile(r'else\s*:?\s*$')
+
+
+def _condition(name, expr):
+    if name == 'addUnless':
+        return 'not (%s)' % expr
+    if _elseRE.match(expr):
+        return 'True'
+    match = _ifRE.match(expr)
+    if match:
+        return match.group(1)
+    return None
+
+
+class TreeBuilder(object):
+    '''Stands in for the ModuleCompiler as the compiler of a Parser:
+    records the calls of the parser in a tree and replays them to the
+    compiler after running the passes.
+    '''
+
+    # calls that only read the state of the compiler; they aren't barriers
+    _passThroughMethods = ('setting', 'settings', 'genCheetahVar',
+                           'genCacheInfoFromArgList')
+
+    def __init__(self, compiler, passManager):
+        self._compiler = compiler
+        self._passManager = passManager
+        self._nodes = []
+        self._openBlocks = []
+        for name in self._passThroughMethods:
+            setattr(self, name, getattr(compiler, name))
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        attr = getattr(self._compiler, name)
+        if not callable(attr):
+            self.flush()
+            return attr
+
+        def barrier(*args, **kws):
+            # the parser can get a method before it records more calls
+            self.flush()
+            return getattr(self._compiler, name)(*args, **kws)
+        return barrier
+
+    def _current(self):
+        if self._openBlocks:
+            return self._openBlocks[-1].branches[-1].children
+        return self._nodes
+
+    def _record(self, node):
+        self._current().append(node)
+
+    def flush(self):
+        '''Run the passes on the recorded nodes and replay them to the
+        compiler.  Blocks that are still open are output as they are; the
+        rest of them is passed on to the compiler directly.
+        '''
+        nodes = self._nodes
+        self._nodes = []
+        self._openBlocks = []
+        if nodes:
+            for node in self._passManager.run(nodes):
+                node.emit(self._compiler)
+
+    # recorded calls
+
+    def addStrConst(self, strConst):
+        self._record(Text('addStrConst', (strConst,)))
+
+    def addRawText(self, text):
+        self._record(Text('addRawText', (text,)))
+
+    def handleWSBeforeDirective(self):
+        self._record(Node('handleWSBeforeDirective'))
+
+    def commitStrConst(self):
+        self._record(Node('commitStrConst'))
+
+    def addComment(self, comm):
+        self._record(Node('addComment', (comm,)))
+
+    def addPlaceholder(self, *args, **kws):
+        self._record(Placeholder('addPlaceholder', args, kws))
+
+    def addIf(self, expr, lineCol=None):
+        self._openBlock(Node('addIf', (expr,), {'lineCol': lineCol}))
+
+    def addUnless(self, expr, lineCol=None):
+        self._openBlock(Node('addUnless', (expr,), {'lineCol': lineCol}))
+
+    def _openBlock(self, node):
+        block = If(node, _condition(node.name, node.args[0]))
+        self._record(block)
+        self._openBlocks.append(block)
+
+    def addElse(self, expr, dedent=True, lineCol=None):
+        self._addBranch('addElse', expr, dedent, lineCol)
+
+    def addElif(self, expr, dedent=True, lineCol=None):
+        self._addBranch('addElif', expr, dedent, lineCol)
+
+    def _addBranch(self, name, expr, dedent, lineCol):
+        if not dedent or not self._openBlocks:
+            # continues a closed block or ends a block the
+            # compiler opened: a barrier
+            if not dedent:
+                for node in reversed(self._current()):
+                    if isinstance(node, If):
+                        node.keep = True
+                        break
+            self.__getattr__(name)(expr, dedent=dedent, lineCol=lineCol)
+            return
+        node = Node(name, (expr,), {'lineCol': lineCol})
+        self._openBlocks[-1].branches.append(
+            Branch(node, _condition(name, expr)))
+
+    def dedent(self):
+        if not self._openBlocks:
+            self.__getattr__('dedent')()
+            return
+        self._openBlocks.pop().end = Node('dedent')
+
+
+class PassManager(object):
+    '''Runs a sequence of passes on lists of nodes.'''
+
+    def __init__(self, passList):
+        self._passes = [passes[p] if not callable(p) else p
+                        for p in passList]
+
+    def run(self, nodes):
+        for optimizationPass in self._passes:
+            nodes = optimizationPass(nodes)
+        return nodes
+
+
+def _walkBlocks(nodes, func):
+    '''Apply func to the If blocks of nodes, innermost first.'''
+    for node in nodes:
+        if isinstance(node, If):
+            for branch in node.branches:
+                _walkBlocks(branch.children, func)
+            func(node)
+
+
+# constant folding
+
+_compareOps = {
+    ast.Eq: lambda a, b: a == b,
+    ast.NotEq: lambda a, b: a != b,
+    ast.Lt: lambda a, b: a < b,
+    ast.LtE: lambda a, b: a <= b,
+    ast.Gt: lambda a, b: a > b,
+    ast.GtE: lambda a, b: a >= b,
+    ast.Is: lambda a, b: a is b,
+    ast.IsNot: lambda a, b: a is not b,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+
+if PY2:
+    _names = {'True': True, 'False': False, 'None': None}
+    _constantNodes = (ast.Num, ast.Str)
+else:
+    _names = {}
+    _constantNodes = (ast.Constant,)
+
+
+def _constantValue(node):
+    if isinstance(node, _constantNodes):
+        if PY2:
+            return node.n if isinstance(node, ast.Num) else node.s
+        return node.value
+    if isinstance(node, ast.Name) and node.id in _names:
+        return _names[node.id]
+    if isinstance(node, (ast.Tuple, ast.List)):
+        values = [_constantValue(elt) for elt in node.elts]
+        if Unknown in values:
+            return Unknown
+        return tuple(values)
+    if isinstance(node, ast.UnaryOp):
+        operand = _constantValue(node.operand)
+        if operand is Unknown:
+            return Unknown
+        if isinstance(node.op, ast.Not):
+            return not operand
+        if isinstance(node.op, ast.USub):
+            return -operand
+        if isinstance(node.op, ast.UAdd):
+            return +operand
+        return Unknown
+    if isinstance(node, ast.BoolOp):
+        values = [_constantValue(value) for value in node.values]
+        if Unknown in values:
+            return Unknown
+        if isinstance(node.op, ast.And):
+            return all(values)
+        return any(values)
+    if isinstance(node, ast.Compare):
+        left = _constantValue(node.left)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = _constantValue(comparator)
+            if left is Unknown or right is Unknown \
+                    or type(op) not in _compareOps:
+                return Unknown
+            if not _compareOps[type(op)](left, right):
+                return False
+            left = right
+        return True
+    return Unknown
+
+
+def evalConstant(expr):
+    '''Return the value of the Python expression expr if it is made of
+    literals and operators that can be evaluated at compile time, else
+    Unknown.
+    '''
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError:
+        return Unknown
+    try:
+        return _constantValue(tree.body)
+    except Exception:
+        return Unknown
+
+
+def foldConstants(nodes):
+    def fold(block):
+        for branch in block.branches:
+            if branch.condition is not None:
+                value = evalConstant(branch.condition)
+                if value is not Unknown:
+                    value = bool(value)
+                branch.value = value
+    _walkBlocks(nodes, fold)
+    return nodes
+
+
+# dead code elimination
+
+def _eliminate(block):
+    '''Return the nodes to output for the block.'''
+    if block.keep or not block.isClosed():
+        return [block]
+    branches = []
+    for branch in block.branches:
+        if branch.value is False:
+            continue
+        branches.append(branch)
+        if branch.value is True:
+            break
+    if not branches:
+        # `pass` in case the block was the only statement of a loop
+        return [Node('addChunk', ('pass',))]
+    first = branches[0]
+    if first.value is True:
+        return first.children
+    if first is not block.branches[0]:
+        # an #elif becomes the #if
+        first.node = Node('addIf', ('if ' + first.condition,),
+                          {'lineCol': first.lineCol})
+    last = branches[-1]
+    if last is not first and last.value is True:
+        # an `#elif True` becomes the #else
+        last.node = Node('addElse', ('else',), {'lineCol': last.lineCol})
+    if last is not block.branches[-1]:
+        # the text of the last branch must be output before the dedent
+        last.children.append(Node('commitStrConst'))
+    block.branches = branches
+    return [block]
+
+
+def eliminateDeadCode(nodes):
+    result = []
+    for node in nodes:
+        if isinstance(node, If):
+            for branch in node.branches:
+                branch.children = eliminateDeadCode(branch.children)
+            result.extend(_eliminate(node))
+        else:
+            result.append(node)
+    return result
+
+
+# write merging
+
+def _startsOutput(node):
+    return isinstance(node, (Text, Placeholder))
+
+
+def mergeWrites(nodes):
+    result = []
+    for i, node in enumerate(nodes):
+        if isinstance(node, If):
+            for branch in node.branches:
+                branch.children = mergeWrites(branch.children)
+        elif node.name == 'commitStrConst' and i + 1 < len(nodes):
+            following = nodes[i + 1]
+            if _startsOutput(following) or (
+                    isinstance(following, Node)
+                    and following.name == 'commitStrConst'):
+                continue
+        result.append(node)
+    return result
+
+
+passes = {
+    'foldConstants': foldConstants,
+    'eliminateDeadCode': eliminateDeadCode,
+    'mergeWrites': mergeWrites,
+}
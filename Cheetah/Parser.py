@@ -8,10 +8,13 @@ Classes:
   Parser === _HighLevelParser (an alias)
 """
 
+import ast
+import os
 import sys
 import re
 import types
 import inspect
+import codecs
 
 from .SourceReader import SourceReader
 from .Unspecified import Unspecified
@@ -434,6 +437,15 @@ class _LowLevelParser(SourceReader):
             + self.setting('cheetahVarStartToken')[0]
             + self.setting('directiveStartToken')[0]
             + self.setting('PSPStartToken')[0])
+        # the start tokens of the matchers below; plain text is scanned
+        # for them with one search instead of char by char
+        startTokens = [self.setting(name) for name in (
+            'commentStartToken', 'multiLineCommentStartToken',
+            'cheetahVarStartToken', 'directiveStartToken', 'PSPStartToken',
+            'EOLSlurpToken')]
+        self._possibleNonStrConstantRE = re.compile('|'.join([
+            re.escape(token) for token in startTokens
+            if token and token[0] in self._possibleNonStrConstantChars]))
         self._nonStrConstMatchers = [
             self.matchCommentStartToken,
             self.matchMultiLineCommentStartToken,
@@ -590,6 +602,17 @@ class _LowLevelParser(SourceReader):
                     break
         return match
 
+    def advanceToPossibleNonStrConstant(self):
+        """Advance past the current char to the next start token of a
+        comment, placeholder, directive, PSP tag or EOL slurp, or to the end.
+        """
+        match = self._possibleNonStrConstantRE.search(
+            self.src(), self.pos() + 1, self.breakPoint())
+        if match:
+            self.setPos(match.start())
+        else:
+            self.setPos(self.breakPoint())
+
     def matchPyToken(self):
         match = pseudoprog.match(self.src(), self.pos())
 
@@ -1572,7 +1595,7 @@ class _HighLevelParser(_LowLevelParser):
             if match:
                 break
             else:
-                self.advance()
+                self.advanceToPossibleNonStrConstant()
         strConst = self.readTo(self.pos(), start=startPos)
         strConst = self._unescapeCheetahVars(strConst)
         strConst = self._unescapeDirectives(strConst)
@@ -1694,10 +1717,11 @@ class _HighLevelParser(_LowLevelParser):
                 includeDirectiveNameInExpr = False
             else:
                 includeDirectiveNameInExpr = True
+            lineCol = self.getRowCol()
             expr = self.eatSimpleExprDirective(
                 directiveName,
                 includeDirectiveNameInExpr=includeDirectiveNameInExpr)
-            handler(expr)
+            handler(expr, lineCol=lineCol)
         ##
         for callback in self.setting('postparseDirectiveHooks'):
             callback(parser=self, directiveName=directiveName)
@@ -2247,6 +2271,7 @@ class _HighLevelParser(_LowLevelParser):
         # filtered
         isLineClearToStartToken = self.isLineClearToStartToken()
         endOfFirstLine = self.findEOL()
+        lineCol = self.getRowCol()
         self.getDirectiveStartToken()
         self.advance(3)
         self.getWhiteSpace()
@@ -2280,7 +2305,7 @@ class _HighLevelParser(_LowLevelParser):
         exprComponents.LVALUE = LVALUE
         exprComponents.OP = OP
         exprComponents.RVALUE = RVALUE
-        self._compiler.addSet(expr, exprComponents, style)
+        self._compiler.addSet(expr, exprComponents, style, lineCol=lineCol)
 
     def eatSlurp(self):
         if self.isLineClearToStartToken():
@@ -2340,7 +2365,53 @@ class _HighLevelParser(_LowLevelParser):
         sourceExpr = self._applyExpressionFilters(sourceExpr, 'include',
                                                   startPos=startPos)
         self._eatRestOfDirectiveTag(isLineClearToStartToken, endOfFirstLinePos)
-        self._compiler.addInclude(sourceExpr, includeFrom, isRaw)
+        includePath = None
+        if includeFrom == 'file' and self.setting('inlineIncludes'):
+            includePath = self._getStringLiteral(sourceExpr)
+        if includePath is None:
+            self._compiler.addInclude(sourceExpr, includeFrom, isRaw)
+        else:
+            self._inlineInclude(includePath, isRaw)
+
+    def _getStringLiteral(self, expr):
+        try:
+            value = ast.literal_eval(expr.strip())
+        except (ValueError, SyntaxError):
+            return None
+        if isinstance(value, string_type):
+            return value
+        return None
+
+    def _inlineInclude(self, path, isRaw):
+        """Parse the file path in place of an #include directive (the
+        compiler setting inlineIncludes).
+
+        The path is resolved like Servlet.serverSidePath() does at runtime
+        and recorded with its mtime in the generated class attribute
+        _CHEETAH_includedFiles so Template.compile() recompiles the
+        template when the file changes.
+        """
+        path = os.path.normpath(os.path.abspath(path.replace('\\', '/')))
+        encoding = self.setting('encoding')
+        if encoding:
+            f = codecs.open(path, 'r', encoding=encoding)
+        else:
+            f = open(path, 'r')
+        try:
+            source = f.read()
+        finally:
+            f.close()
+        self._compiler.addIncludedFile(path, os.path.getmtime(path))
+        if isRaw:
+            self._compiler.addStrConst(source)
+            return
+        source = unicode(source)
+        parser = self.__class__(source, filename=path,
+                                compiler=self._compiler)
+        self._compiler.pushSourceFile(path, source)
+        parser.parse()
+        parser.cleanup()
+        self._compiler.popSourceFile()
 
     def eatDefMacro(self):
         # @@TR: not filtered yet
@@ -1,6 +1,7 @@
 """SourceReader class for Cheetah's Parser and CodeGenerator
 """
 import re
+from bisect import bisect_right
 from .compat import unicode
 
 EOLre = re.compile(r'[ \f\t]*(?:\r\n|\r|\n)')
@@ -25,18 +26,17 @@ class SourceReader(object):
         self._bookmarks = {}
         self._posTobookmarkMap = {}
 
-        # collect some meta-information
+        # collect some meta-information: the positions of the beginning
+        # and of the end of every line
         self._EOLs = []
-        pos = 0
-        while pos < len(self):
-            EOLmatch = EOLZre.search(src, pos)
-            self._EOLs.append(EOLmatch.start())
-            pos = EOLmatch.end()
-
         self._BOLs = []
-        for pos in self._EOLs:
-            BOLpos = self.findBOL(pos)
-            self._BOLs.append(BOLpos)
+        BOL = 0
+        for EOLmatch in EOLZre.finditer(src):
+            if BOL >= len(self):
+                break
+            self._BOLs.append(BOL)
+            self._EOLs.append(EOLmatch.start())
+            BOL = EOLmatch.end()
 
     def src(self):
         return self._src
@@ -68,9 +68,9 @@ class SourceReader(object):
         if pos is None:
             pos = self._pos
 
-        for i in range(len(self._BOLs)):
-            if pos >= self._BOLs[i] and pos <= self._EOLs[i]:
-                return i
+        i = bisect_right(self._BOLs, pos) - 1
+        if i >= 0 and pos <= self._EOLs[i]:
+            return i
 
     def getRowCol(self, pos=None):
         if pos is None:
@@ -15,6 +15,8 @@ import time                       # used in the cache refresh code
 from random import randrange
 import inspect
 import io
+import ast
+import linecache
 try:
     from StringIO import StringIO
 except ImportError:
@@ -27,13 +29,20 @@ except ImportError:  # Python 3.13+
     from urllib.parse import parse_qs
     cgi = None
 import types
+import warnings
+import weakref
 
 from . import ErrorCatchers              # for placeholder tags
 from . import Filters                    # the output filters
-from .CacheRegion import CacheRegion
+from .CacheRegion import CacheRegion, SharedCacheRegion, prefetchCacheItems
 from .CacheStore import MemoryCacheStore  # , MemcachedCacheStore
+from .CacheStore import getSharedCacheStore
+from .CompileCache import CompileCache, PersistentCompileCache, \
+    replaceCodeFilename, Error as CompileCacheError
 from .Compiler import Compiler
-from .NameMapper import NotFound, valueFromSearchList
+from .DummyTransaction import FileTransaction, StreamingTransaction
+from .NameMapper import NotFound, valueFromSearchList, \
+    SearchList, WatchedDict
 from .Parser import ParseError, SourceReader
 # Base classes for Template
 from .Servlet import Servlet
@@ -79,6 +88,33 @@ def checkFileMtime(value):
     globals()['__checkFileMtime'] = value
 
 
+_includedFilesRE = re.compile(r'^\s*_CHEETAH_includedFiles = (.*)$', re.M)
+
+
+def _includedFilesModified(includedFiles):
+    """Return True if one of the (path, mtime) pairs of the files inlined
+    by #include directives (the compiler setting inlineIncludes) is out of
+    date.
+    """
+    if not globals()['__checkFileMtime']:
+        return False
+    for path, mtime in includedFiles:
+        try:
+            if os.path.getmtime(path) != mtime:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def _getIncludedFiles(generatedModuleCode):
+    """The _CHEETAH_includedFiles of the generated code of a template."""
+    match = _includedFilesRE.search(generatedModuleCode)
+    if match is None:
+        return ()
+    return ast.literal_eval(match.group(1))
+
+
 class Error(Exception):
     pass
 
@@ -130,7 +166,6 @@ _formUsedByWebInput = None
 
 
 def updateLinecache(filename, src):
-    import linecache
     size = len(src)
     mtime = time.time()
     lines = src.splitlines()
@@ -138,10 +173,138 @@ def updateLinecache(filename, src):
     linecache.cache[filename] = size, mtime, lines, fullname
 
 
+def _lineMapClass(moduleGlobals):
+    '''Return the template class with a source map (see the compiler
+    setting production) defined in the module with the globals
+    moduleGlobals, or None.
+    '''
+    moduleName = moduleGlobals.get('__name__')
+    for value in list(moduleGlobals.values()):
+        if isinstance(value, type) and value.__module__ == moduleName \
+                and value.__dict__.get('_CHEETAH_lineMap'):
+            return value
+    return None
+
+
+def sourcePosition(templateClass, lineno):
+    '''Return (filename, line, col) in the template source for the line
+    lineno of the module generated for templateClass, or None if the line
+    isn't in the source map.
+
+    filename is None for a template compiled from a string.
+    '''
+    lineMap = templateClass.__dict__.get('_CHEETAH_lineMap')
+    position = lineMap and lineMap.get(lineno)
+    if not position:
+        return None
+    fileIndex, line, col = position
+    return templateClass._CHEETAH_sourceFiles[fileIndex], line, col
+
+
+def _frameSourcePosition(filename, lineno, moduleGlobals):
+    templateClass = _lineMapClass(moduleGlobals)
+    position = templateClass and sourcePosition(templateClass, lineno)
+    if not position:
+        return None
+    return position[0] or '<template>', position[1], position[2]
+
+
+def extractTraceback(tb):
+    '''Like traceback.extract_tb(), but the frames of the templates
+    compiled with the compiler setting production point to the template
+    source instead of the generated module: a list of (filename, line
+    number, function name, text) tuples.
+    '''
+    frames = []
+    while tb is not None:
+        frame = tb.tb_frame
+        filename = frame.f_code.co_filename
+        lineno = tb.tb_lineno
+        moduleGlobals = frame.f_globals
+        position = _frameSourcePosition(filename, lineno, moduleGlobals)
+        if position:
+            filename, lineno, col = position
+            # the loader of the module would return the generated code
+            moduleGlobals = None
+        linecache.checkcache(filename)
+        text = linecache.getline(filename, lineno, moduleGlobals).strip()
+        frames.append((filename, lineno, frame.f_code.co_name, text or None))
+        tb = tb.tb_next
+    return frames
+
+
+def formatException(etype, value, tb):
+    '''Like traceback.format_exception() with extractTraceback().'''
+    lines = ['Traceback (most recent call last):\n']
+    lines.extend(traceback.format_list(extractTraceback(tb)))
+    lines.extend(traceback.format_exception_only(etype, value))
+    return lines
+
+
+def rewriteProfileStats(stats):
+    '''Replace the functions of the templates compiled with the compiler
+    setting production in the pstats.Stats object stats with their
+    positions in the template source, like stats.strip_dirs() does with
+    the paths.  The line of a function is the line of its first
+    placeholder or directive.
+    '''
+    import pstats
+    modules = {}
+    for module in list(sys.modules.values()):
+        filename = getattr(module, '__file__', None)
+        if filename:
+            if filename.endswith(('.pyc', '.pyo')):
+                filename = filename[:-1]
+            modules[filename] = module.__dict__
+
+    def rewrite(func):
+        filename, lineno, name = func
+        if filename not in modules:
+            return func
+        position = _frameSourcePosition(filename, lineno, modules[filename])
+        if not position:
+            return func
+        return position[0], position[1], name
+
+    oldStats = stats.stats
+    stats.stats = newStats = {}
+    for func, (cc, nc, tt, ct, callers) in oldStats.items():
+        newFunc = rewrite(func)
+        newCallers = {}
+        for caller, callerStats in callers.items():
+            newCallers[rewrite(caller)] = callerStats
+        if newFunc in newStats:
+            newStats[newFunc] = pstats.add_func_stats(
+                newStats[newFunc], (cc, nc, tt, ct, newCallers))
+        else:
+            newStats[newFunc] = (cc, nc, tt, ct, newCallers)
+    if isinstance(stats.top_level, dict):
+        stats.top_level = dict([(rewrite(func), None)
+                                for func in stats.top_level])
+    else:
+        stats.top_level = set([rewrite(func) for func in stats.top_level])
+    stats.max_name_len = max(
+        [len(pstats.func_std_string(func)) for func in newStats] + [0])
+    stats.fcn_list = None
+    stats.all_callees = None
+    return stats
+
+
 class CompileCacheItem(object):
     pass
 
 
+def _storeInPersistentCache(persistentCache, key, *args):
+    """Store a compiled template in persistentCache.  A cache directory
+    that can't be written to (missing, read-only, full) doesn't make
+    Template.compile() fail, it only emits a warning."""
+    try:
+        persistentCache.store(key, *args)
+    except (CompileCacheError, IOError, OSError) as e:
+        warnings.warn('Could not store the template in the compile cache: %s'
+                      % e)
+
+
 class TemplatePreprocessor(object):
     '''
     This is used with the preprocessors argument to Template.compile().
@@ -279,6 +442,7 @@ class Template(Servlet):
     # this is used by ._addCheetahPlumbingCodeToClass()
     _CHEETAH_requiredCheetahMethods = (
         '_initCheetahInstance',
+        '_setCurrentFilter',
         'searchList',
         'errorCatcher',
         'getVar',
@@ -301,25 +465,52 @@ class Template(Servlet):
         'refreshCache',
 
         '_handleCheetahInclude',
+        '_getIncludedTemplateClass',
         '_getTemplateAPIClassForIncludeDirectiveCompilation',
     )
     _CHEETAH_requiredCheetahClassMethods = ('subclass',)
     _CHEETAH_requiredCheetahClassAttributes = (
         'cacheRegionClass', 'cacheStore',
-        'cacheStoreIdPrefix', 'cacheStoreClass')
+        'cacheStoreIdPrefix', 'cacheStoreClass', 'useNameMapperCache',
+        'shareCacheRegions', 'sharedCacheRegionClass', 'cacheRegionIDs',
+        'sourceDigest',
+        'includeCache', 'includedFiles', 'fileContentsCache',
+        'sourceFiles', 'lineMap')
 
     # The following are used by .compile().
     # Most are documented in its docstring.
     _CHEETAH_cacheModuleFilesForTracebacks = False
     _CHEETAH_cacheDirForModuleFiles = None  # change to a dirname
-
-    _CHEETAH_compileCache = dict()  # cache store for compiled code and classes
+    _CHEETAH_compileCacheDir = None  # change to a dirname
+
+    # cache store for compiled code and classes
+    _CHEETAH_compileCache = CompileCache()
+    # The default cache is unbounded. To bound it create a CompileCache with
+    # limits; see Cheetah.CompileCache.CompileCache for details. E.g.:
+    #   class BoundedCachingTemplate(Template):
+    #       _CHEETAH_compileCache = CompileCache(maxEntries=500,
+    #                                            maxIdleTime=3600)
     # To do something other than simple in-memory caching you can create an
     # alternative cache store. It just needs to support the basics of Python's
     # mapping/dict protocol. E.g.:
     #   class AdvCachingTemplate(Template):
     #       _CHEETAH_compileCache = MemoryOrFileCache()
     _CHEETAH_compileLock = Lock()  # used to prevent race conditions
+    # weak references to the classes of the files compiled for #include
+    # directives, shared by all instances; see _getIncludedTemplateClass()
+    _CHEETAH_includeCache = CompileCache(maxEntries=1000)
+    # (path, mtime) pairs of the files compiled into the generated class
+    # by #include directives with the compiler setting inlineIncludes
+    _CHEETAH_includedFiles = ()
+    # contents of the files read by getFileContents() (#include raw); the
+    # least recently used files are dropped first.  The size is counted in
+    # characters (item.code is the contents)
+    _CHEETAH_fileContentsCache = CompileCache(maxEntries=1000,
+                                              maxCodeSize=10000000)
+    # the source map of a class compiled with the compiler setting
+    # production: see sourcePosition() and extractTraceback()
+    _CHEETAH_sourceFiles = ()
+    _CHEETAH_lineMap = None
     _CHEETAH_defaultMainMethodName = None
     _CHEETAH_compilerSettings = None
     _CHEETAH_compilerClass = Compiler
@@ -345,6 +536,21 @@ class Template(Servlet):
     # _CHEETAH_cacheStoreClass = MemcachedCacheStore
     _CHEETAH_cacheStore = None
     _CHEETAH_cacheStoreIdPrefix = None
+    # Set to True to share the #cache regions of all instances of the
+    # template class: the regions are stored (unless _CHEETAH_cacheStore is
+    # set) in the process-wide CacheStore.getSharedCacheStore() with a key
+    # prefix derived from the class name and the source of the template
+    # instead of the instance's id().
+    _CHEETAH_shareCacheRegions = False
+    _CHEETAH_sharedCacheRegionClass = SharedCacheRegion
+    # IDs of the #cache regions of the generated class that have a single
+    # cache item; their data is fetched at once with the first shared region
+    _CHEETAH_cacheRegionIDs = ()
+    # SHA-1 of the source of a generated class with #cache regions
+    _CHEETAH_sourceDigest = None
+    # Set to True to use a NameMapper.SearchList that remembers in which
+    # namespace a $placeholder was found (see _initCheetahInstance()):
+    _CHEETAH_useNameMapperCache = False
 
     @classmethod
     def _getCompilerClass(klass, source=None, file=None):
@@ -372,6 +578,7 @@ class Template(Servlet):
                 cacheDirForModuleFiles=Unspecified,
                 commandlineopts=None,
                 keepRefToGeneratedCode=Unspecified,
+                compileCacheDir=Unspecified,
                 ):
 
         """
@@ -530,6 +737,25 @@ class Template(Servlet):
 
               See notes on cacheModuleFilesForTracebacks.
 
+            - compileCacheDir (a string representing a dir path)
+              Default: Template._CHEETAH_compileCacheDir=None
+
+              If set, the generated module code and the compiled Python code
+              object are also stored in this directory (which must exist),
+              keyed on a stable digest of the source, compiler class and
+              settings, class/module/method names, baseclass, Cheetah and
+              Python versions.  When the same template is compiled in a later
+              process the cached code is loaded from disk and the Cheetah
+              parser and compiler are not run at all.  This can reduce the
+              startup time of applications that use a lot of dynamically
+              compiled templates.  The directory is consulted only if
+              'useCache' is true and written only if 'cacheCompilationResults'
+              is true.  Templates compiled from file-like objects or with
+              compiler settings that can't be represented stably (e.g.
+              callables) are not cached on disk.  If the directory can't be
+              written to (missing, read-only, full) the template is compiled
+              anyway and a warning is emitted.
+
             - preprocessors
               Default: Template._CHEETAH_preprocessors=None
 
@@ -705,6 +931,12 @@ class Template(Servlet):
             raise TypeError(errmsg %
                             ('cacheDirForModuleFiles', 'string or None'))
 
+        if compileCacheDir is Unspecified:
+            compileCacheDir = klass._CHEETAH_compileCacheDir
+
+        if not isinstance(compileCacheDir, (NoneType, string_type)):
+            raise TypeError(errmsg % ('compileCacheDir', 'string or None'))
+
         ##################################################
         # handle any preprocessors
         if preprocessors:
@@ -742,11 +974,8 @@ class Template(Servlet):
                     fileHash += str(os.path.getmtime(file))
 
             try:
-                # @@TR: find some way to create a cacheHash that is consistent
-                # between process restarts.  It would allow for caching the
-                # compiled module on disk and thereby reduce the startup time
-                # for applications that use a lot of dynamically compiled
-                # templates.
+                # This cacheHash isn't consistent between process restarts;
+                # see compileCacheDir for the persistent on-disk cache.
                 cacheHash = ''.join([str(v) for v in
                                      [hash(source),
                                       fileHash,
@@ -762,12 +991,46 @@ class Template(Servlet):
             except Exception:
                 # @@TR: should add some logging to this
                 pass
+
         outputEncoding = 'ascii'
         compiler = None
-        if useCache and cacheHash and cacheHash in klass._CHEETAH_compileCache:
-            cacheItem = klass._CHEETAH_compileCache[cacheHash]
+        codeObject = None
+        persistentCache = None
+        persistentCacheKey = None
+        persistentCacheEntry = None
+        if useCache and cacheHash:
+            try:
+                cacheItem = klass._CHEETAH_compileCache[cacheHash]
+            except KeyError:
+                pass
+            else:
+                if _includedFilesModified(
+                        cacheItem.klass._CHEETAH_includedFiles):
+                    del klass._CHEETAH_compileCache[cacheHash]
+                    cacheItem = None
+        if cacheItem:
             generatedModuleCode = cacheItem.code
         else:
+            if compileCacheDir and (source or isinstance(file, string_type)):
+                persistentCache = PersistentCompileCache(compileCacheDir)
+                persistentCacheKey = persistentCache.genKey(
+                    source=source, file=file,
+                    className=className,
+                    moduleName=moduleName,
+                    mainMethodName=mainMethodName,
+                    compilerClass=compilerClass,
+                    baseclassName=baseclassName,
+                    compilerSettings=compilerSettings,
+                    shBang=commandlineopts and commandlineopts.shbang)
+            if useCache and persistentCacheKey:
+                persistentCacheEntry = persistentCache.load(persistentCacheKey)
+                if persistentCacheEntry and _includedFilesModified(
+                        _getIncludedFiles(persistentCacheEntry[0])):
+                    persistentCacheEntry = None
+        if persistentCacheEntry:
+            generatedModuleCode, outputEncoding, codeObject = \
+                persistentCacheEntry
+        elif not cacheItem:
             compiler = compilerClass(source, file,
                                      moduleName=moduleName,
                                      mainClassName=className,
@@ -780,7 +1043,14 @@ class Template(Servlet):
             generatedModuleCode = compiler.getModuleCode()
             outputEncoding = compiler.getModuleEncoding()
 
+        storeInPersistentCache = (
+            persistentCacheKey and cacheCompilationResults
+            and (not persistentCacheEntry or codeObject is None))
+
         if not returnAClass:
+            if storeInPersistentCache and compiler:
+                _storeInPersistentCache(persistentCache, persistentCacheKey,
+                                        generatedModuleCode, outputEncoding)
             # This is a bit of a hackish solution to make sure
             # we're setting the proper encoding on generated code
             # that is destined to be written to a file.
@@ -824,7 +1094,11 @@ class Template(Servlet):
                     setattr(mod, baseclassName, baseclassValue)
                 ##
                 try:
-                    co = compile(generatedModuleCode, __file__, 'exec')
+                    co = None
+                    if codeObject is not None:
+                        co = replaceCodeFilename(codeObject, __file__)
+                    if co is None:
+                        co = compile(generatedModuleCode, __file__, 'exec')
                     exec(co, mod.__dict__)
                 except SyntaxError as e:
                     try:
@@ -845,6 +1119,11 @@ class Template(Servlet):
             finally:
                 klass._CHEETAH_compileLock.release()
 
+            if storeInPersistentCache:
+                _storeInPersistentCache(persistentCache, persistentCacheKey,
+                                        generatedModuleCode, outputEncoding,
+                                        co)
+
             templateClass = getattr(mod, className)
 
             if (cacheCompilationResults and cacheHash
@@ -853,6 +1132,7 @@ class Template(Servlet):
                 cacheItem.cacheTime = cacheItem.lastCheckoutTime = time.time()
                 cacheItem.code = generatedModuleCode
                 cacheItem.klass = templateClass
+                cacheItem.moduleName = uniqueModuleName
                 templateClass._CHEETAH_isInCompilationCache = True
                 klass._CHEETAH_compileCache[cacheHash] = cacheItem
             else:
@@ -1372,6 +1652,8 @@ class Template(Servlet):
         if not self._CHEETAH__cacheStore:
             if self._CHEETAH_cacheStore is not None:
                 self._CHEETAH__cacheStore = self._CHEETAH_cacheStore
+            elif self._CHEETAH_shareCacheRegions:
+                self._CHEETAH__cacheStore = getSharedCacheStore()
             else:
                 # @@TR: might want to provide a way to provide init args
                 self._CHEETAH__cacheStore = self._CHEETAH_cacheStoreClass()
@@ -1381,22 +1663,53 @@ class Template(Servlet):
     def _getCacheStoreIdPrefix(self):
         if self._CHEETAH_cacheStoreIdPrefix is not None:
             return self._CHEETAH_cacheStoreIdPrefix
+        elif self._CHEETAH_shareCacheRegions:
+            # The class name alone isn't unique (index.tmpl in two
+            # directories, DynamicallyCompiledCheetahTemplate); add the
+            # digests of the sources of the class and its base templates,
+            # which stay the same when the template is recompiled
+            klass = self.__class__
+            digests = [base.__dict__['_CHEETAH_sourceDigest'][:16]
+                       for base in klass.__mro__
+                       if base.__dict__.get('_CHEETAH_sourceDigest')]
+            if not digests:
+                return klass.__module__ + '.' + klass.__name__
+            return '_'.join([klass.__name__] + digests)
         else:
             return str(id(self))
 
     def _createCacheRegion(self, regionID):
-        return self._CHEETAH_cacheRegionClass(
+        if self._CHEETAH_shareCacheRegions:
+            cacheRegionClass = self._CHEETAH_sharedCacheRegionClass
+        else:
+            cacheRegionClass = self._CHEETAH_cacheRegionClass
+        return cacheRegionClass(
             regionID=regionID,
             templateCacheIdPrefix=self._getCacheStoreIdPrefix(),
             cacheStore=self._getCacheStore())
 
     def getCacheRegion(self, regionID, cacheInfo=None, create=True):
         cacheRegion = self._CHEETAH__cacheRegions.get(regionID)
+        if not cacheRegion and create and self._CHEETAH_shareCacheRegions \
+                and not self._CHEETAH__cacheRegions:
+            self._prefetchCacheRegions()
+            cacheRegion = self._CHEETAH__cacheRegions.get(regionID)
         if not cacheRegion and create:
             cacheRegion = self._createCacheRegion(regionID)
             self._CHEETAH__cacheRegions[regionID] = cacheRegion
         return cacheRegion
 
+    def _prefetchCacheRegions(self):
+        # the regions of the class and its base classes (#extends)
+        cacheItems = []
+        for klass in self.__class__.__mro__:
+            for regionID in klass.__dict__.get('_CHEETAH_cacheRegionIDs', ()):
+                if regionID not in self._CHEETAH__cacheRegions:
+                    cacheRegion = self._createCacheRegion(regionID)
+                    self._CHEETAH__cacheRegions[regionID] = cacheRegion
+                    cacheItems.append(cacheRegion.getCacheItem(regionID))
+        prefetchCacheItems(cacheItems)
+
     def getCacheRegions(self):
         """Returns a dictionary of the 'cache regions' initialized in a
         template.
@@ -1505,12 +1818,35 @@ class Template(Servlet):
         to load local files.  This method could be reimplemented
         to allow reading of remote files via various protocols,
         as PHP allows with its 'URL fopen wrapper'.
+
+        The contents are cached in _CHEETAH_fileContentsCache, shared by
+        all instances, and read again when the modification time or the
+        size of the file changes.  After checkFileMtime(False) a cached
+        file is not checked at all until clearFileContentsCache() is called.
         """
+        cacheItem = self._CHEETAH_fileContentsCache.get(path)
+        if cacheItem is not None and not globals()['__checkFileMtime']:
+            return cacheItem.code
+        stat = os.stat(path)
+        if cacheItem is not None and \
+                cacheItem.stat == (stat.st_mtime, stat.st_size):
+            return cacheItem.code
         fp = open(path, 'r')
         output = fp.read()
         fp.close()
+        cacheItem = CompileCacheItem()
+        cacheItem.stat = (stat.st_mtime, stat.st_size)
+        cacheItem.code = output
+        self._CHEETAH_fileContentsCache[path] = cacheItem
         return output
 
+    @classmethod
+    def clearFileContentsCache(klass):
+        """Forget the contents of the files cached by getFileContents(),
+        e.g. after files changed while checkFileMtime(False) was in effect.
+        """
+        klass._CHEETAH_fileContentsCache.clear()
+
     def runAsMainProgram(self):
         """Allows the Template to function as a standalone command-line program
         for static page generation.
@@ -1521,9 +1857,60 @@ class Template(Servlet):
         from .TemplateCmdLineIface import CmdLineIface
         CmdLineIface(templateObj=self).run()
 
+    def iterRespond(self, chunkSize=8192, methodName=None):
+        """Render the template incrementally: return an iterator over
+        chunks of the output of about chunkSize characters that are
+        produced while the main method (or the method methodName)
+        is still running, instead of the whole output joined at once.
+
+        The iterator can be returned from a WSGI application::
+
+            def application(environ, start_response):
+                start_response('200 OK', [('Content-Type', 'text/html')])
+                for chunk in Template(file=path).iterRespond():
+                    yield chunk.encode('utf-8')
+
+        The template is rendered in a helper thread started for every
+        call (see DummyTransaction.StreamingTransaction), which costs more
+        than respond() for small templates and needs searchList objects
+        that can be used from another thread.  Close the iterator when not
+        all of it is consumed to stop the rendering.
+        """
+        trans = StreamingTransaction(chunkSize=chunkSize)
+        return trans.stream(self._getMainMethod(methodName))
+
+    def respondToFile(self, fileobj, encoding=None, methodName=None):
+        """Render the template straight into a file-like object (an open
+        file, io.StringIO, io.BytesIO...) instead of collecting the output
+        and returning it.  If encoding is given the output is encoded
+        while it is written (for files opened in binary mode).
+        """
+        trans = FileTransaction(fileobj, encoding=encoding)
+        self._getMainMethod(methodName)(trans=trans)
+        trans.response().flush()
+
+    def _getMainMethod(self, methodName=None):
+        if methodName is None:
+            methodName = getattr(
+                self, '_mainCheetahMethod_for_' + self.__class__.__name__,
+                'respond')
+        return getattr(self, methodName)
+
     ##################################################
     # internal methods -- not to be called by end-users
 
+    def _setCurrentFilter(self, filter):
+        """Switch to the filter (the filter() method of a filter instance)
+        for a #filter directive and return it.  A filter instance with a
+        filterSwitched() method (e.g. Filters.MemoizingFilter) is told
+        that a filter region starts."""
+        self._CHEETAH__currentFilter = filter
+        filterSwitched = getattr(getattr(filter, '__self__', None),
+                                 'filterSwitched', None)
+        if filterSwitched is not None:
+            filterSwitched()
+        return filter
+
     def _initCheetahInstance(self,
                              searchList=None,
                              namespaces=None,
@@ -1555,7 +1942,10 @@ class Template(Servlet):
                 and not isinstance(searchList, (list, tuple)):
             searchList = [searchList]
 
-        self._CHEETAH__globalSetVars = {}
+        if self._CHEETAH_useNameMapperCache:
+            self._CHEETAH__globalSetVars = WatchedDict()
+        else:
+            self._CHEETAH__globalSetVars = {}
         if _globalSetVars is not None:
             # this is intended to be used internally by Nested Templates
             # in #include's
@@ -1575,6 +1965,14 @@ class Template(Servlet):
                         self._CHEETAH__searchList
                 else:
                     self._CHEETAH__searchList.extend(list(searchList))
+        if self._CHEETAH_useNameMapperCache:
+            # The cache is invalidated when the searchList is changed or
+            # a #set global variable is added (#include'd templates share
+            # the globalSetVars of the including template)
+            watch = [namespace for namespace in self._CHEETAH__searchList
+                     if isinstance(namespace, WatchedDict)]
+            self._CHEETAH__searchList = SearchList(
+                self._CHEETAH__searchList, watch=watch)
         self._CHEETAH__cheetahIncludes = {}
         self._CHEETAH__cacheRegions = {}
         self._CHEETAH__indenter = Indenter()
@@ -1686,8 +2084,12 @@ class Template(Servlet):
                 compiler = \
                     self._getTemplateAPIClassForIncludeDirectiveCompilation(
                         source, file)
-                nestedTemplateClass = compiler.compile(source=source,
-                                                       file=file)
+                if isinstance(file, string_type):
+                    nestedTemplateClass = \
+                        self._getIncludedTemplateClass(compiler, file)
+                else:
+                    nestedTemplateClass = compiler.compile(source=source,
+                                                           file=file)
                 nestedTemplate = nestedTemplateClass(
                     _preBuiltSearchList=self.searchList(),
                     _globalSetVars=self._CHEETAH__globalSetVars)
@@ -1713,6 +2115,37 @@ class Template(Servlet):
         else:
             trans.response().write(self._CHEETAH__cheetahIncludes[_includeID])
 
+    def _getIncludedTemplateClass(self, compiler, path):
+        """Return the class of the file path compiled by the Template
+        subclass compiler for an #include directive.
+
+        The classes are cached in _CHEETAH_includeCache keyed by the
+        compiler and the path, so the instances of a template do not compile
+        their included files again.  A file modified since it was compiled
+        is compiled again unless checkFileMtime(False) has been called.
+        The cache only keeps weak references to the compiler and the
+        class: a class evicted from the compiler's _CHEETAH_compileCache
+        is freed once no instance uses it.
+        """
+        if not compiler._CHEETAH_cacheCompilationResults:
+            return compiler.compile(file=path)
+        mtime = None
+        if globals()['__checkFileMtime']:
+            mtime = os.path.getmtime(path)
+        key = (weakref.ref(compiler), path)
+        cacheItem = self._CHEETAH_includeCache.get(key)
+        if cacheItem is not None and (mtime is None
+                                      or cacheItem.mtime == mtime):
+            templateClass = cacheItem.classRef()
+            if templateClass is not None:
+                return templateClass
+        templateClass = compiler.compile(file=path)
+        cacheItem = CompileCacheItem()
+        cacheItem.mtime = mtime
+        cacheItem.classRef = weakref.ref(templateClass)
+        self._CHEETAH_includeCache[key] = cacheItem
+        return templateClass
+
     def _getTemplateAPIClassForIncludeDirectiveCompilation(self, source, file):
         """Returns the subclass of Template which should be used to compile
         #include directives.
@@ -0,0 +1,204 @@
+'''
+Bundles of precompiled templates.
+
+A bundle is a single file with the compiled code objects of a whole tree of
+templates and a manifest of the modules in it.  It is created with
+
+  cheetah compile --bundle=templates.bundle -R --idir=templates
+
+and used with
+
+  from Cheetah.TemplateBundle import TemplateBundle
+  bundle = TemplateBundle('templates.bundle')
+  bundle.install()  # `import views.index` now imports from the bundle
+  klass = bundle.getClass('views.index')
+
+Loading a bundle reads one file; nothing is parsed or compiled and the code
+of a template is unmarshalled and executed only when its module is first
+imported (or requested with getModule()/getClass()).  Directories of the
+template tree are packages; the modules of the bundle take precedence over
+modules with the same names found on sys.path while the bundle is
+installed.
+
+The code objects are specific to the Python version that created the
+bundle; loading a bundle created by a different Python raises
+PythonVersionError.
+'''
+
+import marshal
+import sys
+import types
+from threading import RLock
+try:
+    from importlib.util import spec_from_loader
+except ImportError:  # PY2
+    spec_from_loader = None
+
+from .CompileCache import _pythonTag
+from .Version import Version
+
+_BUNDLE_FORMAT = 'Cheetah template bundle 1'
+
+
+class Error(Exception):
+    pass
+
+
+class PythonVersionError(Error):
+    """The bundle was created by a different Python."""
+    pass
+
+
+def writeBundle(path, modules):
+    '''Write a bundle of the modules to the file path.
+
+    modules is an iterable of (moduleName, className, codeObject) tuples;
+    moduleName is the dotted name the module will be imported as.
+    '''
+    manifest = {}
+    codes = {}
+    for moduleName, className, code in modules:
+        if moduleName in manifest:
+            raise Error('Duplicate module %s in bundle %s'
+                        % (moduleName, path))
+        manifest[moduleName] = {'className': className,
+                                'filename': code.co_filename}
+        codes[moduleName] = marshal.dumps(code)
+    packages = set()
+    for moduleName in manifest:
+        parts = moduleName.split('.')[:-1]
+        for i in range(len(parts)):
+            packages.add('.'.join(parts[:i + 1]))
+    collisions = packages.intersection(manifest)
+    if collisions:
+        raise Error('Modules %s are also packages in bundle %s'
+                    % (', '.join(sorted(collisions)), path))
+    # The header is plain text so that any Python can tell
+    # which Python created the bundle
+    header = '%s\n%s\n' % (_BUNDLE_FORMAT, _pythonTag())
+    data = marshal.dumps((Version, manifest, sorted(packages), codes))
+    with open(path, 'wb') as bundleFile:
+        bundleFile.write(header.encode('ascii'))
+        bundleFile.write(data)
+
+
+class TemplateBundle(object):
+    '''The templates of a bundle file, loaded lazily.
+
+    install() registers the bundle as an import hook (a finder in
+    sys.meta_path) so templates can import each other (#extends, #import)
+    and be imported by application code.
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        with open(path, 'rb') as bundleFile:
+            bundleFormat = bundleFile.readline().rstrip(b'\n')
+            pythonTag = bundleFile.readline().rstrip(b'\n')
+            data = bundleFile.read()
+        if bundleFormat != _BUNDLE_FORMAT.encode('ascii'):
+            raise Error('%s is not a template bundle' % path)
+        pythonTag = pythonTag.decode('ascii', 'replace')
+        if pythonTag != _pythonTag():
+            raise PythonVersionError(
+                'Template bundle %s was created by %s, not %s'
+                % (path, pythonTag, _pythonTag()))
+        try:
+            cheetahVersion, manifest, packages, codes = marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            raise Error('%s is not a template bundle' % path)
+        self._manifest = manifest
+        self._packages = set(packages)
+        self._codes = codes
+        self._lock = RLock()
+
+    def path(self):
+        return self._path
+
+    def moduleNames(self):
+        return sorted(self._manifest)
+
+    def __contains__(self, moduleName):
+        return moduleName in self._manifest
+
+    def getModule(self, moduleName):
+        '''Return the module, importing it from the bundle if needed.'''
+        if moduleName not in self._manifest:
+            raise KeyError(moduleName)
+        parts = moduleName.split('.')
+        for i in range(len(parts)):
+            module = self.load_module('.'.join(parts[:i + 1]))
+        return module
+
+    def getClass(self, moduleName):
+        '''Return the template class of the module.'''
+        return getattr(self.getModule(moduleName),
+                       self._manifest[moduleName]['className'])
+
+    # import hook
+
+    def install(self):
+        '''Import the modules of the bundle from the bundle.'''
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def _isPackage(self, fullname):
+        return fullname in self._packages
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname not in self._manifest and fullname not in self._packages:
+            return None
+        return spec_from_loader(fullname, self,
+                                origin=self._origin(fullname),
+                                is_package=self._isPackage(fullname))
+
+    def create_module(self, spec):
+        return None  # the default module
+
+    def exec_module(self, module):
+        fullname = module.__name__
+        if self._isPackage(fullname):
+            return
+        module.__file__ = self._origin(fullname)
+        code = marshal.loads(self._codes[fullname])
+        exec(code, module.__dict__)
+
+    def _origin(self, fullname):
+        if self._isPackage(fullname):
+            return None
+        return self._manifest[fullname]['filename']
+
+    # PEP 302 import hook protocol for Python 2;
+    # load_module() is also used by getModule()
+
+    def find_module(self, fullname, path=None):
+        if fullname in self._manifest or fullname in self._packages:
+            return self
+        return None
+
+    def load_module(self, fullname):
+        with self._lock:
+            module = sys.modules.get(fullname)
+            if module is not None:
+                return module
+            module = types.ModuleType(fullname)
+            module.__loader__ = self
+            if self._isPackage(fullname):
+                module.__path__ = []
+                module.__package__ = fullname
+            else:
+                module.__package__ = fullname.rpartition('.')[0]
+            sys.modules[fullname] = module
+            try:
+                self.exec_module(module)
+            except BaseException:
+                del sys.modules[fullname]
+                raise
+            parent, _, name = fullname.rpartition('.')
+            if parent in sys.modules:
+                setattr(sys.modules[parent], name, module)
+            return module
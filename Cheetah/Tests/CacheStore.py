@@ -0,0 +1,429 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from Cheetah import CacheStore
+from Cheetah.CacheRegion import SharedCacheRegion
+from Cheetah.Template import Template
+
+
+class MemoryCacheStoreTest(unittest.TestCase):
+    def test_setGet(self):
+        store = CacheStore.MemoryCacheStore()
+        store.set('a', 1)
+        self.assertEqual(store.get('a'), 1)
+        self.assertRaises(KeyError, store.get, 'b')
+        store.set('b', 2, time=1)  # expired long ago
+        self.assertRaises(KeyError, store.get, 'b')
+        store.delete('a')
+        self.assertRaises(KeyError, store.get, 'a')
+
+    def test_maxEntries(self):
+        store = CacheStore.MemoryCacheStore(maxEntries=2)
+        store.set('a', 1)
+        store.set('b', 2)
+        store.set('a', 3)
+        store.set('c', 4)
+        self.assertRaises(KeyError, store.get, 'b')
+        self.assertEqual(store.get('a'), 3)
+        self.assertEqual(store.get('c'), 4)
+
+    def test_addReplace(self):
+        store = CacheStore.MemoryCacheStore()
+        self.assertRaises(CacheStore.Error, store.replace, 'a', 1)
+        store.add('a', 1)
+        self.assertRaises(CacheStore.Error, store.add, 'a', 2)
+        store.replace('a', 3)
+        self.assertEqual(store.get('a'), 3)
+        store.set('b', 1, time=1)  # expired
+        self.assertRaises(CacheStore.Error, store.replace, 'b', 2)
+        store.add('b', 4)
+        self.assertEqual(store.get('b'), 4)
+
+    def test_lru(self):
+        store = CacheStore.MemoryCacheStore(maxEntries=2)
+        store.set('a', 1)
+        store.set('b', 2)
+        store.get('a')
+        store.set('c', 3)
+        self.assertRaises(KeyError, store.get, 'b')
+        self.assertEqual(store.get('a'), 1)
+
+    def test_maxSize(self):
+        store = CacheStore.MemoryCacheStore(maxSize=10)
+        store.set('a', 'x' * 4)
+        store.set('b', 'x' * 4)
+        store.set('c', 'x' * 4)
+        self.assertRaises(KeyError, store.get, 'a')
+        self.assertEqual(store.stats()['size'], 8)
+        store.set('d', 'x' * 20)  # too big to keep at all
+        self.assertEqual(store.stats()['entries'], 0)
+        self.assertEqual(store.stats()['size'], 0)
+
+    def test_sharedCacheItemSize(self):
+        store = CacheStore.MemoryCacheStore(maxSize=150000)
+        klass = Template.compile('#cache\n$a\n#end cache\n',
+                                 cacheCompilationResults=False)
+        klass._CHEETAH_shareCacheRegions = True
+        klass._CHEETAH_cacheStore = store
+        str(klass(searchList=[{'a': 'x' * 100000}]))
+        self.assertEqual(store.stats()['size'], 100001)
+        store.set('b', ('y' * 100000, 1.5, None))
+        self.assertEqual(store.stats()['entries'], 1)
+        self.assertEqual(store.stats()['evictions'], 1)
+
+    def test_sweep(self):
+        store = CacheStore.MemoryCacheStore(sweepInterval=0)
+        store.set('a', 'x', time=1)
+        store.set('b', 'y', time=1)
+        # the second set() swept 'a'
+        self.assertEqual(store.stats()['entries'], 1)
+        self.assertEqual(store.sweep(), 1)
+        self.assertEqual(store.stats()['entries'], 0)
+        self.assertEqual(store.stats()['expirations'], 2)
+
+    def test_stats(self):
+        store = CacheStore.MemoryCacheStore(maxEntries=1)
+        store.set('a', 'xyz')
+        store.get('a')
+        self.assertRaises(KeyError, store.get, 'b')
+        store.set('b', 'xy')
+        self.assertEqual(store.stats(), {
+            'hits': 1, 'misses': 1, 'evictions': 1, 'expirations': 0,
+            'entries': 1, 'size': 2})
+        store.delete('b')
+        self.assertRaises(KeyError, store.delete, 'b')
+        self.assertEqual(store.stats()['size'], 0)
+
+    def test_sharedCacheStore(self):
+        store = CacheStore.getSharedCacheStore()
+        self.assertTrue(isinstance(store, CacheStore.MemoryCacheStore))
+        self.assertTrue(CacheStore.getSharedCacheStore() is store)
+
+
+class SQLiteCacheStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpDir, 'cache.sqlite')
+        self.store = CacheStore.SQLiteCacheStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpDir)
+
+    def test_setGet(self):
+        store = self.store
+        store.set('a', u'\u1234')
+        store.set('b', [1, 2])
+        self.assertEqual(store.get('a'), u'\u1234')
+        self.assertEqual(store.get('b'), [1, 2])
+        self.assertRaises(KeyError, store.get, 'c')
+        store.set('b', 2, time=1)  # expired long ago
+        self.assertRaises(KeyError, store.get, 'b')
+        store.delete('a')
+        self.assertRaises(KeyError, store.get, 'a')
+        self.assertRaises(KeyError, store.delete, 'a')
+
+    def test_addReplace(self):
+        store = self.store
+        self.assertRaises(CacheStore.Error, store.replace, 'a', 1)
+        store.add('a', 1)
+        self.assertRaises(CacheStore.Error, store.add, 'a', 2)
+        store.replace('a', 3)
+        self.assertEqual(store.get('a'), 3)
+        store.set('b', 1, time=1)  # expired
+        self.assertRaises(CacheStore.Error, store.replace, 'b', 2)
+        store.add('b', 4)
+        self.assertEqual(store.get('b'), 4)
+
+    def test_sweep(self):
+        self.store.set('a', 1, time=1)
+        self.store.set('b', 1)
+        self.assertEqual(self.store.sweep(), 1)
+        self.assertEqual(self.store.get('b'), 1)
+        self.store.clear()
+        self.assertRaises(KeyError, self.store.get, 'b')
+
+    def test_processes(self):
+        subprocess.check_call([
+            sys.executable, '-c',
+            'from Cheetah.CacheStore import SQLiteCacheStore; '
+            'SQLiteCacheStore(%r).set("a", "from another process")'
+            % self.path])
+        self.assertEqual(self.store.get('a'), 'from another process')
+
+    def test_template(self):
+        klass = Template.compile(
+            '#cache timer=5m\n$a\n#end cache\n',
+            cacheCompilationResults=False)
+        klass._CHEETAH_shareCacheRegions = True
+        klass._CHEETAH_cacheStore = self.store
+        self.assertEqual(str(klass(searchList=[{'a': 1}])), '1\n')
+        klass._CHEETAH_cacheStore = store = \
+            CacheStore.SQLiteCacheStore(self.path)
+        self.assertEqual(str(klass(searchList=[{'a': 2}])), '1\n')
+        store.close()
+
+
+class SharedCacheRegionsTest(unittest.TestCase):
+    source = '''#cache timer=5m
+$a
+#end cache
+$a
+'''
+
+    def setUp(self):
+        CacheStore.getSharedCacheStore().clear()
+
+    tearDown = setUp
+
+    def compile(self, **attributes):
+        klass = Template.compile(self.source, cacheCompilationResults=False)
+        for name, value in attributes.items():
+            setattr(klass, '_CHEETAH_' + name, value)
+        return klass
+
+    def test_unshared(self):
+        klass = self.compile()
+        self.assertEqual(str(klass(searchList=[{'a': 1}])), '1\n1\n')
+        self.assertEqual(str(klass(searchList=[{'a': 2}])), '2\n2\n')
+
+    def test_shared(self):
+        klass = self.compile(shareCacheRegions=True)
+        template = klass(searchList=[{'a': 1}])
+        self.assertEqual(str(template), '1\n1\n')
+        self.assertTrue(isinstance(
+            list(template.getCacheRegions().values())[0], SharedCacheRegion))
+        self.assertEqual(str(klass(searchList=[{'a': 2}])), '1\n2\n')
+        # recompiling the template yields the same cache regions
+        klass = self.compile(shareCacheRegions=True)
+        template = klass(searchList=[{'a': 3}])
+        self.assertEqual(str(template), '1\n3\n')
+        template.refreshCache()
+        self.assertEqual(str(template), '3\n3\n')
+        self.assertEqual(str(klass(searchList=[{'a': 4}])), '3\n4\n')
+
+    def test_sameClassName(self):
+        classes = []
+        for name in ('A', 'B'):
+            klass = Template.compile(
+                '#cache id="sidebar"\nSIDEBAR %s\n#end cache\n' % name,
+                className='index', cacheCompilationResults=False)
+            klass._CHEETAH_shareCacheRegions = True
+            classes.append(klass)
+        self.assertEqual(str(classes[0]()), 'SIDEBAR A\n')
+        self.assertEqual(str(classes[1]()), 'SIDEBAR B\n')
+
+    def test_cacheStore(self):
+        store = CacheStore.MemoryCacheStore()
+        klass = self.compile(shareCacheRegions=True, cacheStore=store)
+        self.assertEqual(str(klass(searchList=[{'a': 1}])), '1\n1\n')
+        self.assertEqual(str(klass(searchList=[{'a': 2}])), '1\n2\n')
+        self.assertEqual(len(store._data), 1)
+        self.assertRaises(KeyError, CacheStore.getSharedCacheStore()._data
+                          .__getitem__, list(store._data)[0])
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        CacheStore.getSharedCacheStore().clear()
+        self.renderings = 0
+        self.rendering = threading.Event()
+        self.release = threading.Event()
+
+    tearDown = setUp
+
+    def render(self):
+        self.renderings += 1
+        self.rendering.set()
+        self.release.wait(5)
+        return self.renderings
+
+    def compile(self, cacheArgs):
+        return Template.compile(
+            '#cache %s\n$render()\n#end cache\n' % cacheArgs,
+            cacheCompilationResults=False)
+
+    def startThreads(self, template, number):
+        results = []
+
+        def target():
+            results.append(str(template))
+
+        threads = [threading.Thread(target=target) for i in range(number)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_lock(self):
+        template = self.compile("timer='5m', lock=True")(
+            searchList=[self])
+        threads, results = self.startThreads(template, 4)
+        self.rendering.wait(5)
+        time.sleep(0.1)  # let the other threads wait for the lock
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['1\n'] * 4)
+        self.assertEqual(self.renderings, 1)
+
+    def test_noLock(self):
+        template = self.compile("timer='5m'")(searchList=[self])
+        self.release.set()
+        threads, results = self.startThreads(template, 2)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(str(template), results[-1])
+
+    def test_stale(self):
+        klass = self.compile("timer='0.2s', stale='5m'")
+        klass._CHEETAH_shareCacheRegions = True
+        self.release.set()
+        self.assertEqual(str(klass(searchList=[self])), '1\n')
+        time.sleep(0.3)  # expired, not yet for good
+        self.rendering.clear()
+        self.release.clear()
+        threads, results = self.startThreads(klass(searchList=[self]), 1)
+        self.rendering.wait(5)
+        # another instance gets the stale output while it is refreshed
+        self.assertEqual(str(klass(searchList=[self])), '1\n')
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['2\n'])
+        self.assertEqual(str(klass(searchList=[self])), '2\n')
+        self.assertEqual(self.renderings, 2)
+
+
+class FakeMemcachedClient(object):
+    '''An in-process stand-in for memcache.Client'''
+
+    def __init__(self, servers, debug=False, data=None):
+        self.servers = servers
+        self.data = {} if data is None else data
+        self.calls = []
+
+    def set(self, key, val, time=0):
+        self.calls.append('set')
+        self.data[key] = val
+        return True
+
+    def add(self, key, val, time=0):
+        self.calls.append('add')
+        if key in self.data:
+            return False
+        self.data[key] = val
+        return True
+
+    def replace(self, key, val, time=0):
+        self.calls.append('replace')
+        if key not in self.data:
+            return False
+        self.data[key] = val
+        return True
+
+    def delete(self, key, time=0):
+        self.calls.append('delete')
+        return int(self.data.pop(key, None) is not None)
+
+    def get(self, key):
+        self.calls.append('get')
+        return self.data.get(key)
+
+    def get_multi(self, keys):
+        self.calls.append('get_multi')
+        return dict((key, self.data[key]) for key in keys
+                    if key in self.data)
+
+    def flush_all(self):
+        self.data.clear()
+
+
+class FakeMemcachedCacheStore(CacheStore.MemcachedCacheStore):
+    def __init__(self, *args, **kw):
+        self.data = {}
+        self.clients = []
+        super(FakeMemcachedCacheStore, self).__init__(*args, **kw)
+
+    def _newClient(self):
+        client = FakeMemcachedClient(self._servers, data=self.data)
+        self.clients.append(client)
+        return client
+
+    def calls(self):
+        return sum([client.calls for client in self.clients], [])
+
+
+class MemcachedCacheStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = FakeMemcachedCacheStore()
+
+    def test_operations(self):
+        store = self.store
+        self.assertRaises(CacheStore.Error, store.replace, 'a', 1)
+        store.add('a', 1)
+        self.assertRaises(CacheStore.Error, store.add, 'a', 2)
+        store.replace('a', 3)
+        self.assertEqual(store.get('a'), 3)
+        store.set('b', 4)
+        self.assertEqual(store.getMulti(['a', 'b', 'c']), {'a': 3, 'b': 4})
+        store.delete('a')
+        self.assertRaises(KeyError, store.get, 'a')
+        self.assertRaises(KeyError, store.delete, 'a')
+        store.clear()
+        self.assertRaises(KeyError, store.get, 'b')
+        # the operations used the one client created by __init__
+        self.assertEqual(len(store.clients), 1)
+
+    def test_threads(self):
+        errors = []
+
+        def target(i):
+            try:
+                for j in range(100):
+                    self.store.set('%s-%s' % (i, j), j)
+                    assert self.store.get('%s-%s' % (i, j)) == j
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=target, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.store.data), 800)
+        self.assertEqual(len(self.store.clients), 1)
+
+    def test_prefetch(self):
+        klass = Template.compile('''#cache timer=5m
+$a
+#end cache
+#cache id='second'
+$a
+#end cache
+#def third
+#cache
+$a
+#end cache
+#end def
+$third
+#cache varyBy=$a
+$a
+#end cache
+''', cacheCompilationResults=False)
+        klass._CHEETAH_shareCacheRegions = True
+        klass._CHEETAH_cacheStore = self.store
+        self.assertEqual(len(klass._CHEETAH_cacheRegionIDs), 3)
+        self.assertEqual(str(klass(searchList=[{'a': 1}])), '1\n1\n1\n\n1\n')
+        del self.store.clients[0].calls[:]
+        self.assertEqual(str(klass(searchList=[{'a': 2}])), '1\n1\n1\n\n2\n')
+        # one get_multi() for the 3 regions, a get() for the varyBy one
+        self.assertEqual(sorted(self.store.calls()),
+                         ['get', 'get_multi', 'set'])
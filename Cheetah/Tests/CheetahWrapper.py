@@ -25,6 +25,7 @@ import json
 
 from optparse import OptionParser
 from Cheetah.CheetahWrapper import CheetahWrapper  # Used by NoBackup.
+from Cheetah.TemplateBundle import TemplateBundle, PythonVersionError
 
 try:
     from subprocess import Popen, PIPE, STDOUT
@@ -641,6 +642,44 @@ Found %(result)r"""
         self.checkFill('pickle.txt')
 
 
+class IdirBundle(CFIdirBase):
+    """Compile a tree of templates to a bundle file."""
+    subdirs = ('SRC/bundlechild',)
+    srcFiles = ('SRC/bundletop.tmpl', 'SRC/bundlechild/bundlekid.tmpl')
+    moduleNames = ['bundlechild', 'bundlechild.bundlekid', 'bundletop']
+
+    def tearDown(self):
+        for name in self.moduleNames:
+            sys.modules.pop(name, None)
+        super(IdirBundle, self).tearDown()
+
+    def testCompile(self):
+        self.go("cheetah compile -R --idir SRC --bundle templates.bundle")
+        self.assertFalse(os.path.exists('bundletop.py'))
+        try:
+            bundle = TemplateBundle('templates.bundle')
+        except PythonVersionError as e:
+            # the cheetah script runs a different Python than the tests
+            self.skipTest(str(e))
+        self.assertEqual(bundle.moduleNames(), self.moduleNames[1:])
+        self.assertEqual(str(bundle.getClass('bundlechild.bundlekid')()),
+                         'Hello, world!\n')
+        bundle.install()
+        try:
+            from bundletop import bundletop
+        finally:
+            bundle.uninstall()
+        self.assertEqual(str(bundletop()), 'Hello, world!\n')
+
+    def testBadName(self):
+        os.mkdir('SRC/bad-name')
+        with open('SRC/bad-name/a.tmpl', 'w') as f:
+            f.write("Hello, world!\n")
+        self.assertSubprocess(
+            "cheetah compile -R --idir SRC --bundle templates.bundle",
+            nonzero=True)
+
+
 def listTests(cheetahWrapperFile):
     """cheetahWrapperFile, string, path of this script.
 
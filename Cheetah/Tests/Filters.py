@@ -1,6 +1,9 @@
 import unittest
+from decimal import Decimal
+
 import Cheetah.Template
 import Cheetah.Filters
+from Cheetah.compat import unicode
 
 
 class BasicMarkdownFilterTest(unittest.TestCase):
@@ -58,3 +61,140 @@ def foo(self):
             template, searchList=[{'foo': 'bar'}])
         template = str(template)
         assert template, (template, 'We should have some content here...')
+
+
+class StandardFiltersTest(unittest.TestCase):
+    '''
+        Test the standard filters against the pure-python implementation
+        (they are the same unless the C version is available)
+    '''
+    values = [None, 1, 1.5, u'', u'abc', u'<a href="x">&amp; \u1234</a>',
+              u'x' * 100]
+
+    def check(self, filterClass, pyMethod, **kw):
+        theFilter = filterClass()
+        pyFilter = Cheetah.Filters._PyFilterBase()
+        for val in self.values:
+            result = theFilter.filter(val, **kw)
+            self.assertEqual(result, pyMethod(pyFilter, val, **kw))
+            self.assertTrue(isinstance(result, unicode))
+
+    def test_Filter(self):
+        self.check(Cheetah.Filters.Filter,
+                   Cheetah.Filters._PyFilterBase.filter)
+
+    def test_MaxLen(self):
+        for maxlen in (0, 3, 100, 200):
+            self.check(Cheetah.Filters.MaxLen,
+                       Cheetah.Filters._PyFilterBase._maxLen, maxlen=maxlen)
+        self.check(Cheetah.Filters.MaxLen,
+                   Cheetah.Filters._PyFilterBase._maxLen)
+
+    def test_WebSafe(self):
+        for also in (u' "', u'&', u'a&', u'\u1234#', [u' ', u'x'], u''):
+            self.check(Cheetah.Filters.WebSafe,
+                       Cheetah.Filters._PyFilterBase._webSafe, also=also)
+        self.check(Cheetah.Filters.WebSafe,
+                   Cheetah.Filters._PyFilterBase._webSafe)
+
+    def test_WebSafeEntities(self):
+        self.assertEqual(Cheetah.Filters.WebSafe().filter(
+            u'<a b="c">', also=u' "'), u'&lt;a&nbsp;b=&quot;c&quot;&gt;')
+        self.assertEqual(Cheetah.Filters.WebSafe().filter(u'a&b', also=u'&'),
+                         u'a&#38;amp;b')
+
+    def test_WebSafeReplacements(self):
+        webSafe = Cheetah.Filters.WebSafe()
+        for i in range(2):  # the second time from the cache
+            self.assertEqual(webSafe.filter(u'a <b> "c"'), u'a &lt;b&gt; "c"')
+            self.assertEqual(webSafe.filter(u'a <b> "c"', also=[u'"', u'a']),
+                             u'&#97; &lt;b&gt; &quot;c&quot;')
+            self.assertEqual(webSafe.filter(u'a <b>', also=u't'),
+                             u'a &l&#116;;b&g&#116;;')
+            self.assertEqual(webSafe.filter(u'clean'), u'clean')
+
+    def test_MRO(self):
+        class Upper(Cheetah.Filters.Filter):
+            def filter(self, val, **kw):
+                return super(Upper, self).filter(val, **kw).upper()
+
+        class UpperWebSafe(Cheetah.Filters.WebSafe, Upper):
+            pass
+
+        class UpperMaxLen(Cheetah.Filters.MaxLen, Upper):
+            pass
+
+        self.assertEqual(UpperWebSafe().filter(u'<b>'), u'&lt;B&gt;')
+        self.assertEqual(UpperMaxLen().filter(u'abc', maxlen=2), u'AB')
+
+        class QuotingWebSafe(Cheetah.Filters.WebSafe):
+            def filter(self, val, **kw):
+                return u'"%s"' % super(QuotingWebSafe, self).filter(
+                    val, **kw)
+
+        self.assertEqual(QuotingWebSafe().filter(u'<b>'), u'"&lt;b&gt;"')
+
+    def test_Template(self):
+        template = Cheetah.Template.Template(
+            '#filter WebSafe\n$foo ${foo, also=" "} $bar\n#end filter\n',
+            searchList=[{'foo': '<a b>', 'bar': None}])
+        self.assertEqual(str(template), '&lt;a b&gt; &lt;a&nbsp;b&gt; \n')
+
+
+class CountingFilter(Cheetah.Filters.Filter):
+    calls = 0
+
+    def filter(self, val, **kw):
+        CountingFilter.calls += 1
+        return u'<%s>' % super(CountingFilter, self).filter(val, **kw)
+
+
+class MemoizingFilterTest(unittest.TestCase):
+    def setUp(self):
+        CountingFilter.calls = 0
+        self.filter = Cheetah.Filters.memoize(CountingFilter, maxSize=3)()
+
+    def test_memoize(self):
+        self.assertEqual(self.filter.__class__.__name__,
+                         'MemoizedCountingFilter')
+        for i in range(2):
+            self.assertEqual(self.filter.filter(u'a'), u'<a>')
+            self.assertEqual(self.filter.filter(1), u'<1>')
+            self.assertEqual(self.filter.filter(Decimal(1)), u'<1>')
+        self.assertEqual(CountingFilter.calls, 3)
+        # placeholders with the same value share the cached output
+        self.assertEqual(self.filter.filter(u'a', rawExpr=u'$a'), u'<a>')
+        self.assertEqual(self.filter.filter(u'a', rawExpr=u'$b'), u'<a>')
+        self.assertEqual(CountingFilter.calls, 3)
+        self.assertEqual(self.filter.filter(u'a', rawExpr=u'$a', maxlen=1),
+                         u'<a>')
+        self.assertEqual(CountingFilter.calls, 4)
+
+    def test_notMemoized(self):
+        for i in range(2):
+            self.assertEqual(self.filter.filter(None), u'<>')
+            self.assertEqual(self.filter.filter(1.5), u'<1.5>')
+            self.assertEqual(self.filter.filter(u'a', also=[u'b']), u'<a>')
+        self.assertEqual(CountingFilter.calls, 6)
+
+    def test_maxSize(self):
+        for val in (1, 2, 3, 1, 4, 1, 2):
+            self.filter.filter(val)
+        # 2 was evicted by 4, 3 was the least recently used
+        self.assertEqual(CountingFilter.calls, 5)
+        self.filter.filter(3)
+        self.assertEqual(CountingFilter.calls, 6)
+
+    def test_filterSwitch(self):
+        template = Cheetah.Template.Template(
+            '$a$a#filter WebSafe#$a#end filter#$a$a',
+            searchList=[{'a': 'x'}], filter=self.filter.__class__)
+        self.assertEqual(str(template), '<x><x>x<x><x>')
+        # the cache was cleared when the #filter region ended
+        self.assertEqual(CountingFilter.calls, 2)
+        # the cache is kept between renderings up to the next #filter
+        self.assertEqual(str(template), '<x><x>x<x><x>')
+        self.assertEqual(CountingFilter.calls, 3)
+        # a plain instance attribute, not a property
+        self.assertIs(template._CHEETAH__currentFilter,
+                      template.__dict__['_CHEETAH__currentFilter'])
@@ -3,7 +3,7 @@ import unittest
 
 from Cheetah.NameMapper import NotFound, \
     valueForName, valueFromSearchList, valueFromFrame, \
-    valueFromFrameOrSearchList
+    valueFromFrameOrSearchList, SearchList, WatchedDict
 
 
 class DummyClass(object):
@@ -476,6 +476,23 @@ class VFS_4namespaces(VFS):
     _searchListLength = 4
 
 
+class VFS_SearchList(VFS_3namespaces):
+    def searchList(self):
+        return SearchList(VFS_3namespaces.searchList(self))
+
+    def get(self, name, autocall=True):
+        searchList = self.searchList()
+        self.VFS(searchList, name, autocall)
+        # the second lookup uses the cache
+        return self.VFS(searchList, name, autocall)
+
+
+class VFS_SearchListPart(VFS_SearchList):
+    def searchList(self):
+        return [{'dummy': 1234}] + VFS_SearchList.searchList(self) \
+            + [{'dummy': 1234}]
+
+
 class VFF(VFN):
     def get(self, name, autocall=True):
         ns = self._testNamespace
@@ -541,6 +558,73 @@ class VFFSL_4(VFFSL):
     _searchListLength = 4
 
 
+class VFFSL_SearchList(VFFSL_3):
+    def searchList(self):
+        return SearchList(VFFSL_3.searchList(self))
+
+    def get(self, name, autocall=True):
+        searchList = self.searchList()
+        self.VFFSL(searchList, name, autocall)
+        return self.VFFSL(searchList, name, autocall)
+
+
+class SearchListCache(unittest.TestCase):
+    def setUp(self):
+        self.globalSetVars = WatchedDict()
+        self.searchList = SearchList(
+            [self.globalSetVars, {'a': 1}, {'a': 2, 'b': 3}],
+            watch=[self.globalSetVars])
+
+    def lookup(self, name):
+        return valueFromSearchList(
+            [{'local': 0}] + self.searchList + [{'global': 4}], name)
+
+    def test_cache(self):
+        self.assertEqual(self.lookup('a'), 1)
+        self.assertEqual(self.lookup('b'), 3)
+        self.assertEqual(self.lookup('global'), 4)
+        self.assertEqual(self.lookup('local'), 0)
+        self.assertEqual(self.searchList._nameCache,
+                         {'a': 1, 'b': 2, 'global': None})
+        self.assertEqual(self.lookup('a'), 1)
+        self.assertEqual(self.lookup('global'), 4)
+        self.assertRaises(NotFound, self.lookup, 'c')
+
+    def test_searchListChanged(self):
+        self.assertEqual(self.lookup('b'), 3)
+        self.searchList.insert(1, {'b': 5})
+        self.assertEqual(self.lookup('b'), 5)
+        del self.searchList[1]
+        self.assertEqual(self.lookup('b'), 3)
+        self.searchList.append({'c': 6})
+        self.assertEqual(self.lookup('c'), 6)
+
+    def test_watchedDictChanged(self):
+        self.assertEqual(self.lookup('a'), 1)
+        self.globalSetVars['a'] = 7
+        self.assertEqual(self.lookup('a'), 7)
+        del self.globalSetVars['a']
+        self.assertEqual(self.lookup('a'), 1)
+
+    def test_nameRemoved(self):
+        self.assertEqual(self.lookup('a'), 1)
+        del self.searchList[1]['a']
+        self.assertEqual(self.lookup('a'), 2)
+
+    def test_template(self):
+        from Cheetah.Template import Template
+        klass = Template.compile('''#for i in range(2)
+$a#slurp
+#set global a = 'global'
+#end for
+#silent $searchList.insert(0, {'a': 'inserted'})
+$a''')
+        klass._CHEETAH_useNameMapperCache = True
+        t = klass(searchList=[{'a': 'searchList'}])
+        self.assertIsInstance(t.searchList(), SearchList)
+        self.assertEqual(str(t), 'searchListglobalinserted')
+
+
 if sys.platform.startswith('java'):
     del VFF, VFFSL, VFFSL_2, VFFSL_3, VFFSL_4
 
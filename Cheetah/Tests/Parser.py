@@ -1,6 +1,7 @@
 import unittest
 
 from Cheetah import Parser
+from Cheetah.SourceReader import SourceReader
 
 
 class ArgListTest(unittest.TestCase):
@@ -43,3 +44,26 @@ class ArgListTest(unittest.TestCase):
         expect = [('arg', "'This is my block'")]
 
         self.assertEqual(expect, self.al.merge())
+
+
+class SourceReaderTest(unittest.TestCase):
+    def test_getRowCol(self):
+        reader = SourceReader('ab\ncd\r\n\ref')
+        self.assertEqual(reader.getRowCol(0), (1, 1))
+        self.assertEqual(reader.getRowCol(2), (1, 3))
+        self.assertEqual(reader.getRowCol(3), (2, 1))
+        self.assertEqual(reader.getRowCol(5), (2, 3))
+        self.assertEqual(reader.getRowCol(7), (3, 1))
+        self.assertEqual(reader.getRowCol(8), (4, 1))
+        self.assertEqual(reader.getRowCol(10), (4, 3))
+
+    def test_lineNum(self):
+        reader = SourceReader('a\r\nb\n')
+        self.assertEqual([reader.lineNum(pos) for pos in range(5)],
+                         [0, 0, None, 1, 1])
+        self.assertEqual(reader.lineNum(5), None)
+
+    def test_breakPoint(self):
+        reader = SourceReader('a\nb\nc', breakPoint=2)
+        self.assertEqual(reader.getRowCol(1), (1, 2))
+        self.assertEqual(reader.lineNum(2), None)
@@ -9,6 +9,7 @@ import unittest
 from test import pystone
 import time
 
+import Cheetah.Filters
 import Cheetah.NameMapper
 import Cheetah.Template
 from Cheetah.compat import unicode
@@ -168,6 +169,7 @@ class DynamicSimpleCompilationTest(PerformanceTest):
 
 class FilterTest(PerformanceTest):
     template = None
+    filter = 'RawOrEncodedUnicode'
 
     def setUp(self):
         super(FilterTest, self).setUp()
@@ -175,17 +177,120 @@ class FilterTest(PerformanceTest):
             #import sys
             #import os
             #set foo = [1, 2, 3, 4]
+            #set title = 'Fish & Chips'
 
             $foo, $foo, $foo
+            $title, $title, $len($foo)
         '''
         template = Cheetah.Template.Template.compile(
             template, keepRefToGeneratedCode=False)
-        self.template = template()
+        self.template = template(filter=self.filter)
 
     def performanceSample(self):
         value = unicode(self.template)  # noqa: F841
 
 
+class MemoizingFilterTest(FilterTest):
+    filter = Cheetah.Filters.memoize(Cheetah.Filters.Filter)
+
+
+class WebSafeFilterTest(PerformanceTest):
+    ''' Render many placeholders through the WebSafe filter '''
+    iterations = 1000
+
+    def setUp(self):
+        super(WebSafeFilterTest, self).setUp()
+        template = '''
+            #filter WebSafe
+            #for i in range(100)
+                <a href="$url">${title, also=' "'}</a>$i
+            #end for
+            #end filter
+        '''
+        template = Cheetah.Template.Template.compile(
+            template, keepRefToGeneratedCode=False)
+        self.template = template(searchList=[{
+            'url': '/search?q=x&page=2', 'title': 'Fish & "Chips"'}])
+
+    def performanceSample(self):
+        value = self.template.respond()  # noqa: F841
+
+
+class HoistedSearchListTest(PerformanceTest):
+    ''' Render many placeholders without stack frames '''
+    iterations = 1000
+    compilerSettings = {'useStackFrames': False, 'hoistSearchList': True}
+
+    def setUp(self):
+        super(HoistedSearchListTest, self).setUp()
+        template = '''
+            #for i in range(100)
+                $i: $title $title $title $title $title
+            #end for
+        '''
+        template = Cheetah.Template.Template.compile(
+            template, keepRefToGeneratedCode=False,
+            compilerSettings=self.compilerSettings)
+        self.template = template(searchList=[{'title': 'foo'}])
+
+    def performanceSample(self):
+        value = self.template.respond()  # noqa: F841
+
+
+class UnhoistedSearchListTest(HoistedSearchListTest):
+    compilerSettings = {'useStackFrames': False, 'hoistSearchList': False}
+
+
+class CoalescedWritesTest(PerformanceTest):
+    ''' Render static text mixed with placeholders '''
+    iterations = 1000
+    compilerSettings = {'coalesceWrites': True}
+
+    def setUp(self):
+        super(CoalescedWritesTest, self).setUp()
+        template = '''
+            #for i in range(100)
+                <li>$title|$i|$title</li>
+            #end for
+        '''
+        template = Cheetah.Template.Template.compile(
+            template, keepRefToGeneratedCode=False,
+            compilerSettings=self.compilerSettings)
+        self.template = template(searchList=[{'title': 'foo'}])
+
+    def performanceSample(self):
+        value = self.template.respond()  # noqa: F841
+
+
+class UncoalescedWritesTest(CoalescedWritesTest):
+    compilerSettings = {'coalesceWrites': False}
+
+
+class ProductionPlaceholdersTest(PerformanceTest):
+    ''' Render many placeholders without rawExpr for the filter '''
+    iterations = 1000
+    compilerSettings = {'useNameMapper': False, 'production': True}
+
+    def setUp(self):
+        super(ProductionPlaceholdersTest, self).setUp()
+        template = '''
+            #for i in range(100)
+                $i: $i $i $i $i $i
+            #end for
+        '''
+        template = Cheetah.Template.Template.compile(
+            template, keepRefToGeneratedCode=False,
+            compilerSettings=self.compilerSettings)
+        self.template = template()
+
+    def performanceSample(self):
+        value = self.template.respond()  # noqa: F841
+
+
+class DefaultPlaceholdersTest(ProductionPlaceholdersTest):
+    compilerSettings = {'useNameMapper': False}
+
+
 class LongCompileTest(PerformanceTest):
     ''' Test the compilation on a sufficiently large template '''
     def compile(self, template):
@@ -250,6 +355,20 @@ class LongCompileAndRun(LongCompileTest):
         template = template.respond()
 
 
+class LargeStaticTemplateCompileTest(PerformanceTest):
+    ''' Test the parsing of a large template of mostly static HTML '''
+    iterations = 10
+
+    row = ('<tr><td class="label">Static report text</td>'
+           '<td class="value">more static text</td></tr>\n')
+    template = ''.join([row * 20 + '<p>$name</p>\n' for i in range(100)])
+
+    def performanceSample(self):
+        return Cheetah.Template.Template.compile(
+            self.template, keepRefToGeneratedCode=False,
+            useCache=False, cacheCompilationResults=False)
+
+
 if __name__ == '__main__':
     if '--debug' in sys.argv:
         DEBUG = True
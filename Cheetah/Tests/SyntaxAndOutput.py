@@ -18,10 +18,12 @@ TODO
 
 import os
 import os.path
+import re
 import sys
 import unittest
 import warnings
 
+from Cheetah import ParseTree
 from Cheetah.NameMapper import NotFound
 from Cheetah.Template import Template
 from Cheetah.Parser import ParseError
@@ -1152,6 +1154,23 @@ $aStr#slurp
 $foo$foo$foo$foo$foo""",
                     "1\n012346blarg"*5)  # noqa: E226,E501 missing whitespace around operator
 
+    def test7(self):
+        r"""nested #cache blocks with stale= and lock="""
+        self.verify("""#slurp
+#def foo
+#cache ID='cache1', timer=150m, stale=10m
+$anInt
+#cache id='cache2', lock=True
+ #for $i in range(5)
+$i#slurp
+ #end for
+#end cache
+#end cache
+$aStr#slurp
+#end def
+$foo$foo$foo""",
+                    "1\n01234blarg"*3)  # noqa: E226,E501 missing whitespace around operator
+
     def test6(self):
         r"""Make sure that partial directives don't match"""
         self.verify("#cache_foo",
@@ -3157,6 +3176,311 @@ class CGI(OutputTest):
         self._endCGI()
 
 
+class HoistSearchList(OutputTest):
+    def _getCompilerSettings(self):
+        return {'hoistSearchList': True, 'useStackFrames': False}
+
+    def searchList(self):
+        # a new list for the tests that modify it
+        return [defaultTestNameSpace]
+
+    def test1(self):
+        """placeholders in plain text"""
+        self.verify("$aStr $anInt $aFunc() $anObj.meth1",
+                    "blarg 1 Scooby doo")
+
+    def test2(self):
+        """#set between placeholders"""
+        self.verify("$anInt\n#set anInt = 5\n$anInt $numOne",
+                    "1\n5 1")
+
+    def test3(self):
+        """#for loop variables and #set in the loop"""
+        self.verify("#set s = 0\n"
+                    "#for i in $aList\n"
+                    "#set s = $s + 1\n"
+                    "$i $s $aStr\n"
+                    "#end for\n"
+                    "$i $s",
+                    "item0 1 blarg\nitem1 2 blarg\nitem2 3 blarg\n"
+                    "item2 3")
+
+    def test4(self):
+        """#if, #elif and #else"""
+        self.verify("#for i in $letterList\n"
+                    "#if $i == 'a'\na#slurp\n"
+                    "#elif $i == 'b'\nb$i#slurp\n"
+                    "#else\n$i#slurp\n"
+                    "#end if\n"
+                    "#end for",
+                    "abbc")
+
+    def test5(self):
+        """#while with a condition on a local variable"""
+        self.verify("#set i = 0\n"
+                    "#while $i < $numTwo\n"
+                    "#set i = $i + 1\n"
+                    "$i#slurp\n"
+                    "#end while",
+                    "12")
+
+    def test6(self):
+        """comprehensions and lambdas"""
+        self.verify("${[$x.upper() for x in $letterList]} "
+                    "${(lambda x: $numOne + x)(1)}",
+                    "['A', 'B', 'C'] 2")
+
+    def test7(self):
+        """a call that extends the searchList"""
+        self.verify("$self._CHEETAH__searchList.insert(0, {'newName': 5})"
+                    "#slurp\n$newName",
+                    "5")
+
+    def test8(self):
+        """#silent call that extends the searchList"""
+        self.verify("#silent "
+                    "$self._CHEETAH__searchList.insert(0, {'newName': 6})\n"
+                    "$newName",
+                    "6")
+
+    def test9(self):
+        """#def and #block"""
+        self.verify("#def f(x)\n$x $aStr\n#end def\n"
+                    "#block b\n$f($anInt)\n#end block b",
+                    "1 blarg\n\n")
+
+    def test10(self):
+        """#errorCatcher"""
+        self.verify("#errorCatcher Echo\n$nonExistent $aStr",
+                    "$nonExistent blarg")
+
+    def test11(self):
+        """an autocalled placeholder doesn't rebuild the searchList"""
+        template = Template.compile(
+            "#for i in $aList\n$aStr $anObj.meth1 $i\n#end for",
+            compilerSettings=self._getCompilerSettings(),
+            keepRefToGeneratedCode=True)
+        code = template._CHEETAH_generatedModuleCode
+        # before the loop and once per iteration for i
+        self.assertEqual(code.count("_SL = [locals()]"), 2)
+
+    def test12(self):
+        """#return and #stop"""
+        self.verify("#def f(x)\n#set y = $x\n#return $y + $anInt\n"
+                    "#end def\n"
+                    "$f(1) $aStr\n#stop\n$aStr",
+                    "2 blarg\n")
+
+    def test13(self):
+        """_SL is dropped where the method returns"""
+        template = Template.compile(
+            "#def f\n#return $aStr\n#end def\n$f $anInt",
+            compilerSettings=self._getCompilerSettings(),
+            keepRefToGeneratedCode=True)
+        code = template._CHEETAH_generatedModuleCode
+        self.assertEqual(code.count("_SL = None; locals()"), 2)
+
+
+class DirectLocalNames(OutputTest):
+    def _getCompilerSettings(self):
+        return {'useDirectLocalNames': True}
+
+    def test1(self):
+        """#for targets"""
+        self.verify("#for i, (a, b) in [(1, $nameList[0])]\n"
+                    "$i $a.upper() $b.upper\n"
+                    "#end for",
+                    "1 JOHN DOE\n")
+
+    def test2(self):
+        """#set locals"""
+        self.verify("#set d = $aDict\n$d.one $d.nestedFunc $d['two']",
+                    "item1 Scooby item2")
+
+    def test3(self):
+        """#def arguments"""
+        self.verify("#def f(a, *args, **kw)\n"
+                    "$a.one $args[0] $kw.k#slurp\n"
+                    "#end def\n"
+                    "$f($aDict, 2, k=3)",
+                    "item1 2 3")
+
+    def test4(self):
+        """names bound in a block are looked up after the block"""
+        self.verify("#if $zero\n#set aStr = 'local'\n#end if\n$aStr",
+                    "blarg")
+
+    def test5(self):
+        """#for targets after an empty loop"""
+        self.verify("#for anInt in []\n#pass\n#end for\n$anInt",
+                    "1")
+
+    def test6(self):
+        """#del"""
+        self.verify("#set aStr = 'local'\n$aStr\n#del aStr\n$aStr",
+                    "local\nblarg")
+
+    def test7(self):
+        """generated code"""
+        template = Template.compile(
+            "#for i in $aList\n$i.upper $aStr\n#end for",
+            compilerSettings=self._getCompilerSettings(),
+            keepRefToGeneratedCode=True)
+        code = template._CHEETAH_generatedModuleCode
+        self.assertIn('VFN(i,"upper",True)', code)
+        self.assertNotIn('"i.upper"', code)
+        self.assertIn('"aStr"', code)
+
+
+class CoalesceWrites(OutputTest):
+    def _getCompilerSettings(self):
+        return {'coalesceWrites': True}
+
+    def test1(self):
+        """static text and placeholders"""
+        self.verify("<li>$aStr|$anInt</li>\n<li>$aFunc()</li>",
+                    "<li>blarg|1</li>\n<li>Scooby</li>")
+
+    def test2(self):
+        """writes in blocks"""
+        self.verify("#for i in range(2)\n<$i>\n#if $i\n$aStr\n#end if\n"
+                    "#end for\ndone $anInt",
+                    "<0>\n<1>\nblarg\ndone 1")
+
+    def test3(self):
+        """silent placeholders"""
+        self.verify("a $!undefinedName b $aStr c",
+                    "a  b blarg c")
+
+    def test4(self):
+        """generated code"""
+        template = Template.compile(
+            "<li>$aStr|$anInt</li>\n",
+            compilerSettings=self._getCompilerSettings(),
+            keepRefToGeneratedCode=True)
+        code = template._CHEETAH_generatedModuleCode
+        # u'''<li>''' on Python 2
+        self.assertTrue(re.search(
+            r"write\(''\.join\(\(u?'''<li>''', _filter\(", code), code)
+        self.assertEqual(code.count("write("), 1)
+
+
+class CoalesceWritesHoistSearchList(HoistSearchList):
+    def _getCompilerSettings(self):
+        return {'coalesceWrites': True,
+                'hoistSearchList': True, 'useStackFrames': False}
+
+
+class OptimizationPasses(OutputTest):
+    def _getCompilerSettings(self):
+        return {'optimizationPasses': ['foldConstants', 'eliminateDeadCode',
+                                       'mergeWrites']}
+
+    def generatedCode(self, source, **settings):
+        compilerSettings = self._getCompilerSettings()
+        compilerSettings.update(settings)
+        template = Template.compile(source,
+                                    compilerSettings=compilerSettings,
+                                    keepRefToGeneratedCode=True)
+        return template._CHEETAH_generatedModuleCode
+
+    def test1(self):
+        """#if False"""
+        self.verify("a\n#if False\n$undefinedName\n#end if\nb $aStr",
+                    "a\nb blarg")
+        self.assertNotIn('if False', self.generatedCode(
+            "a\n#if False\n$undefinedName\n#end if\nb $aStr"))
+
+    def test2(self):
+        """#elif and #else"""
+        self.verify("#if 1 > 2\none\n#elif $anInt\ntwo\n"
+                    "#elif not 0\nthree\n#else\nfour\n#end if",
+                    "two\n")
+        self.verify("#if 0\none\n#elif None\ntwo\n#else\nthree\n#end if",
+                    "three\n")
+        self.verify("#unless True\none\n#end unless\n#if 0: two\n"
+                    "#else: three\n",
+                    "three\n")
+
+    def test3(self):
+        """blocks around loops"""
+        self.verify("#for i in range(3)\n#if False\nno\n#end if\n#end for\n"
+                    "#if $anInt\n#for i in range(2)\n$i\n#end for\n"
+                    "#end if",
+                    "0\n1\n")
+
+    def test4(self):
+        """merged writes"""
+        code = self.generatedCode(
+            "a $aStr\n#if True\nb $aStr\n#end if\nc",
+            coalesceWrites=True)
+        self.assertNotIn('if True', code)
+        self.assertEqual(code.count('write('), 1)
+
+    def test5(self):
+        """passes given as callables"""
+        def dropPlaceholders(nodes):
+            return [node for node in nodes
+                    if not isinstance(node, ParseTree.Placeholder)]
+        code = self.generatedCode("a $aStr b",
+                                  optimizationPasses=[dropPlaceholders])
+        self.assertNotIn('"aStr"', code)
+
+    def test6(self):
+        """constant expressions"""
+        self.assertIs(ParseTree.evalConstant('1 < 2 < 3 and not None'), True)
+        self.assertEqual(ParseTree.evalConstant('-1'), -1)
+        self.assertIs(ParseTree.evalConstant('"a" in ("a", "b")'), True)
+        self.assertIs(ParseTree.evalConstant('x == 1'), ParseTree.Unknown)
+        self.assertIs(ParseTree.evalConstant('2 ** 3'), ParseTree.Unknown)
+        self.assertIs(ParseTree.evalConstant('1 < "a"' if not PY2
+                                             else 'x'),
+                      ParseTree.Unknown)
+
+
+class ProductionCode(OutputTest):
+    def _getCompilerSettings(self):
+        return {'production': True}
+
+    def test1(self):
+        """no rawExpr and no comments"""
+        self.verify("$aStr\n#for i in range(2)\n$i#end for", "blarg\n01")
+        template = Template.compile("$aStr\n#if $anInt\n$aStr#end if",
+                                    compilerSettings={'production': True},
+                                    keepRefToGeneratedCode=True)
+        code = template._CHEETAH_generatedModuleCode
+        self.assertNotIn('rawExpr', code)
+        self.assertNotIn('line 1, col 1', code)
+        self.assertNotIn('\0', code)
+
+    def test2(self):
+        """the line map"""
+        source = "a $aStr\n#if $anInt\n  $anInt#end if"
+        template = Template.compile(source,
+                                    compilerSettings={'production': True},
+                                    keepRefToGeneratedCode=True)
+        codeLines = template._CHEETAH_generatedModuleCode.splitlines()
+        lineMap = template._CHEETAH_lineMap
+        self.assertEqual(sorted(set(lineMap.values())),
+                         [(0, 1, 3), (0, 2, 1), (0, 3, 3)])
+        self.assertEqual(template._CHEETAH_sourceFiles, (None,))
+        for codeLine, (fileIndex, line, col) in lineMap.items():
+            codeLine = codeLines[codeLine - 1].strip()
+            if (line, col) == (2, 1):
+                self.assertTrue(codeLine.startswith('if '))
+            elif not codeLine.startswith('def '):
+                self.assertIn('_v', codeLine)
+
+    def test3(self):
+        """the line map with coalesceWrites"""
+        template = Template.compile("a $aStr b $anInt",
+                                    compilerSettings={'production': True,
+                                                      'coalesceWrites': True})
+        self.assertEqual(sorted(template._CHEETAH_lineMap.values()),
+                         [(0, 1, 3), (0, 1, 3), (0, 1, 11)])
+        self.verify("a $aStr b $anInt", "a blarg b 1")
+
+
 class WhitespaceAfterDirectiveTokens(OutputTest):
     def _getCompilerSettings(self):
         return {'allowWhitespaceAfterDirectiveStartToken': True}
@@ -1,11 +1,20 @@
+import gc
+import io
 import os
 import os.path
 import sys
 import shutil
 import tempfile
+import threading
+import time
 import unittest
+import warnings
+import weakref
 
-from Cheetah.Template import Template
+from Cheetah.CompileCache import CompileCache
+from Cheetah.NameMapper import NotFound
+from Cheetah.Template import Template, CompileCacheItem, checkFileMtime, \
+    extractTraceback, formatException, rewriteProfileStats, sourcePosition
 from Cheetah.compat import unicode
 
 
@@ -355,3 +364,511 @@ class SubclassSearchListTest(TemplateTest):
             greeting = 'Hola'
         tmpl = Sub('''When we meet, I say "${greeting}"''')
         self.assertEqual(unicode(tmpl), 'When we meet, I say "Hola"')
+
+
+class PersistentCompileCacheTest(TemplateTest):
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+
+        class CachingTemplate(Template):
+            _CHEETAH_compileCache = {}
+            _CHEETAH_compileCacheDir = self.cacheDir
+        self.templateAPIClass = CachingTemplate
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir, True)
+
+    def _cacheFiles(self):
+        return [fn for fn in os.listdir(self.cacheDir)
+                if fn.endswith('.cheetahc')]
+
+    def test_storeAndLoad(self):
+        klass = self.templateAPIClass.compile(source='$foo')
+        self.assertEqual(len(self._cacheFiles()), 1)
+        self.assertTrue(klass._CHEETAH_compilerInstance)
+
+        # Simulate a new process: empty the in-memory cache
+        self.templateAPIClass._CHEETAH_compileCache.clear()
+        klass2 = self.templateAPIClass.compile(source='$foo')
+        self.assertIsNot(klass2, klass)
+        self.assertIsNone(klass2._CHEETAH_compilerInstance)
+        self.assertEqual(klass2._CHEETAH_generatedModuleCode,
+                         klass._CHEETAH_generatedModuleCode)
+        self.assertEqual(str(klass2(namespaces={'foo': 1234})), '1234')
+        self.assertEqual(len(self._cacheFiles()), 1)
+
+    def test_keyDependsOnSettings(self):
+        self.templateAPIClass.compile(source='$foo')
+        self.templateAPIClass.compile(source='$foo', className='foo123')
+        self.templateAPIClass.compile(
+            source='$foo', compilerSettings={'useAutocalling': False})
+        self.templateAPIClass.compile(source='$bar')
+        self.assertEqual(len(self._cacheFiles()), 4)
+
+    def test_unstableSettingsAreNotCached(self):
+        self.templateAPIClass.compile(
+            source='$foo',
+            compilerSettings={'expressionFilterHooks': [lambda *a, **kw: 1]})
+        self.assertEqual(self._cacheFiles(), [])
+
+    def test_unwritableCacheDir(self):
+        self.templateAPIClass._CHEETAH_compileCacheDir = os.path.join(
+            self.cacheDir, 'nonexistent')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            klass = self.templateAPIClass.compile(source='$foo')
+        self.assertEqual(str(klass(namespaces={'foo': 1234})), '1234')
+        messages = [str(w.message) for w in caught
+                    if 'compile cache' in str(w.message)]
+        self.assertEqual(len(messages), 1)
+
+    def test_useCacheAndCacheCompilationResults(self):
+        self.templateAPIClass.compile(source='$foo',
+                                      cacheCompilationResults=False)
+        self.assertEqual(self._cacheFiles(), [])
+        self.templateAPIClass.compile(source='$foo')
+        self.templateAPIClass._CHEETAH_compileCache.clear()
+        klass = self.templateAPIClass.compile(source='$foo', useCache=False)
+        self.assertTrue(klass._CHEETAH_compilerInstance)
+
+    def test_corruptEntry(self):
+        self.templateAPIClass.compile(source='$foo')
+        for fn in self._cacheFiles():
+            with open(os.path.join(self.cacheDir, fn), 'wb') as f:
+                f.write(b'garbage')
+        self.templateAPIClass._CHEETAH_compileCache.clear()
+        klass = self.templateAPIClass.compile(source='$foo')
+        self.assertTrue(klass._CHEETAH_compilerInstance)
+        self.assertEqual(str(klass(namespaces={'foo': 1234})), '1234')
+
+    def test_file(self):
+        tmplPath = os.path.join(self.cacheDir, 'test.tmpl')
+        with open(tmplPath, 'w') as f:
+            f.write('$foo')
+        self.templateAPIClass.compile(file=tmplPath)
+        self.templateAPIClass._CHEETAH_compileCache.clear()
+        klass = self.templateAPIClass.compile(file=tmplPath)
+        self.assertIsNone(klass._CHEETAH_compilerInstance)
+
+        # Changed file contents must not be served from the cache
+        with open(tmplPath, 'w') as f:
+            f.write('-$foo-')
+        self.templateAPIClass._CHEETAH_compileCache.clear()
+        klass = self.templateAPIClass.compile(file=tmplPath)
+        self.assertTrue(klass._CHEETAH_compilerInstance)
+        self.assertEqual(str(klass(namespaces={'foo': 1234})), '-1234-')
+
+    def test_returnCode(self):
+        code = self.templateAPIClass.compile(source='$foo',
+                                             returnAClass=False)
+        self.templateAPIClass._CHEETAH_compileCache.clear()
+        self.assertEqual(
+            self.templateAPIClass.compile(source='$foo', returnAClass=False),
+            code)
+
+
+class CompileCacheEvictionTest(TemplateTest):
+    def _templateAPIClass(self, **limits):
+        class CachingTemplate(Template):
+            _CHEETAH_compileCache = CompileCache(**limits)
+        return CachingTemplate
+
+    def test_statsAndUnbounded(self):
+        templateAPIClass = self._templateAPIClass()
+        cache = templateAPIClass._CHEETAH_compileCache
+        klass = templateAPIClass.compile(source='$foo')
+        self.assertIs(templateAPIClass.compile(source='$foo'), klass)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['evictions'], 0)
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['codeSize'],
+                         len(klass._CHEETAH_generatedModuleCode))
+
+    def test_maxEntries(self):
+        templateAPIClass = self._templateAPIClass(maxEntries=2)
+        cache = templateAPIClass._CHEETAH_compileCache
+        klass1 = templateAPIClass.compile(source='$one')
+        templateAPIClass.compile(source='$two')
+        templateAPIClass.compile(source='$one')  # $two is now the LRU
+        templateAPIClass.compile(source='$three')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIs(templateAPIClass.compile(source='$one'), klass1)
+        klass2 = templateAPIClass.compile(source='$two')
+        self.assertTrue(klass2._CHEETAH_isInCompilationCache)
+        self.assertEqual(cache.evictions, 2)
+
+    def test_evictionRemovesModule(self):
+        templateAPIClass = self._templateAPIClass(maxEntries=1)
+        klass1 = templateAPIClass.compile(source='$one')
+        moduleName = klass1.__module__
+        self.assertIn(moduleName, sys.modules)
+        templateAPIClass.compile(source='$two')
+        self.assertNotIn(moduleName, sys.modules)
+        self.assertFalse(klass1._CHEETAH_isInCompilationCache)
+        # Instances of evicted classes keep working
+        self.assertEqual(str(klass1(namespaces={'one': 1})), '1')
+
+    def test_maxCodeSize(self):
+        templateAPIClass = self._templateAPIClass()
+        cache = templateAPIClass._CHEETAH_compileCache
+        klass = templateAPIClass.compile(source='$one')
+        cache.maxCodeSize = len(klass._CHEETAH_generatedModuleCode) * 3 // 2
+        templateAPIClass.compile(source='$two')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_maxIdleTime(self):
+        templateAPIClass = self._templateAPIClass(maxIdleTime=60)
+        cache = templateAPIClass._CHEETAH_compileCache
+        klass = templateAPIClass.compile(source='$one')
+        list(cache.values())[0].lastCheckoutTime -= 61
+        self.assertIsNot(templateAPIClass.compile(source='$one'), klass)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(cache), 1)
+
+    def test_clear(self):
+        templateAPIClass = self._templateAPIClass()
+        cache = templateAPIClass._CHEETAH_compileCache
+        klass = templateAPIClass.compile(source='$one')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertNotIn(klass.__module__, sys.modules)
+
+
+class IterRespondTest(TemplateTest):
+    source = '''#for i in range(1000)
+$i $name
+#end for
+'''
+
+    def test_chunks(self):
+        template = Template(self.source, searchList=[{'name': 'foo'}])
+        chunks = list(template.iterRespond(chunkSize=100))
+        self.assertTrue(len(chunks) > 10)
+        self.assertTrue(all(len(chunk) < 200 for chunk in chunks))
+        self.assertEqual(''.join(chunks), unicode(template))
+
+    def test_methodName(self):
+        template = Template(
+            '#def body(): <$name>\n', searchList=[{'name': 'foo'}])
+        self.assertEqual(''.join(template.iterRespond(methodName='body')),
+                         '<foo>')
+
+    def test_exception(self):
+        template = Template('start\n$undefinedName\n')
+        chunks = template.iterRespond(chunkSize=1)
+        self.assertEqual(next(chunks), 'start\n')
+        self.assertRaises(NotFound, list, chunks)
+
+    def test_close(self):
+        template = Template(self.source, searchList=[{'name': 'foo'}])
+        chunks = template.iterRespond(chunkSize=10)
+        next(chunks)
+        chunks.close()
+
+    def test_closeInTry(self):
+        # StreamingClosed isn't caught by #except Exception
+        template = Template('#while True\n#try\nx\n'
+                            '#except Exception\n#pass\n#end try\n'
+                            '#end while\n')
+        threadCount = threading.active_count()
+        chunks = template.iterRespond(chunkSize=1)
+        next(chunks)
+        chunks.close()
+        for i in range(100):
+            if threading.active_count() == threadCount:
+                break
+            time.sleep(0.05)
+        self.assertEqual(threading.active_count(), threadCount)
+
+
+class RespondToFileTest(TemplateTest):
+    source = u'''#for i in range(3)
+$i $name
+#end for
+'''
+
+    def test_textFile(self):
+        template = Template(self.source, searchList=[{'name': u'foo'}])
+        output = io.StringIO()
+        template.respondToFile(output)
+        self.assertEqual(output.getvalue(), u'0 foo\n1 foo\n2 foo\n')
+
+    def test_encoding(self):
+        template = Template(self.source, searchList=[{'name': u'f\xf6\xf6'}])
+        output = io.BytesIO()
+        template.respondToFile(output, encoding='utf-8')
+        self.assertEqual(output.getvalue(),
+                         u'0 f\xf6\xf6\n1 f\xf6\xf6\n2 f\xf6\xf6\n'
+                         .encode('utf-8'))
+
+
+class IncludeCacheTest(TemplateTest):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.includePath = os.path.join(self.tmpDir, 'header.tmpl')
+        self.writeInclude(u'Header $name', 1000000000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeInclude(self, source, mtime):
+        with open(self.includePath, 'w') as includeFile:
+            includeFile.write(source)
+        os.utime(self.includePath, (mtime, mtime))
+
+    def page(self, name):
+        klass = Template.compile(
+            '#include $includePath\n', cacheCompilationResults=False)
+        return klass(searchList=[{'includePath': self.includePath,
+                                  'name': name}])
+
+    def test_sharedClass(self):
+        first = self.page('a')
+        self.assertEqual(str(first), 'Header a')
+        second = self.page('b')
+        self.assertEqual(str(second), 'Header b')
+        firstIncludes = first._CHEETAH__cheetahIncludes
+        secondIncludes = second._CHEETAH__cheetahIncludes
+        self.assertIs(firstIncludes[self.includePath].__class__,
+                      secondIncludes[self.includePath].__class__)
+
+    def test_modified(self):
+        self.assertEqual(str(self.page('a')), 'Header a')
+        self.writeInclude(u'Footer $name', 1000000100)
+        self.assertEqual(str(self.page('a')), 'Footer a')
+
+    def test_evicted(self):
+        page = self.page('a')
+        str(page)
+        includeClass = page._CHEETAH__cheetahIncludes[self.includePath] \
+            .__class__
+        classRef = weakref.ref(includeClass)
+        for key, item in Template._CHEETAH_compileCache.items():
+            if item.klass is includeClass:
+                del Template._CHEETAH_compileCache[key]
+        del page, includeClass, item
+        gc.collect()
+        self.assertIsNone(classRef())
+        self.assertEqual(str(self.page('b')), 'Header b')
+
+
+class InlineIncludesTest(TemplateTest):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.includePath = os.path.join(self.tmpDir, 'header.tmpl')
+        self.writeInclude(u'#set title = $name.upper()\nHeader $title\n',
+                          1000000000)
+        self.source = (u'#include "%s"\n#include raw "%s"\nBody $title'
+                       % (self.includePath, self.includePath))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeInclude(self, source, mtime):
+        with open(self.includePath, 'w') as includeFile:
+            includeFile.write(source)
+        os.utime(self.includePath, (mtime, mtime))
+
+    def compile(self, **kw):
+        return Template.compile(self.source,
+                                compilerSettings={'inlineIncludes': True},
+                                **kw)
+
+    def test_inlined(self):
+        klass = self.compile()
+        self.assertNotIn('_handleCheetahInclude',
+                         klass._CHEETAH_generatedModuleCode)
+        self.assertEqual(klass._CHEETAH_includedFiles,
+                         ((self.includePath, 1000000000),))
+        self.assertEqual(
+            str(klass(searchList=[{'name': 'foo'}])),
+            'Header FOO\n#set title = $name.upper()\nHeader $title\n'
+            'Body FOO')
+
+    def test_expression(self):
+        klass = Template.compile(u'#include $path',
+                                 compilerSettings={'inlineIncludes': True})
+        self.assertIn('_handleCheetahInclude',
+                      klass._CHEETAH_generatedModuleCode)
+
+    def test_modified(self):
+        klass = self.compile()
+        self.assertIs(self.compile(), klass)
+        self.writeInclude(u'#set title = $name\nFooter\n', 1000000100)
+        modifiedClass = self.compile()
+        self.assertIsNot(modifiedClass, klass)
+        self.assertEqual(str(modifiedClass(searchList=[{'name': 'foo'}])),
+                         'Footer\n#set title = $name\nFooter\nBody foo')
+
+    def test_persistentCache(self):
+        cacheDir = os.path.join(self.tmpDir, 'cache')
+        os.mkdir(cacheDir)
+        self.compile(compileCacheDir=cacheDir, cacheCompilationResults=False)
+        self.writeInclude(u'Footer\n', 1000000100)
+        klass = self.compile(compileCacheDir=cacheDir,
+                             cacheCompilationResults=False)
+        self.assertEqual(klass._CHEETAH_includedFiles,
+                         ((self.includePath, 1000000100),))
+
+    def test_cacheRegions(self):
+        # #cache at the same position in two included files
+        paths = []
+        for name in ('A', 'B'):
+            path = os.path.join(self.tmpDir, name + '.tmpl')
+            with open(path, 'w') as includeFile:
+                includeFile.write(u'#cache\n%s:$n\n#end cache\n' % name)
+            paths.append(path)
+        klass = Template.compile(
+            u'#include "%s"\n#include "%s"\n' % tuple(paths),
+            compilerSettings={'inlineIncludes': True})
+        self.assertEqual(str(klass(searchList=[{'n': 1}])), 'A:1\nB:1\n')
+
+
+class RawIncludeCacheTest(TemplateTest):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.includePath = os.path.join(self.tmpDir, 'footer.html')
+        self.writeInclude(u'<footer>', 1000000000)
+        self.klass = Template.compile(
+            '#include raw $includePath\n', cacheCompilationResults=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+        checkFileMtime(True)
+
+    def writeInclude(self, source, mtime):
+        with open(self.includePath, 'w') as includeFile:
+            includeFile.write(source)
+        os.utime(self.includePath, (mtime, mtime))
+
+    def render(self):
+        return str(self.klass(searchList=[{'includePath': self.includePath}]))
+
+    def test_cached(self):
+        self.assertEqual(self.render(), '<footer>')
+        # same mtime and size: the file isn't read again
+        self.writeInclude(u'<FOOTER>', 1000000000)
+        self.assertEqual(self.render(), '<footer>')
+        self.writeInclude(u'<footer/>', 1000000000)
+        self.assertEqual(self.render(), '<footer/>')
+        self.writeInclude(u'<FOOTER/>', 1000000100)
+        self.assertEqual(self.render(), '<FOOTER/>')
+
+    def test_checkFileMtime(self):
+        self.assertEqual(self.render(), '<footer>')
+        checkFileMtime(False)
+        self.writeInclude(u'<footer/>', 1000000100)
+        self.assertEqual(self.render(), '<footer>')
+        Template.clearFileContentsCache()
+        self.assertEqual(self.render(), '<footer/>')
+
+    def test_bounded(self):
+        cache = Template._CHEETAH_fileContentsCache
+        self.render()
+        self.assertIn(self.includePath, cache)
+        for i in range(cache.maxEntries):
+            cache['/nonexistent/%d' % i] = CompileCacheItem()
+        self.assertNotIn(self.includePath, cache)
+        self.assertEqual(len(cache), cache.maxEntries)
+        Template.clearFileContentsCache()
+        self.assertEqual(len(cache), 0)
+
+
+def _fail():
+    raise ValueError('failed')
+
+
+class SourceMapTest(TemplateTest):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.includePath = os.path.join(self.tmpDir, 'macros.tmpl')
+        with open(self.includePath, 'w') as includeFile:
+            includeFile.write(u'#def helper\n  $fail()\n#end def\n')
+        self.templatePath = os.path.join(self.tmpDir, 'page.tmpl')
+        with open(self.templatePath, 'w') as templateFile:
+            templateFile.write(u'Hello $name\n#include "%s"\n$helper()\n'
+                               % self.includePath)
+        self.klass = Template.compile(
+            file=self.templatePath,
+            compilerSettings={'production': True, 'inlineIncludes': True})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_sourcePosition(self):
+        self.assertEqual(self.klass._CHEETAH_sourceFiles,
+                         (self.templatePath, self.includePath))
+        positions = set([sourcePosition(self.klass, lineno)
+                         for lineno in self.klass._CHEETAH_lineMap])
+        self.assertEqual(positions, set([(self.templatePath, 1, 7),
+                                         (self.templatePath, 3, 1),
+                                         (self.includePath, 2, 3)]))
+        self.assertIsNone(sourcePosition(self.klass, 1))
+
+    def test_formatException(self):
+        template = self.klass(searchList=[{'name': 'foo', 'fail': _fail}])
+        try:
+            template.respond()
+        except ValueError:
+            frames = extractTraceback(sys.exc_info()[2])
+            lines = formatException(*sys.exc_info())
+        self.assertEqual(
+            [frame[:3] for frame in frames[1:3]],
+            [(self.templatePath, 3, 'respond'),
+             (self.includePath, 2, 'helper')])
+        self.assertEqual(frames[2][3], '$fail()')
+        self.assertIn('  File "%s", line 2, in helper\n    $fail()\n'
+                      % self.includePath, lines)
+        self.assertEqual(lines[-1], 'ValueError: failed\n')
+
+    def test_stringSource(self):
+        klass = Template.compile('$fail()',
+                                 compilerSettings={'production': True})
+        try:
+            klass(searchList=[{'fail': _fail}]).respond()
+        except ValueError:
+            frames = extractTraceback(sys.exc_info()[2])
+        self.assertEqual(frames[1], ('<template>', 1, 'respond', None))
+
+    def test_directives(self):
+        directives = ['#set z = $fail()', '#set global z = $fail()',
+                      '#silent $fail()', '#echo $fail()',
+                      '#del z', '#assert $fail() == 1',
+                      '#raise ValueError("failed")',
+                      '#call $fail\nx\n#end call']
+        for directive in directives:
+            templatePath = os.path.join(self.tmpDir, 'directive.tmpl')
+            with open(templatePath, 'w') as templateFile:
+                templateFile.write(u'Hello\n  %s\n' % directive)
+            klass = Template.compile(
+                file=templatePath, compilerSettings={'production': True})
+            template = klass(searchList=[{'fail': _fail,
+                                          'undefinedName': 1}])
+            try:
+                template.respond()
+            except Exception:
+                frames = extractTraceback(sys.exc_info()[2])
+            else:
+                self.fail(directive)
+            self.assertEqual(frames[1][:3], (templatePath, 2, 'respond'),
+                             directive)
+            self.assertEqual(frames[1][3], directive.split('\n')[0],
+                             directive)
+
+    def test_rewriteProfileStats(self):
+        import cProfile
+        import pstats
+        template = self.klass(
+            searchList=[{'name': 'foo', 'fail': lambda: 'bar'}])
+        profile = cProfile.Profile()
+        profile.runcall(template.respond)
+        stats = rewriteProfileStats(pstats.Stats(profile))
+        functions = set([func for func in stats.stats
+                         if func[0] in (self.templatePath,
+                                        self.includePath)])
+        self.assertEqual(functions, set([(self.templatePath, 1, 'respond'),
+                                         (self.includePath, 2, 'helper')]))
@@ -19,21 +19,31 @@ if args_l == 1:
 elif args_l == 2 and sys.argv[1] == 'test':
     pass
 elif args_l == 2 and sys.argv[1] == '--namemapper-pure':
-    try:
-        from Cheetah import _namemapper  # noqa
-    except ImportError:
-        # _namemapper hasn't been compiled so Tests/NameMapper.py
-        # tests pure-python NameMapper.py; no need to duplicate these tests.
+    # Test the pure-python NameMapper.py and Filters.py
+    compiled = False
+    for extension in ('_namemapper', '_filters'):
+        try:
+            __import__('Cheetah.' + extension)
+        except ImportError:
+            pass
+        else:
+            compiled = True
+    if not compiled:
+        # The extensions haven't been compiled so the tests already
+        # tested the pure-python modules; no need to duplicate these tests.
         print('Ok')
         sys.exit(0)
     sys.modules['Cheetah._namemapper'] = None
     sys._cheetah_namemapper_pure = True
+    sys.modules['Cheetah._filters'] = None
+    sys._cheetah_filters_pure = True
 else:
     sys.exit('Wrong argument or wrong number of arguments')
 
 import unittest  # noqa: E402 module level import not at top of file
 
 from Cheetah.Tests import Analyzer  # noqa: E402
+from Cheetah.Tests import CacheStore  # noqa: E402
 from Cheetah.Tests import CheetahWrapper  # noqa: E402
 from Cheetah.Tests import Filters  # noqa: E402
 from Cheetah.Tests import ImportHooks  # noqa: E402
@@ -51,6 +61,7 @@ SyntaxAndOutput.install_eols()
 
 suites = [
     unittest.defaultTestLoader.loadTestsFromModule(Analyzer),
+    unittest.defaultTestLoader.loadTestsFromModule(CacheStore),
     unittest.defaultTestLoader.loadTestsFromModule(Filters),
     unittest.defaultTestLoader.loadTestsFromModule(ImportHooks),
     unittest.defaultTestLoader.loadTestsFromModule(LoadTemplate),
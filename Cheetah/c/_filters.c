@@ -1,5 +1,5 @@
 /*
- * C-version of the src/Filters.py module
+ * C-version of the Filter, WebSafe and MaxLen filters of Filters.py
  *
  * (c) 2009, R. Tyler Ballance <tyler@slide.com>
  */
@@ -7,85 +7,495 @@
 
 #include "_filters.h"
 
-#if __STDC_VERSION__ >= 199901L
-#include <stdbool.h>
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/* Filters.webSafeEntities, registered with setWebSafeEntities() */
+static PyObject *webSafeEntities = NULL;
+/* builtin ord() */
+static PyObject *ordFunc = NULL;
+/* replacements of '&', '<' and '>' */
+static PyObject *ampEntity = NULL;
+static PyObject *ltEntity = NULL;
+static PyObject *gtEntity = NULL;
+
+
+/* Convert a value like Filters.Filter.filter(): None to an empty string and
+   everything but unicode to unicode.  Returns a new reference. */
+static PyObject *toUnicode(PyObject *val)
+{
+    if (val == Py_None) {
+        return PyUnicode_FromStringAndSize("", 0);
+    }
+    if (PyUnicode_Check(val)) {
+        Py_INCREF(val);
+        return val;
+    }
+#ifdef IS_PYTHON3
+    return PyObject_Str(val);
 #else
-typedef enum { false, true } bool;
+    {
+        PyObject *result = PyObject_Unicode(val);
+        if (result == NULL
+                && PyErr_ExceptionMatches(PyExc_UnicodeDecodeError)) {
+            /* pass the str on and let DummyTransaction worry about it */
+            PyErr_Clear();
+            result = PyObject_Str(val);
+        }
+        return result;
+    }
 #endif
+}
 
-#ifdef __cplusplus
-extern "C" {
+/* The value to filter: the first positional argument or val=.
+   Returns a borrowed reference. */
+static PyObject *getVal(PyObject *args, PyObject *kwargs)
+{
+    PyObject *val = NULL;
+
+    if (PyTuple_GET_SIZE(args) > 0) {
+        val = PyTuple_GET_ITEM(args, 0);
+    } else if (kwargs != NULL) {
+        val = PyDict_GetItemString(kwargs, "val");
+    }
+    if (val == NULL) {
+        PyErr_SetString(PyExc_TypeError,
+                        "filter() missing required argument 'val'");
+    }
+    return val;
+}
+
+/* The replacement of a character (or string) from the also= argument of
+   WebSafe: its entry in webSafeEntities or a numeric character reference.
+   Returns a new reference. */
+static PyObject *entityFor(PyObject *key)
+{
+    PyObject *entity = NULL;
+    PyObject *ord = NULL;
+
+    if (webSafeEntities != NULL) {
+        entity = PyObject_GetItem(webSafeEntities, key);
+        if (entity != NULL) {
+            return entity;
+        }
+        if (!PyErr_ExceptionMatches(PyExc_KeyError)) {
+            return NULL;
+        }
+        PyErr_Clear();
+    }
+    ord = PyObject_CallFunctionObjArgs(ordFunc, key, NULL);
+    if (ord == NULL) {
+        return NULL;
+    }
+    entity = PyUnicode_FromFormat("&#%S;", ord);
+    Py_DECREF(ord);
+    return entity;
+}
+
+/* Replace every string of keys in s by the string at the same index in
+   replacements, one after another like str.replace() in the pure-python
+   WebSafe.  Steals the reference to s; returns a new reference. */
+static PyObject *replaceSequentially(PyObject *s, PyObject **keys,
+                                     PyObject **replacements, Py_ssize_t n)
+{
+    PyObject *result;
+    Py_ssize_t i;
+
+    for (i = 0; i < n && s != NULL; i++) {
+        result = PyUnicode_Replace(s, keys[i], replacements[i], -1);
+        Py_DECREF(s);
+        s = result;
+    }
+    return s;
+}
+
+#ifdef IS_PYTHON3
+/* Replace the characters chars[i] in s by replacements[i] in one pass.
+   Returns a new reference; s itself if there is nothing to replace. */
+static PyObject *replaceChars(PyObject *s, Py_UCS4 *chars,
+                              PyObject **replacements, Py_ssize_t n)
+{
+    Py_ssize_t len, outLen, i, j, pos, replacementLen;
+    int kind, outKind, found;
+    const void *data;
+    void *outData;
+    Py_UCS4 c, maxChar;
+    signed char asciiIndex[128];
+    PyObject *result;
+
+#if PY_VERSION_HEX < 0x030C0000
+    if (PyUnicode_READY(s) < 0) {
+        return NULL;
+    }
+#endif
+    memset(asciiIndex, -1, sizeof(asciiIndex));
+    for (j = n - 1; j >= 0; j--) {  /* the first one wins */
+        if (chars[j] < 128) {
+            asciiIndex[chars[j]] = (signed char)j;
+        }
+    }
+
+#define FIND_REPLACEMENT(c, j) \
+    if ((c) < 128) { \
+        j = asciiIndex[(c)]; \
+    } else { \
+        j = 0; \
+        while (j < n && chars[j] != (c)) { \
+            j++; \
+        } \
+        if (j == n) { \
+            j = -1; \
+        } \
+    }
+
+    len = PyUnicode_GET_LENGTH(s);
+    kind = PyUnicode_KIND(s);
+    data = PyUnicode_DATA(s);
+    outLen = len;
+    found = 0;
+    for (i = 0; i < len; i++) {
+        c = PyUnicode_READ(kind, data, i);
+        FIND_REPLACEMENT(c, j);
+        if (j >= 0) {
+            outLen += PyUnicode_GET_LENGTH(replacements[j]) - 1;
+            found = 1;
+        }
+    }
+    if (!found) {
+        Py_INCREF(s);
+        return s;
+    }
+
+    maxChar = PyUnicode_MAX_CHAR_VALUE(s);
+    for (j = 0; j < n; j++) {
+        if (PyUnicode_MAX_CHAR_VALUE(replacements[j]) > maxChar) {
+            maxChar = PyUnicode_MAX_CHAR_VALUE(replacements[j]);
+        }
+    }
+    result = PyUnicode_New(outLen, maxChar);
+    if (result == NULL) {
+        return NULL;
+    }
+    outKind = PyUnicode_KIND(result);
+    outData = PyUnicode_DATA(result);
+    pos = 0;
+    for (i = 0; i < len; i++) {
+        c = PyUnicode_READ(kind, data, i);
+        FIND_REPLACEMENT(c, j);
+        if (j >= 0) {
+            replacementLen = PyUnicode_GET_LENGTH(replacements[j]);
+            if (PyUnicode_CopyCharacters(result, pos, replacements[j],
+                                         0, replacementLen) < 0) {
+                Py_DECREF(result);
+                return NULL;
+            }
+            pos += replacementLen;
+        } else {
+            PyUnicode_WRITE(outKind, outData, pos, c);
+            pos++;
+        }
+    }
+#undef FIND_REPLACEMENT
+    return result;
+}
+#endif
+
+/* Escape '&', '<', '>' and the characters in also.
+   Steals the reference to s; returns a new reference. */
+static PyObject *webSafe(PyObject *s, PyObject *also)
+{
+    PyObject *keys[MAX_WEBSAFE_CHARS];
+    PyObject *replacements[MAX_WEBSAFE_CHARS];
+    Py_ssize_t n = 0, i;
+    PyObject *iterator = NULL, *key = NULL, *entity = NULL;
+#ifdef IS_PYTHON3
+    int onePass = 1;
+    Py_UCS4 chars[MAX_WEBSAFE_CHARS];
+    Py_UCS4 c;
+    Py_ssize_t j;
+    PyObject *result;
+#endif
+
+    keys[0] = PyUnicode_FromOrdinal('&');
+    keys[1] = PyUnicode_FromOrdinal('<');
+    keys[2] = PyUnicode_FromOrdinal('>');
+    replacements[0] = ampEntity;
+    replacements[1] = ltEntity;
+    replacements[2] = gtEntity;
+    Py_INCREF(ampEntity);
+    Py_INCREF(ltEntity);
+    Py_INCREF(gtEntity);
+    n = 3;
+    if (keys[0] == NULL || keys[1] == NULL || keys[2] == NULL) {
+        goto error;
+    }
+
+    if (also != NULL && also != Py_None) {
+#ifdef IS_PYTHON3
+        /* One pass is only possible if also is a string of characters
+           that don't appear in the replacements of the preceding ones */
+        onePass = PyUnicode_Check(also)
+            && PyUnicode_GET_LENGTH(also) <= MAX_WEBSAFE_CHARS - n;
+#endif
+        iterator = PyObject_GetIter(also);
+        if (iterator == NULL) {
+            goto error;
+        }
+        while ((key = PyIter_Next(iterator))) {
+            if (n == MAX_WEBSAFE_CHARS) {
+                /* apply what we have and continue with the rest */
+                s = replaceSequentially(s, keys, replacements, n);
+                for (i = 0; i < n; i++) {
+                    Py_DECREF(keys[i]);
+                    Py_DECREF(replacements[i]);
+                }
+                n = 0;
+                if (s == NULL) {
+                    Py_DECREF(key);
+                    goto error;
+                }
+            }
+            entity = entityFor(key);
+            if (entity == NULL) {
+                Py_DECREF(key);
+                goto error;
+            }
+#ifdef IS_PYTHON3
+            if (onePass) {
+                if (!PyUnicode_Check(entity)) {
+                    onePass = 0;
+                } else {
+                    c = PyUnicode_READ_CHAR(key, 0);
+                    for (j = 0; j < n && onePass; j++) {
+                        if (PyUnicode_FindChar(replacements[j], c, 0,
+                                PyUnicode_GET_LENGTH(replacements[j]),
+                                1) != -1) {
+                            onePass = 0;
+                        }
+                    }
+                }
+            }
 #endif
+            keys[n] = key;
+            replacements[n] = entity;
+            n++;
+        }
+        if (PyErr_Occurred()) {
+            goto error;
+        }
+    }
+
+#ifdef IS_PYTHON3
+    if (onePass) {
+        for (i = 0; i < n; i++) {
+            chars[i] = PyUnicode_READ_CHAR(keys[i], 0);
+        }
+        result = replaceChars(s, chars, replacements, n);
+        Py_DECREF(s);
+        s = result;
+    } else
+#endif
+    {
+        s = replaceSequentially(s, keys, replacements, n);
+    }
+    goto done;
+
+error:
+    Py_XDECREF(s);
+    s = NULL;
+
+done:
+    for (i = 0; i < n; i++) {
+        Py_XDECREF(keys[i]);
+        Py_XDECREF(replacements[i]);
+    }
+    Py_XDECREF(iterator);
+    return s;
+}
 
 
+/* *************************************************************************** */
+/* Methods of the Filter type */
+
 static PyObject *py_filter(PyObject *self, PyObject *args, PyObject *kwargs)
 {
-    Py_RETURN_FALSE;
+    PyObject *val = getVal(args, kwargs);
+
+    if (val == NULL) {
+        return NULL;
+    }
+    return toUnicode(val);
+}
+
+static PyObject *py_webSafe(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    PyObject *val = getVal(args, kwargs);
+    PyObject *s, *also = NULL;
+
+    if (val == NULL) {
+        return NULL;
+    }
+    s = toUnicode(val);
+    if (s == NULL) {
+        return NULL;
+    }
+    if (kwargs != NULL) {
+        also = PyDict_GetItemString(kwargs, "also");
+    }
+    return webSafe(s, also);
+}
+
+static PyObject *py_maxLen(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    PyObject *val = getVal(args, kwargs);
+    PyObject *s, *maxlen = NULL, *len, *slice, *result;
+    int isLonger;
+
+    if (val == NULL) {
+        return NULL;
+    }
+    s = toUnicode(val);
+    if (s == NULL || kwargs == NULL) {
+        return s;
+    }
+    maxlen = PyDict_GetItemString(kwargs, "maxlen");
+    if (maxlen == NULL) {
+        return s;
+    }
+    len = PyLong_FromSsize_t(PyObject_Length(s));
+    if (len == NULL) {
+        Py_DECREF(s);
+        return NULL;
+    }
+    isLonger = PyObject_RichCompareBool(len, maxlen, Py_GT);
+    Py_DECREF(len);
+    if (isLonger <= 0) {
+        if (isLonger < 0) {
+            Py_DECREF(s);
+            return NULL;
+        }
+        return s;
+    }
+    slice = PySlice_New(NULL, maxlen, NULL);
+    if (slice == NULL) {
+        Py_DECREF(s);
+        return NULL;
+    }
+    result = PyObject_GetItem(s, slice);
+    Py_DECREF(slice);
+    Py_DECREF(s);
+    return result;
 }
 
-static const char _filtersdoc[] = "\
-\n\
-";
 static struct PyMethodDef py_filtermethods[] = {
     {"filter", (PyCFunction)(py_filter), METH_VARARGS | METH_KEYWORDS,
-            PyDoc_STR("Filter stuff")},
+            PyDoc_STR("Convert the value to unicode; None to u''")},
+    {"_webSafe", (PyCFunction)(py_webSafe), METH_VARARGS | METH_KEYWORDS,
+            PyDoc_STR("Filter the value and escape HTML entities")},
+    {"_maxLen", (PyCFunction)(py_maxLen), METH_VARARGS | METH_KEYWORDS,
+            PyDoc_STR("Filter the value and cut it off at maxlen")},
     {NULL},
 };
+
 static PyTypeObject PyFilterType = {
-    PyObject_HEAD_INIT(NULL)
-    0,                         /*ob_size*/
-    "_filters.Filter",             /*tp_name*/
-    sizeof(PyFilter), /*tp_basicsize*/
-    0,                         /*tp_itemsize*/
-    0,                         /*tp_dealloc*/
-    0,                         /*tp_print*/
-    0,                         /*tp_getattr*/
-    0,                         /*tp_setattr*/
-    0,                         /*tp_compare*/
-    0,                         /*tp_repr*/
-    0,                         /*tp_as_number*/
-    0,                         /*tp_as_sequence*/
-    0,                         /*tp_as_mapping*/
-    0,                         /*tp_hash */
-    0,                         /*tp_call*/
-    0,                         /*tp_str*/
-    0,                         /*tp_getattro*/
-    0,                         /*tp_setattro*/
-    0,                         /*tp_as_buffer*/
-    Py_TPFLAGS_DEFAULT,        /*tp_flags*/
-    "Filter object",           /* tp_doc */
-    0,                     /* tp_traverse */
-    0,                     /* tp_clear */
-    0,                     /* tp_richcompare */
-    0,                     /* tp_weaklistoffset */
-    0,                     /* tp_iter */
-    0,                     /* tp_iternext */
-    py_filtermethods,             /* tp_methods */
-#if 0
-    py_filtermembers,             /* tp_members */
-    0,                         /* tp_getset */
-    0,                         /* tp_base */
-    0,                         /* tp_dict */
-    0,                         /* tp_descr_get */
-    0,                         /* tp_descr_set */
-    0,                         /* tp_dictoffset */
-    (initproc)Noddy_init,      /* tp_init */
-    0,                         /* tp_alloc */
-    NULL,                 /* tp_new */
-#endif
+    PyVarObject_HEAD_INIT(NULL, 0)
 };
 
-PyMODINIT_FUNC init_filters()
+
+/* *************************************************************************** */
+/* Module functions */
+
+static PyObject *py_setWebSafeEntities(PyObject *self, PyObject *args)
 {
-    PyObject *module = Py_InitModule3("_filters", py_filtermethods, _filtersdoc);
+    PyObject *entities;
 
-    PyFilterType.tp_new = PyType_GenericNew;
-    if (PyType_Ready(&PyFilterType) < 0)
-        return;
+    if (!PyArg_ParseTuple(args, "O", &entities)) {
+        return NULL;
+    }
+    Py_INCREF(entities);
+    Py_XDECREF(webSafeEntities);
+    webSafeEntities = entities;
+    Py_RETURN_NONE;
+}
 
-    Py_INCREF(&PyFilterType);
+static const char _filtersdoc[] = "\
+C versions of Filter, WebSafe and MaxLen from Cheetah.Filters\n\
+";
+static struct PyMethodDef py_filtersfunctions[] = {
+    {"setWebSafeEntities", (PyCFunction)(py_setWebSafeEntities), METH_VARARGS,
+            PyDoc_STR("Set the mapping of the entities WebSafe knows")},
+    {NULL},
+};
+
+
+/* *************************************************************************** */
+/* Initialization function (import-time) */
+
+#ifdef IS_PYTHON3
+static struct PyModuleDef filtersmodule = {
+    PyModuleDef_HEAD_INIT,
+    "_filters",
+    _filtersdoc,
+    -1,
+    py_filtersfunctions,
+    NULL,
+    NULL,
+    NULL,
+    NULL};
+
+#define INIT_ERROR return NULL
+
+PyMODINIT_FUNC PyInit__filters(void)
+{
+    PyObject *module = PyModule_Create(&filtersmodule);
+#else
+
+#define INIT_ERROR return
 
+PyMODINIT_FUNC init_filters(void)
+{
+    PyObject *module = Py_InitModule3("_filters", py_filtersfunctions,
+                                      _filtersdoc);
+#endif
+    PyObject *builtins;
+
+    if (module == NULL) {
+        INIT_ERROR;
+    }
+
+    PyFilterType.tp_name = "Cheetah._filters.Filter";
+    PyFilterType.tp_basicsize = sizeof(PyFilter);
+    PyFilterType.tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE;
+    PyFilterType.tp_doc = "Base of the Cheetah filters";
+    PyFilterType.tp_methods = py_filtermethods;
+    PyFilterType.tp_new = PyType_GenericNew;
+    if (PyType_Ready(&PyFilterType) < 0) {
+        INIT_ERROR;
+    }
+    Py_INCREF(&PyFilterType);
     PyModule_AddObject(module, "Filter", (PyObject *)(&PyFilterType));
+
+#ifdef IS_PYTHON3
+    builtins = PyImport_ImportModule("builtins");
+#else
+    builtins = PyImport_ImportModule("__builtin__");
+#endif
+    if (builtins == NULL) {
+        INIT_ERROR;
+    }
+    ordFunc = PyObject_GetAttrString(builtins, "ord");
+    Py_DECREF(builtins);
+    ampEntity = PyUnicode_FromString("&amp;");
+    ltEntity = PyUnicode_FromString("&lt;");
+    gtEntity = PyUnicode_FromString("&gt;");
+    if (ordFunc == NULL || ampEntity == NULL || ltEntity == NULL
+            || gtEntity == NULL) {
+        INIT_ERROR;
+    }
+#ifdef IS_PYTHON3
+    return module;
+#endif
 }
 
 #ifdef __cplusplus
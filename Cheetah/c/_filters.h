@@ -11,6 +11,10 @@
 extern "C" {
 #endif
 
+#if PY_MAJOR_VERSION >= 3
+#define IS_PYTHON3
+#endif
+
 /*
  * Python 2.3 compatibility
  */
@@ -36,6 +40,9 @@ typedef struct {
     /* type specific fields */
 } PyFilter;
 
+/* The maximal number of characters WebSafe replaces in one pass */
+#define MAX_WEBSAFE_CHARS 64
+
 /*
  * End Filter Module
  */
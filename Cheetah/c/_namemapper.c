@@ -247,6 +247,125 @@ static PyObject *PyNamemapper_valueForName(PyObject *obj, char *nameChunks[], in
 }
 
 
+/* Get the name cache of a NameMapper.SearchList (or of a list created by
+   adding lists to one) and the bounds of the SearchList part of it.
+   Returns FALSE for other searchLists. */
+static int getNameCache(PyObject *searchList, PyObject **nameCache,
+                        Py_ssize_t *start, Py_ssize_t *end)
+{
+    PyObject *obj = NULL;
+
+    *nameCache = NULL;
+    if (!PyList_Check(searchList) || PyList_CheckExact(searchList)) {
+        return FALSE;
+    }
+    *nameCache = PyObject_GetAttrString(searchList, "_nameCache");
+    if (*nameCache == NULL || !PyDict_Check(*nameCache)) {
+        goto notCached;
+    }
+    obj = PyObject_GetAttrString(searchList, "_searchListStart");
+    if (obj == NULL) {
+        goto notCached;
+    }
+    *start = PyNumber_AsSsize_t(obj, NULL);
+    Py_DECREF(obj);
+    obj = PyObject_GetAttrString(searchList, "_searchListEnd");
+    if (obj == NULL) {
+        goto notCached;
+    }
+    *end = PyNumber_AsSsize_t(obj, NULL);
+    Py_DECREF(obj);
+    if (PyErr_Occurred() || *start < 0 || *end < *start
+            || *end > PyList_GET_SIZE(searchList)) {
+        goto notCached;
+    }
+    return TRUE;
+
+notCached:
+    PyErr_Clear();
+    Py_XDECREF(*nameCache);
+    *nameCache = NULL;
+    return FALSE;
+}
+
+/* Return a new reference to the first namespace in searchList that has the
+   key, using and updating the name cache of the SearchList part
+   searchList[start:end] (see NameMapper._namespaceForKey).
+   Returns NULL if no namespace has the key or if an exception was raised. */
+static PyObject *PyNamemapper_namespaceFromNameCache(PyObject *searchList,
+        PyObject *nameCache, Py_ssize_t start, Py_ssize_t end, char *key)
+{
+    PyObject *nameSpace = NULL;
+    PyObject *cached = NULL;
+    PyObject *index = NULL;
+    Py_ssize_t i;
+    int found;
+
+    for (i = 0; i < start && i < PyList_GET_SIZE(searchList); i++) {
+        nameSpace = PyList_GET_ITEM(searchList, i);
+        Py_INCREF(nameSpace);
+        if (PyNamemapper_hasKey(nameSpace, key)) {
+            return nameSpace;
+        }
+        Py_DECREF(nameSpace);
+    }
+
+    cached = PyDict_GetItemString(nameCache, key); /* borrowed */
+    if (cached == Py_None) {
+        /* not in the SearchList part */
+        i = end;
+    } else {
+        if (cached != NULL) {
+            i = PyNumber_AsSsize_t(cached, NULL);
+            if (!PyErr_Occurred() && i >= 0 && start + i < end
+                    && start + i < PyList_GET_SIZE(searchList)) {
+                nameSpace = PyList_GET_ITEM(searchList, start + i);
+                Py_INCREF(nameSpace);
+                if (PyNamemapper_hasKey(nameSpace, key)) {
+                    return nameSpace;
+                }
+                Py_DECREF(nameSpace);
+            }
+            PyErr_Clear();
+        }
+        found = FALSE;
+        for (i = start; i < end && i < PyList_GET_SIZE(searchList); i++) {
+            nameSpace = PyList_GET_ITEM(searchList, i);
+            Py_INCREF(nameSpace);
+            if (PyNamemapper_hasKey(nameSpace, key)) {
+                found = TRUE;
+                break;
+            }
+            Py_DECREF(nameSpace);
+        }
+        if (found) {
+            index = PyLong_FromSsize_t(i - start);
+        } else {
+            index = Py_None;
+            Py_INCREF(index);
+        }
+        if (index == NULL || PyDict_SetItemString(nameCache, key, index) < 0) {
+            PyErr_Clear(); /* the cache is optional */
+        }
+        Py_XDECREF(index);
+        if (found) {
+            return nameSpace;
+        }
+        i = end;
+    }
+
+    for (; i < PyList_GET_SIZE(searchList); i++) {
+        nameSpace = PyList_GET_ITEM(searchList, i);
+        Py_INCREF(nameSpace);
+        if (PyNamemapper_hasKey(nameSpace, key)) {
+            return nameSpace;
+        }
+        Py_DECREF(nameSpace);
+    }
+    return NULL;
+}
+
+
 /* *************************************************************************** */
 /* Now the wrapper functions to export into the Python module */
 /* *************************************************************************** */
@@ -314,6 +433,8 @@ static PyObject *namemapper_valueFromSearchList(PYARGS)
     PyObject *nameSpace = NULL;
     PyObject *theValue = NULL;
     PyObject *iterator = NULL;
+    PyObject *nameCache = NULL;
+    Py_ssize_t start, end;
 
     static char *kwlist[] = {"searchList", "name", "executeCallables", NULL};
 
@@ -328,6 +449,20 @@ static PyObject *namemapper_valueFromSearchList(PYARGS)
         goto done;
     }
 
+    if (getNameCache(searchList, &nameCache, &start, &end)) {
+        nameSpace = PyNamemapper_namespaceFromNameCache(searchList, nameCache,
+                                                        start, end, nameChunks[0]);
+        if (nameSpace != NULL) {
+            checkForNameInNameSpaceAndReturnIfFound(TRUE);
+            Py_DECREF(nameSpace);
+        }
+        if (PyErr_Occurred()) {
+            goto done;
+        }
+        setNotFoundException(nameChunks[0], searchList);
+        goto done;
+    }
+
     iterator = PyObject_GetIter(searchList);
     if (iterator == NULL) {
         PyErr_SetString(PyExc_TypeError,"This searchList is not iterable!");
@@ -351,6 +486,7 @@ static PyObject *namemapper_valueFromSearchList(PYARGS)
 
 done:
     Py_XDECREF(iterator);
+    Py_XDECREF(nameCache);
     free(nameCopy);
     return theValue;
 }
@@ -373,6 +509,8 @@ static PyObject *namemapper_valueFromFrameOrSearchList(PyObject *self, PyObject
     PyObject *theValue = NULL;
     PyObject *excString = NULL;
     PyObject *iterator = NULL;
+    PyObject *nameCache = NULL;
+    Py_ssize_t start, end;
 
     static char *kwlist[] = {"searchList", "name", "executeCallables", NULL};
 
@@ -391,23 +529,35 @@ static PyObject *namemapper_valueFromFrameOrSearchList(PyObject *self, PyObject
     nameSpace = PyEval_GetLocals();
     checkForNameInNameSpaceAndReturnIfFound(FALSE);
 
-    iterator = PyObject_GetIter(searchList);
-    if (iterator == NULL) {
-        PyErr_SetString(PyExc_TypeError,"This searchList is not iterable!");
-        goto done;
-    }
-    while ( (nameSpace = PyIter_Next(iterator)) ) {
-        checkForNameInNameSpaceAndReturnIfFound(TRUE);
-        Py_DECREF(nameSpace);
-        if(PyErr_CheckSignals()) {
+    if (getNameCache(searchList, &nameCache, &start, &end)) {
+        nameSpace = PyNamemapper_namespaceFromNameCache(searchList, nameCache,
+                                                        start, end, nameChunks[0]);
+        if (nameSpace != NULL) {
+            checkForNameInNameSpaceAndReturnIfFound(TRUE);
+            Py_DECREF(nameSpace);
+        }
+        if (PyErr_Occurred()) {
+            goto done;
+        }
+    } else {
+        iterator = PyObject_GetIter(searchList);
+        if (iterator == NULL) {
+            PyErr_SetString(PyExc_TypeError,"This searchList is not iterable!");
+            goto done;
+        }
+        while ( (nameSpace = PyIter_Next(iterator)) ) {
+            checkForNameInNameSpaceAndReturnIfFound(TRUE);
+            Py_DECREF(nameSpace);
+            if(PyErr_CheckSignals()) {
+                theValue = NULL;
+                goto done;
+            }
+        }
+        if (PyErr_Occurred()) {
             theValue = NULL;
             goto done;
         }
     }
-    if (PyErr_Occurred()) {
-        theValue = NULL;
-        goto done;
-    }
 
     nameSpace = PyEval_GetGlobals();
     checkForNameInNameSpaceAndReturnIfFound(FALSE);
@@ -421,6 +571,7 @@ static PyObject *namemapper_valueFromFrameOrSearchList(PyObject *self, PyObject
 
 done:
     Py_XDECREF(iterator);
+    Py_XDECREF(nameCache);
     free(nameCopy);
     return theValue;
 }
@@ -80,8 +80,8 @@ ext_modules = [
               [os.path.join('Cheetah', 'c', '_namemapper.c')]),
     # Extension("Cheetah._verifytype",
     #            [os.path.join('Cheetah', 'c', '_verifytype.c')]),
-    # Extension("Cheetah._filters",
-    #            [os.path.join('Cheetah', 'c', '_filters.c')]),
+    Extension("Cheetah._filters",
+              [os.path.join('Cheetah', 'c', '_filters.c')]),
     # Extension('Cheetah._template',
     #            [os.path.join('Cheetah', 'c', '_template.c')]),
 ]